@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Master CPU usage while collecting results, with many tasks pending
+
+Compares the old polling loop in AssignParallel.main (client.wait(pending,
+1e-3) and set differences against client.outstanding) with the
+ResultCollector. The client is a stand-in for IPython.parallel.Client whose
+tasks complete at a fixed rate, and which mimics its bookkeeping in wait() and
+spin(), so this measures only the cost of collection on the master.
+
+Usage: bench_collect.py [--n-tasks N] [--rate R]
+"""
+import time
+import resource
+import argparse
+import collections
+
+from msmbuilder.parallel_assign.collect import ResultCollector
+
+
+class FakeClient(object):
+    """n_tasks tasks, which complete at `rate` tasks per second, starting
+    when the client is created"""
+    def __init__(self, n_tasks, rate):
+        self.msg_ids = ['msg-%d' % i for i in xrange(n_tasks)]
+        self.outstanding = set(self.msg_ids)
+        self.results = {}
+        start = time.time()
+        self._schedule = collections.deque((start + i / float(rate), msg_id)
+                                           for i, msg_id in enumerate(self.msg_ids))
+        self._queue_handlers = {'apply_reply': self._handle_apply_reply}
+
+    def _handle_apply_reply(self, msg):
+        msg_id = msg['parent_header']['msg_id']
+        self.outstanding.discard(msg_id)
+        self.results[msg_id] = None
+
+    def spin(self):
+        now = time.time()
+        while self._schedule and self._schedule[0][0] <= now:
+            _, msg_id = self._schedule.popleft()
+            self._queue_handlers['apply_reply']({'parent_header': {'msg_id': msg_id}})
+
+    def wait(self, jobs, timeout):
+        "Same bookkeeping as IPython.parallel.Client.wait (0.13)"
+        tic = time.time()
+        theids = set(jobs)
+        if not theids.intersection(self.outstanding):
+            return True
+        self.spin()
+        while theids.intersection(self.outstanding):
+            if timeout >= 0 and (time.time() - tic) > timeout:
+                break
+            time.sleep(1e-3)
+            self.spin()
+        return len(theids.intersection(self.outstanding)) == 0
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def polling(client):
+    "The collection loop from AssignParallel.main, before the collector"
+    pending = set(client.msg_ids)
+    n_done = 0
+    while pending:
+        client.wait(pending, 1e-3)
+        finished = pending.difference(client.outstanding)
+        pending = pending.difference(finished)
+        n_done += len(finished)
+    return n_done
+
+
+def collector(client):
+    collector = ResultCollector(client)
+    collector.watch(client.msg_ids)
+    return sum(1 for msg_id in collector)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-tasks', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=2000,
+                        help='tasks completed per second')
+    args = parser.parse_args()
+
+    for name, collect in [('polling', polling), ('collector', collector)]:
+        client = FakeClient(args.n_tasks, args.rate)
+        wall, cpu = time.time(), cpu_time()
+        n_done = collect(client)
+        wall, cpu = time.time() - wall, cpu_time() - cpu
+        assert n_done == args.n_tasks
+        print '%-10s %d tasks: %.1fs wall, %.1fs cpu (%.0f%% of a core)' % (
+            name, n_done, wall, cpu, 100 * cpu / wall)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Benchmark partitioning, loading, assignment and saving on a synthetic project
+
+A synthetic project (see synthetic.py) is written to a scratch directory,
+and then each stage of an assignment run is timed in this process, for each
+chunk size:
+
+  partition        local.partition (by frame count and with a cost model)
+  load             VTraj.load_xyz for every vtraj
+  load_gens        remote.load_gens, for each metric
+  assign           remote.assign on (up to --max-vtrajs) vtrajs, per metric
+  setup_containers local.setup_containers, for each layout
+  save             a Saver saving every vtraj, for each layout
+
+Every measurement is written as one line of JSON, with the configuration,
+the best time out of --repeat, and a rate (frames/s, or vtrajs/s for the
+bookkeeping stages), so that results from different revisions can be
+collected in one file and compared. A summary is printed to stderr.
+
+Usage: bench_suite.py [--n-trajs N] [--mean-length L] [--chunk-sizes 100,1000]
+                      [--metrics rmsd,dihedral] [--output results.jsonl]
+"""
+import os
+import sys
+import time
+import json
+import socket
+import shutil
+import argparse
+import tempfile
+import datetime
+import numpy as np
+import tables
+
+from msmbuilder import metrics
+from msmbuilder.parallel_assign import local, remote, kernels
+from synthetic import make_project, LENGTH_DISTRIBUTIONS
+
+
+def construct_metric(name):
+    if name == 'rmsd':
+        return metrics.RMSD()
+    if name == 'dihedral':
+        return metrics.Dihedral()
+    if name == 'contact':
+        return metrics.ContinuousContact()
+    raise ValueError('unknown metric %s' % name)
+
+
+def best_of(repeat, f):
+    """Run f() `repeat` times. Returns the shortest time, and what f returned
+    the last time"""
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        result = f()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+class Recorder(object):
+    "Writes the measurements as lines of JSON, and a summary to stderr"
+    def __init__(self, output, common):
+        self.output = output
+        self.common = common
+
+    def record(self, benchmark, seconds, n, unit, **params):
+        entry = dict(self.common)
+        entry.update(params)
+        entry.update({'benchmark': benchmark, 'seconds': seconds, 'n': n,
+                      'rate': n / seconds if seconds > 0 else None,
+                      'unit': unit + '/s'})
+        self.output.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.output.flush()
+
+        described = ' '.join('%s=%s' % e for e in sorted(params.items()))
+        rate = '%.4g %s/s' % (entry['rate'], unit) if entry['rate'] else '-'
+        print >> sys.stderr, '%-17s %-40s %9.4fs %16s' % (
+            benchmark, described, seconds, rate)
+
+
+def bench_partition(recorder, args, project, chunk_size):
+    n_frames = int(np.sum(project['TrajLengths']))
+    seconds, vtrajs = best_of(args.repeat,
+        lambda: local.partition(project, chunk_size))
+    recorder.record('partition', seconds, n_frames, 'frames',
+                    chunk_size=chunk_size, cost_model=False,
+                    n_vtrajs=len(vtrajs))
+
+    model = local.CostModel(frame_cost=1.0, open_cost=10.0)
+    seconds, vtrajs = best_of(args.repeat,
+        lambda: local.partition(project, chunk_size, model))
+    recorder.record('partition', seconds, n_frames, 'frames',
+                    chunk_size=chunk_size, cost_model=True,
+                    n_vtrajs=len(vtrajs))
+
+
+def bench_load(recorder, args, project, vtrajs, chunk_size):
+    from msmbuilder import Trajectory
+    from msmbuilder.parallel_assign.vtraj import HandlePool, CoordinateBuffer
+    n_atoms = Trajectory.LoadTrajectoryFile(project['ConfFilename']).GetNumberOfAtoms()
+    n_frames = sum(len(vtraj) for vtraj in vtrajs)
+
+    def load():
+        handles, buffer = HandlePool(), CoordinateBuffer()
+        for vtraj in vtrajs:
+            vtraj.load_xyz(n_atoms, handles, buffer)
+        handles.close()
+        return handles.bytes_read
+
+    seconds, bytes_read = best_of(args.repeat, load)
+    recorder.record('load', seconds, n_frames, 'frames',
+                    chunk_size=chunk_size, mb_per_s=bytes_read / 1e6 / seconds)
+
+
+def bench_assign(recorder, args, project, gens_fn, vtraj_sets):
+    for name in args.metrics:
+        metric = construct_metric(name)
+        # (pruned, index)
+        variants = [(False, False)]
+        if args.pruned and kernels.is_true_metric(metric):
+            variants.append((True, False))
+        if args.index and kernels.minkowski_p(metric) is not None:
+            variants.append((False, True))
+
+        for pruned, index in variants:
+            def load_gens():
+                del remote.STATES[:]
+                remote.load_gens(gens_fn, project['ConfFilename'], metric,
+                                 pruned, index=index)
+            seconds, _ = best_of(args.repeat, load_gens)
+            recorder.record('load_gens', seconds, args.n_gens, 'gens',
+                            metric=name, pruned=pruned, index=index)
+
+            for chunk_size, vtrajs in vtraj_sets:
+                vtrajs = vtrajs[:args.max_vtrajs]
+                n_frames = sum(len(vtraj) for vtraj in vtrajs)
+
+                def assign():
+                    totals = {}
+                    for vtraj in vtrajs:
+                        stats = remote.assign(vtraj, gens_fn, metric, pruned,
+                                              index=index)[3]
+                        for key, value in stats.iteritems():
+                            totals[key] = totals.get(key, 0) + value
+                    return totals
+                seconds, totals = best_of(args.repeat, assign)
+                recorder.record('assign', seconds, n_frames, 'frames',
+                                metric=name, pruned=pruned, index=index,
+                                chunk_size=chunk_size,
+                                n_distances=totals['n_distances'],
+                                compute_time=totals['compute_time'],
+                                io_time=totals['io_time'])
+
+
+def bench_containers(recorder, args, project, vtrajs, chunk_size):
+    for layout in local.LAYOUTS:
+        def setup():
+            directory = tempfile.mkdtemp(dir=args.workdir)
+            f_a, f_d = local.setup_containers(directory, project, vtrajs,
+                                              layout=layout)
+            return directory, f_a, f_d
+
+        def cleanup(directory, f_a, f_d):
+            f_a.close()
+            f_d.close()
+            shutil.rmtree(directory)
+
+        def timed_setup():
+            state = setup()
+            cleanup(*state)
+        seconds, _ = best_of(args.repeat, timed_setup)
+        recorder.record('setup_containers', seconds, len(vtrajs), 'vtrajs',
+                        chunk_size=chunk_size, layout=layout)
+
+        results = [(np.zeros(len(vtraj), dtype=np.int32),
+                    np.zeros(len(vtraj), dtype=np.float32)) for vtraj in vtrajs]
+        times = []
+        for _ in xrange(args.repeat):
+            state = setup()
+            saver = local.Saver(state[1], state[2], flush_every=16)
+            start = time.time()
+            for (a, d), vtraj in zip(results, vtrajs):
+                saver.save(a, d, vtraj)
+            saver.flush()
+            times.append(time.time() - start)
+            cleanup(*state)
+        recorder.record('save', min(times), len(vtrajs), 'vtrajs',
+                        chunk_size=chunk_size, layout=layout,
+                        n_frames=sum(len(vtraj) for vtraj in vtrajs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-trajs', type=int, default=100)
+    parser.add_argument('--mean-length', type=int, default=1000)
+    parser.add_argument('--distribution', choices=LENGTH_DISTRIBUTIONS,
+                        default='lognormal',
+                        help='distribution of the trajectory lengths')
+    parser.add_argument('--n-atoms', type=int, default=100)
+    parser.add_argument('--n-gens', type=int, default=1000)
+    parser.add_argument('--chunk-sizes', default='100,1000,10000',
+                        help='comma separated')
+    parser.add_argument('--metrics', default='rmsd,dihedral',
+                        help='comma separated, from rmsd, dihedral, contact')
+    parser.add_argument('--pruned', action='store_true',
+                        help='also time pruned assignment, where it applies')
+    parser.add_argument('--index', action='store_true',
+                        help='also time assignment with an index, where it applies')
+    parser.add_argument('--max-vtrajs', type=int, default=20,
+                        help='maximum number of vtrajs to assign per chunk size')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='report the best of this many runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None,
+                        help='scratch directory. defaults to a new temporary one')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the synthetic project at the end")
+    parser.add_argument('--output', default='-',
+                        help='file to append the results to (JSON lines)')
+    args = parser.parse_args()
+    args.chunk_sizes = [int(e) for e in args.chunk_sizes.split(',')]
+    args.metrics = args.metrics.split(',')
+
+    created = args.workdir is None
+    if created:
+        args.workdir = tempfile.mkdtemp(prefix='bench_suite')
+    output = sys.stdout if args.output == '-' else open(args.output, 'a')
+
+    config = dict((key, getattr(args, key)) for key in
+                  ['n_trajs', 'mean_length', 'distribution', 'n_atoms',
+                   'n_gens', 'seed'])
+    common = {'timestamp': datetime.datetime.now().isoformat(),
+              'host': socket.gethostname(),
+              'python': sys.version.split()[0],
+              'numpy': np.__version__,
+              'tables': tables.__version__,
+              'config': config}
+    recorder = Recorder(output, common)
+
+    try:
+        start = time.time()
+        project, gens_fn = make_project(os.path.join(args.workdir, 'project'),
+            args.n_trajs, args.mean_length, args.distribution, args.n_atoms,
+            args.n_gens, seed=args.seed)
+        print >> sys.stderr, 'made a project of %d frames in %.1fs' % (
+            np.sum(project['TrajLengths']), time.time() - start)
+
+        vtraj_sets = []
+        for chunk_size in args.chunk_sizes:
+            bench_partition(recorder, args, project, chunk_size)
+            vtrajs = local.partition(project, chunk_size)
+            vtraj_sets.append((chunk_size, vtrajs))
+            bench_load(recorder, args, project, vtrajs, chunk_size)
+            bench_containers(recorder, args, project, vtrajs, chunk_size)
+        bench_assign(recorder, args, project, gens_fn, vtraj_sets)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if created and not args.keep:
+            shutil.rmtree(args.workdir)
+
+
+if __name__ == '__main__':
+    main()
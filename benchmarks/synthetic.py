@@ -0,0 +1,136 @@
+"""
+Generate synthetic projects for benchmarking
+
+A synthetic project is a chain of alanine-like residues (N, CA, C and O
+atoms only), a set of trajectories of it, with lengths drawn from a chosen
+distribution, in which every frame is the starting structure plus some
+gaussian noise, and a set of generators picked from those frames. Everything
+is written to a directory as ordinary lh5/pdb files, so the code being
+benchmarked reads them exactly like a real project.
+"""
+import os
+import numpy as np
+
+from msmbuilder import Trajectory, Project
+
+BACKBONE = ['N', 'CA', 'C', 'O']
+
+# spacing between consecutive atoms, in nm
+BOND = 0.15
+
+LENGTH_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+
+
+def trajectory_lengths(n_trajs, mean_length, distribution='fixed',
+                       random=np.random):
+    """Draw the lengths of the trajectories
+
+    'fixed' makes them all `mean_length` frames long. 'uniform' draws them
+    from 1 to 2*mean_length, and 'lognormal' from a long-tailed
+    distribution with the given mean, which is what a project collected from
+    many independent simulations tends to look like.
+    """
+    if distribution == 'fixed':
+        lengths = np.repeat(mean_length, n_trajs)
+    elif distribution == 'uniform':
+        lengths = random.randint(1, 2 * mean_length + 1, n_trajs)
+    elif distribution == 'lognormal':
+        sigma = 1.0
+        mu = np.log(mean_length) - sigma**2 / 2
+        lengths = np.round(random.lognormal(mu, sigma, n_trajs))
+    else:
+        raise ValueError('distribution must be one of %s' %
+                         LENGTH_DISTRIBUTIONS)
+    return np.maximum(lengths, 1).astype(int)
+
+
+def chain_coordinates(n_atoms, random=np.random):
+    """Coordinates (in nm) of a compact chain: the atoms follow a serpentine
+    path through a cubic lattice, so consecutive atoms are bonded, with a bit
+    of noise so that no three atoms are exactly in line."""
+    side = int(np.ceil(n_atoms ** (1.0 / 3)))
+    xyz = []
+    for i in xrange(n_atoms):
+        z, rest = divmod(i, side * side)
+        y, x = divmod(rest, side)
+        # reverse every other row and layer
+        if y % 2 == 1:
+            x = side - 1 - x
+        if z % 2 == 1:
+            y = side - 1 - y
+        xyz.append((x, y, z))
+    xyz = BOND * np.array(xyz, dtype=np.float32)
+    return xyz + random.normal(0, BOND / 5, xyz.shape).astype(np.float32)
+
+
+def write_pdb(filename, xyz):
+    "Write a chain with the given coordinates (in nm) to a pdb file"
+    with open(filename, 'w') as f:
+        for i, (x, y, z) in enumerate(10 * xyz):
+            name = BACKBONE[i % len(BACKBONE)]
+            f.write('ATOM  %5d  %-3s ALA %5d    %8.3f%8.3f%8.3f  1.00  0.00\n'
+                    % (i + 1, name, i // len(BACKBONE) + 1, x, y, z))
+        f.write('TER\nENDMDL\n')
+
+
+def make_project(directory, n_trajs=10, mean_length=1000,
+                 distribution='fixed', n_atoms=100, n_gens=100,
+                 noise=0.05, seed=0):
+    """Write a synthetic project to `directory`
+
+    Parameters
+    ----------
+    directory : str
+        where to write the files. It's created if it doesn't exist
+    n_trajs : int
+    mean_length : int
+    distribution : {'fixed', 'uniform', 'lognormal'}
+        see trajectory_lengths
+    n_atoms : int
+        rounded up to a whole number of residues
+    n_gens : int
+        number of generators, picked at random from the frames
+    noise : float
+        standard deviation of the displacement of each atom, in nm
+    seed : int
+        seed for the random numbers, so a project can be made again
+
+    Returns
+    -------
+    project : msmbuilder.Project
+    gens_fn : str
+        path to the generators
+    """
+    random = np.random.RandomState(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    n_atoms = len(BACKBONE) * int(np.ceil(n_atoms / float(len(BACKBONE))))
+    conf_fn = os.path.join(directory, 'native.pdb')
+    write_pdb(conf_fn, chain_coordinates(n_atoms, random))
+    conf = Trajectory.LoadTrajectoryFile(conf_fn)
+    native = conf['XYZList'][0]
+
+    lengths = trajectory_lengths(n_trajs, mean_length, distribution, random)
+    gens_frames = set(random.permutation(np.sum(lengths))[:n_gens])
+    gens = []
+    offset = 0
+    for i, length in enumerate(lengths):
+        xyz = native + random.normal(0, noise, (length,) + native.shape)
+        xyz = xyz.astype(np.float32)
+        conf['XYZList'] = xyz
+        conf.SaveToLHDF(os.path.join(directory, 'trj%d.lh5' % i))
+        gens.extend(xyz[j - offset] for j in
+                    sorted(gens_frames.intersection(xrange(offset, offset + length))))
+        offset += length
+
+    gens_fn = os.path.join(directory, 'Gens.lh5')
+    conf['XYZList'] = np.array(gens, dtype=np.float32)
+    conf.SaveToLHDF(gens_fn)
+
+    project = Project({'NumTrajs': n_trajs,
+                       'TrajLengths': [int(e) for e in lengths],
+                       'TrajFileBaseName': 'trj', 'TrajFileType': '.lh5',
+                       'ConfFilename': conf_fn,
+                       'TrajFilePath': directory})
+    return project, gens_fn
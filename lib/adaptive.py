@@ -0,0 +1,178 @@
+"""
+Size the chunks from the measured throughput, instead of guessing
+
+With a fixed chunk_size, if the chunks are too small the overhead of each task
+(sending it to an engine, opening the files, sending the results back and
+saving them) dominates, and if they are too large there are fewer tasks than
+engines, or a few engines are still working on big chunks at the end of the
+run while the rest sit idle.
+
+An AdaptivePlan runs the assignment in two rounds. The first is a few small
+probe vtrajs of two different sizes for each engine, which are timed to
+estimate the time per frame and the overhead per task. The rest of the frames
+are then partitioned so that a task takes about `target_time` seconds, with
+the last ones made smaller so that the engines finish together (see
+local.partition).
+"""
+import time
+import numpy as np
+
+from msmbuilder.parallel_assign import local
+
+# the sizes of the probe vtrajs, in frames. each engine gets one of each
+PROBE_SIZES = (50, 200)
+
+# the smallest chunk is the one for which the overhead is this fraction of
+# the time of the task
+MAX_OVERHEAD = 0.1
+
+
+def fit_costs(n_frames, seconds):
+    """Fit seconds = overhead + n_frames * per_frame, by least squares
+
+    If the fit doesn't make sense (e.g. all of the samples have the same
+    number of frames), there's assumed to be no overhead.
+
+    Returns
+    -------
+    overhead : float
+    per_frame : float
+    """
+    n_frames = np.asarray(n_frames, dtype=float)
+    seconds = np.asarray(seconds, dtype=float)
+    if len(np.unique(n_frames)) > 1:
+        A = np.vstack([np.ones_like(n_frames), n_frames]).T
+        overhead, per_frame = np.linalg.lstsq(A, seconds)[0]
+        if overhead >= 0 and per_frame > 0:
+            return float(overhead), float(per_frame)
+    return 0.0, float(np.sum(seconds) / np.sum(n_frames))
+
+
+class AdaptivePlan(object):
+    """Decide how to partition a run from the timing of probe tasks
+
+    Parameters
+    ----------
+    project : msmbuilder.Project
+    completed : np.ndarray
+        the frames that are already completed (see local.completed_frames)
+    target_time : float
+        how long each task should take, in seconds
+    cost_model : local.CostModel, optional
+        passed on to local.partition
+    probe_sizes : tuple
+        sizes of the probe vtrajs, in frames
+
+    Attributes
+    ----------
+    overhead : float
+        estimated overhead of a task, in seconds
+    per_frame : float
+        estimated time to assign a frame, in seconds
+    chunk_size : int
+        the chunk size picked for the rest of the run
+
+    Examples
+    --------
+    >>> plan = AdaptivePlan(project, completed)
+    >>> for vtrajs in plan.rounds(n_engines):
+    ...     for assignments, distances, vtraj, stats in run(vtrajs):
+    ...         plan.observe(stats)
+    """
+    def __init__(self, project, completed, target_time=60.0, cost_model=None,
+                 probe_sizes=PROBE_SIZES):
+        self.project = project
+        self.completed = np.array(completed, dtype=bool)
+        self.target_time = target_time
+        self.cost_model = cost_model
+        self.probe_sizes = probe_sizes
+        self.overhead = None
+        self.per_frame = None
+        self.chunk_size = None
+
+        # (n_frames, task_time) of each observed task
+        self._samples = []
+        self._round_start = None
+        self._round_end = None
+
+    def observe(self, stats):
+        "Account for a completed task, given the stats it returned"
+        self._samples.append((stats['n_frames'], stats['task_time']))
+        self._round_end = time.time()
+
+    def rounds(self, n_engines):
+        """The vtrajs to run, as a list per round: the probes, and then, once
+        they've all been observed, the rest of the frames
+
+        Parameters
+        ----------
+        n_engines : int
+            number of engines that the vtrajs will be run on
+        """
+        probes = self.probes(n_engines)
+        if len(probes) > 0:
+            self._round_start = time.time()
+            yield probes
+            self.fit(n_engines)
+
+        vtrajs = self.partition(n_engines)
+        for vtraj in vtrajs:
+            vtraj.index += len(probes)
+        yield vtrajs
+
+    def probes(self, n_engines):
+        """Cut the probe vtrajs from the frames that are left, and consider
+        those frames completed"""
+        cost_model = self.cost_model or local.CostModel()
+        budgets = iter([cost_model.budget(size) for size in self.probe_sizes
+                        for _ in xrange(n_engines)])
+        traj_lengths = self.project['TrajLengths']
+        segments = local.missing_segments(traj_lengths, self.completed)
+        probes = list(local.cut_segments(self.project, segments, cost_model,
+                                         lambda remaining: next(budgets, None)))
+
+        offsets = local.traj_offsets(traj_lengths)
+        for i, vtraj in enumerate(probes):
+            vtraj.index = i
+            for traj, start, stop in vtraj:
+                self.completed[offsets[traj] + start:offsets[traj] + stop] = True
+        return probes
+
+    def fit(self, n_engines):
+        "Estimate the costs from the probes, and pick the chunk size"
+        n_frames, seconds = zip(*self._samples)
+        overhead, self.per_frame = fit_costs(n_frames, seconds)
+
+        # the time the engines spent between tasks is overhead too: sending
+        # the tasks and their results, and saving them
+        wall = self._round_end - self._round_start
+        busy = min(n_engines, len(seconds))
+        idle = max(0.0, busy * wall - sum(seconds))
+        self.overhead = overhead + idle / len(seconds)
+
+        if self.per_frame > 0:
+            self.chunk_size = int(max((self.target_time - self.overhead) /
+                                      self.per_frame, self.min_chunk_size(), 1))
+        else:
+            self.chunk_size = max(1, int(np.count_nonzero(~self.completed)))
+
+    def min_chunk_size(self):
+        """The smallest chunk worth sending to an engine, whose overhead is
+        MAX_OVERHEAD of its time"""
+        if self.per_frame is None or self.per_frame <= 0:
+            return 1
+        return max(1, int(np.ceil(self.overhead * (1 - MAX_OVERHEAD) /
+                                  (MAX_OVERHEAD * self.per_frame))))
+
+    def partition(self, n_engines):
+        """Partition the frames that are left, into chunks of chunk_size that
+        get smaller at the end, largest first"""
+        if not np.any(~self.completed):
+            return []
+        if self.chunk_size is None:
+            # nothing was probed, so there is nothing to go on
+            self.chunk_size = max(self.probe_sizes)
+        vtrajs = local.partition(self.project, self.chunk_size,
+                                 self.cost_model, self.completed, n_engines,
+                                 self.min_chunk_size())
+        return local.largest_first(vtrajs, self.cost_model)
@@ -0,0 +1,144 @@
+"""
+Collect results from the engines as they complete, without polling
+
+The IPython.parallel client only processes the replies from the engines when
+it's asked to (client.spin()), and the usual way to find out which tasks have
+completed, client.wait() and checking client.outstanding, does work
+proportional to the number of tasks that are still pending every time it's
+called. With tens of thousands of tasks that keeps a core on the master busy.
+
+Instead, the ResultCollector hooks into the client's reply handler, so that
+each completed task is pushed onto a queue as its reply is processed, and it
+sleeps on the client's sockets until a reply arrives. The work done by the
+master is then proportional to the number of replies, not the number of
+pending tasks.
+"""
+import time
+import collections
+
+# when the client has no sockets to wait on (e.g. a stand-in for testing),
+# how long to sleep between spins
+FALLBACK_SLEEP = 1e-3
+
+
+class ResultCollector(object):
+    """Iterate over the msg_ids of tasks, in the order in which they complete
+
+    Parameters
+    ----------
+    client : IPython.parallel.Client
+    poll_timeout : float
+        maximum time, in seconds, to sleep waiting for a reply before
+        spinning the client anyways
+
+    Examples
+    --------
+    >>> collector = ResultCollector(client)
+    >>> collector.watch(lview.map(f, jobs).msg_ids)
+    >>> for msg_id in collector:
+    ...     result = client.get_result(msg_id).result
+    """
+    def __init__(self, client, poll_timeout=1.0):
+        self.client = client
+        self.poll_timeout = poll_timeout
+        self._watched = set()
+        self._completed = collections.deque()
+        self._hook()
+        self._poller = self._make_poller()
+
+    def _hook(self):
+        """Wrap the client's handler for task replies so that it also tells us
+        about them.
+
+        Replies from the engines go through client._queue_handlers, and the
+        replies the client makes up when an engine dies go through
+        client._handle_apply_reply, so we replace both.
+        """
+        original = self.client._handle_apply_reply
+
+        def handle_apply_reply(msg):
+            original(msg)
+            msg_id = msg['parent_header']['msg_id']
+            if msg_id in self._watched:
+                self._watched.remove(msg_id)
+                self._completed.append(msg_id)
+
+        self.client._handle_apply_reply = handle_apply_reply
+        self.client._queue_handlers['apply_reply'] = handle_apply_reply
+
+    def _make_poller(self):
+        "zmq poller on the sockets that task replies arrive on"
+        sockets = [getattr(self.client, name, None)
+                   for name in ['_task_socket', '_mux_socket']]
+        sockets = [s for s in sockets if s is not None]
+        if len(sockets) == 0:
+            return None
+
+        import zmq
+        poller = zmq.Poller()
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
+        return poller
+
+    def watch(self, msg_ids):
+        "Start watching for these tasks to complete"
+        for msg_id in msg_ids:
+            if msg_id in self.client.results:
+                # already done
+                self._completed.append(msg_id)
+            else:
+                self._watched.add(msg_id)
+
+    def forget(self, msg_id):
+        "Stop watching for a task"
+        self._watched.discard(msg_id)
+
+    @property
+    def n_pending(self):
+        "Number of watched tasks that haven't been returned yet"
+        return len(self._watched) + len(self._completed)
+
+    def _wait(self, timeout):
+        "Sleep until there's something to read from the client's sockets"
+        if self._poller is None:
+            time.sleep(min(timeout, FALLBACK_SLEEP))
+        else:
+            self._poller.poll(1000 * timeout)
+
+    def next_completed(self, timeout=None):
+        """Get the msg_id of the next task to complete
+
+        Parameters
+        ----------
+        timeout : float, optional
+            maximum time to wait, in seconds
+
+        Returns
+        -------
+        msg_id : str or None
+            None if nothing completed before the timeout, or if there's
+            nothing being watched
+        """
+        start = time.time()
+        while not self._completed:
+            if not self._watched:
+                return None
+            self.client.spin()
+            if self._completed:
+                break
+
+            wait = self.poll_timeout
+            if timeout is not None:
+                wait = min(wait, start + timeout - time.time())
+                if wait <= 0:
+                    return None
+            self._wait(wait)
+
+        return self._completed.popleft()
+
+    def __iter__(self):
+        while True:
+            msg_id = self.next_completed()
+            if msg_id is None:
+                return
+            yield msg_id
@@ -0,0 +1,341 @@
+"""
+Keep the prepared frames on disk, to skip loading and preparing them again
+
+Every assignment reads and decodes the coordinates and runs
+metric.prepare_trajectory on them, and when the same trajectories are
+assigned again (to another set of generators, say) that all gives the same
+result as the last time. A FeatureCache stores the prepared frames in a
+directory, in the format of shared.cached, and the next time the same frames
+are assigned with the same metric they're memory-mapped from there instead,
+without opening the trajectory files at all.
+
+The frames are stored per slice of a trajectory (each chunk of a vtraj), and
+keyed on the identity (path, mtime and size) of the trajectory file, the
+conformation file and a fingerprint of the metric, so a changed file or a
+different metric gets new entries rather than stale features. Any slice that
+is covered by stored slices is found, so the frames don't have to be cut the
+same way as when they were stored -- e.g. a run that's resumed, adaptive, or
+appending to a project. Prepared frames that are arrays are sliced and
+concatenated as needed. Other prepared trajectories (like RMSD.TheoData) are
+sliced, but not concatenated, so they're only found for vtrajs whose frames
+all come from one stored slice.
+
+The total size of the entries is kept under a limit by removing the least
+recently used ones. Any number of processes can share a cache directory.
+"""
+import os
+import errno
+import fcntl
+import shutil
+import contextlib
+import numpy as np
+
+from msmbuilder.parallel_assign import shared
+
+# name prefix of the entries, so clear() knows what's ours
+PREFIX = 'msmb-features-'
+
+# default limit on the total size of the entries, in bytes
+MAX_BYTES = 10 * 1024 ** 3
+
+# when the cache is over its limit, entries are removed until it's under
+# this fraction of it, so that it's not over again with the next entry
+LOW_WATER = 0.9
+
+
+def _slice(prepared, start, stop):
+    """Frames start:stop of a prepared trajectory, or None if it can't be
+    sliced"""
+    if start == 0 and stop == len(prepared):
+        return prepared
+    try:
+        return prepared[start:stop]
+    except (TypeError, IndexError, KeyError, AttributeError):
+        return None
+
+
+def _join(parts):
+    """The prepared frames of the parts one after the other, or None if they
+    can't be joined"""
+    if len(parts) == 1:
+        return parts[0]
+    if all(isinstance(part, np.ndarray) for part in parts):
+        return np.concatenate(parts)
+    return None
+
+
+def _n_bytes(path):
+    "Size of the files of an entry"
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+class FeatureCache(object):
+    """Prepared frames on disk, by trajectory slice and metric
+
+    This is just the location and the size limit, so it's cheap to pickle and
+    send to the engines with the tasks. The directory is created the first
+    time it's used, on whichever machine uses it.
+
+    Parameters
+    ----------
+    directory : str
+        where to keep the entries
+    max_bytes : int
+        the most that the entries may take up. The least recently used ones
+        are removed to stay under it
+
+    Examples
+    --------
+    >>> features = FeatureCache('/scratch/features')
+    >>> ptraj = features.get(vtraj, fingerprint)
+    >>> if ptraj is None:
+    ...     ptraj = metric.prepare_trajectory(vtraj.load(conf))
+    ...     features.put(vtraj, fingerprint, ptraj)
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return 'FeatureCache(%r, max_bytes=%d)' % (self.directory,
+                                                   self.max_bytes)
+
+    def _traj_dir(self, project, traj, fingerprint):
+        """The directory of the slices of a trajectory, prepared with a
+        metric. Each slice in it is named start-stop"""
+        traj_key = shared.key(
+            shared.file_identity(project.GetTrajFilename(traj)),
+            shared.file_identity(project['ConfFilename']), fingerprint)
+        return os.path.join(self.directory, PREFIX + traj_key)
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """Hold the lock on the directory. Readers hold it shared, so that
+        an entry isn't removed while it's being opened"""
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(os.path.join(self.directory, PREFIX[:-1] + '.lock'),
+                  'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _cover(self, traj_dir, start, stop):
+        """The stored slices that together cover frames start:stop, as
+        (path, start, stop) of each, in order. None if they don't"""
+        exact = os.path.join(traj_dir, '%d-%d' % (start, stop))
+        if os.path.exists(exact):
+            return [(exact, start, stop)]
+        try:
+            names = os.listdir(traj_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        stored = sorted(tuple(int(e) for e in name.split('-'))
+                        for name in names)
+
+        pieces = []
+        position = start
+        while position < stop:
+            # the stored slice that starts at or before `position` and
+            # reaches the furthest past it
+            candidates = [e for e in stored if e[0] <= position < e[1]]
+            if not candidates:
+                return None
+            best = max(candidates, key=lambda e: e[1])
+            pieces.append((os.path.join(traj_dir, '%d-%d' % best),) + best)
+            position = best[1]
+        return pieces
+
+    def _get_chunk(self, project, traj, start, stop, fingerprint):
+        "Frames start:stop of a trajectory, or None"
+        pieces = self._cover(self._traj_dir(project, traj, fingerprint),
+                             start, stop)
+        if pieces is None:
+            return None
+        parts = []
+        for path, piece_start, piece_stop in pieces:
+            part = _slice(shared._load(path), max(start, piece_start) -
+                          piece_start, min(stop, piece_stop) - piece_start)
+            if part is None:
+                return None
+            parts.append(part)
+            # it's now the most recently used
+            os.utime(path, None)
+        return _join(parts)
+
+    def get(self, vtraj, fingerprint):
+        """The prepared frames of vtraj, from the cache
+
+        Parameters
+        ----------
+        vtraj : VTraj
+        fingerprint : str
+            the fingerprint of the metric (see shared.metric_fingerprint)
+
+        Returns
+        -------
+        prepared : np.ndarray or object
+            or None if they're not all in the cache. Frames that come from a
+            single stored slice are memory-mapped
+        """
+        parts = []
+        with self._locked(fcntl.LOCK_SH):
+            for traj, start, stop in vtraj.canonical():
+                part = self._get_chunk(vtraj.project, traj, start, stop,
+                                       fingerprint)
+                if part is None:
+                    return None
+                parts.append(part)
+        return _join(parts)
+
+    def put(self, vtraj, fingerprint, prepared):
+        """Store the prepared frames of vtraj, a slice per chunk, and then
+        remove the least recently used entries if the cache is over max_bytes
+
+        Parameters
+        ----------
+        vtraj : VTraj
+        fingerprint : str
+            the fingerprint of the metric
+        prepared : np.ndarray or object
+            what metric.prepare_trajectory returned for the frames
+        """
+        # write them somewhere else first, so that an entry that exists is
+        # always complete. (path, where it's written) of each
+        written = []
+        try:
+            with self._locked(fcntl.LOCK_SH):
+                offset = 0
+                for traj, start, stop in vtraj.canonical():
+                    end = offset + stop - start
+                    traj_dir = self._traj_dir(vtraj.project, traj, fingerprint)
+                    part = _slice(prepared, offset, end)
+                    offset = end
+                    if part is None or \
+                            self._cover(traj_dir, start, stop) is not None:
+                        continue
+                    path = os.path.join(traj_dir, '%d-%d' % (start, stop))
+                    tmp = '%s-%d-%d.tmp-%d' % (traj_dir, start, stop,
+                                               os.getpid())
+                    written.append((path, tmp))
+                    shared._dump(part, tmp)
+        except:
+            for _, tmp in written:
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        if not written:
+            return
+
+        with self._locked(fcntl.LOCK_EX):
+            n_bytes = 0
+            for path, tmp in written:
+                try:
+                    os.mkdir(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                try:
+                    size = _n_bytes(tmp)
+                    os.rename(tmp, path)
+                except OSError:
+                    # another process stored the same slice in the meantime,
+                    # or the cache was cleared
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    continue
+                n_bytes += size
+
+            total = self._total()
+            if total is None:
+                total = sum(size for _, size in self.entries())
+            else:
+                total += n_bytes
+            if total > self.max_bytes:
+                total = self._evict(LOW_WATER * self.max_bytes)
+            self._set_total(total)
+
+    def _total(self):
+        "The running total of the sizes of the entries, or None if not known"
+        try:
+            with open(os.path.join(self.directory,
+                                   PREFIX[:-1] + '.size')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def _set_total(self, total):
+        path = os.path.join(self.directory, PREFIX[:-1] + '.size')
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d' % total)
+        os.rename(path + '.tmp', path)
+
+    def entries(self):
+        """The entries in the cache, least recently used first
+
+        This looks at every entry, so it's only done when the cache is over
+        its limit.
+
+        Returns
+        -------
+        entries : list
+            (path, n_bytes) of each entry
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            if not name.startswith(PREFIX) or '.tmp-' in name:
+                continue
+            traj_dir = os.path.join(self.directory, name)
+            try:
+                for piece in os.listdir(traj_dir):
+                    path = os.path.join(traj_dir, piece)
+                    entries.append((os.stat(path).st_mtime, path,
+                                    _n_bytes(path)))
+            except OSError as e:
+                # removed since the listdir
+                if e.errno != errno.ENOENT:
+                    raise
+        entries.sort()
+        return [(path, n_bytes) for _, path, n_bytes in entries]
+
+    def _evict(self, max_bytes):
+        """Remove the least recently used entries until they take up at most
+        max_bytes. Returns the size of the ones that are left"""
+        entries = self.entries()
+        total = sum(n_bytes for _, n_bytes in entries)
+        for path, n_bytes in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= n_bytes
+            try:
+                # and the trajectory's directory, once it's empty
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        return total
+
+    def clear(self):
+        """Remove all of the entries. Processes that still have them mapped
+        keep working
+
+        Returns
+        -------
+        n_removed : int
+        """
+        with self._locked(fcntl.LOCK_EX):
+            n_removed = len(self.entries())
+            for name in os.listdir(self.directory):
+                if name.startswith(PREFIX):
+                    shutil.rmtree(os.path.join(self.directory, name),
+                                  ignore_errors=True)
+            self._set_total(0)
+        return n_removed
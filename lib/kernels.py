@@ -0,0 +1,313 @@
+"""
+Distance kernels that assign prepared frames to their nearest generator
+
+These execute on the workers, inside remote.assign. Each kernel takes the
+metric, the prepared trajectory and the prepared generators, and returns the
+index of the closest generator for every frame together with the distance to
+it.
+"""
+import numpy as np
+
+# default tile shape for the blocked kernel. a tile of
+# FRAME_BLOCK x GEN_BLOCK float64 distances is 8MB
+FRAME_BLOCK = 256
+GEN_BLOCK = 4096
+
+
+def exhaustive(metric, ptraj, pgens, n_frames):
+    """Assign each frame by computing its distance to every generator with
+    `metric.one_to_all`, one frame at a time.
+
+    This works for every metric, but for the vectorized metrics it's dominated
+    by python overhead.
+
+    Parameters
+    ----------
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    ptraj : prepared trajectory
+        the output of metric.prepare_trajectory on the frames to assign
+    pgens : prepared trajectory
+        the output of metric.prepare_trajectory on the generators
+    n_frames : int
+        number of frames in ptraj
+
+    Returns
+    -------
+    assignments : np.ndarray, dtype=int
+    distances : np.ndarray, dtype=float
+    """
+    distances = np.zeros(n_frames)
+    assignments = np.zeros(n_frames, dtype=int)
+
+    for i in xrange(n_frames):
+        d_o2a = metric.one_to_all(ptraj, pgens, i)
+        assignments[i] = np.argmin(d_o2a)
+        distances[i] = d_o2a[assignments[i]]
+
+    return assignments, distances
+
+
+def supports_blocks(metric, ptraj, pgens):
+    """Can `metric` compute frame-block x generator-block tiles?
+
+    This requires that the prepared trajectories are plain arrays (so that
+    they can be sliced into blocks) and that the metric has an `all_to_all`
+    method, which is the case for the vectorized metrics (dihedral, contact)
+    """
+    return isinstance(ptraj, np.ndarray) and isinstance(pgens, np.ndarray) \
+        and callable(getattr(metric, 'all_to_all', None))
+
+
+def blocked(metric, ptraj, pgens, n_frames, frame_block=FRAME_BLOCK,
+            gen_block=GEN_BLOCK):
+    """Assign frames by computing tiles of frame-block x generator-block
+    distances with `metric.all_to_all`, keeping only a running minimum and
+    argmin for each frame.
+
+    The memory required is bounded by the tile size, independent of the number
+    of frames or generators. The assignments are the same as those from
+    `exhaustive`, including the tie breaking (the lowest generator index wins).
+    If the metric can't compute tiles, this falls back to `exhaustive`.
+
+    Parameters
+    ----------
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    ptraj : prepared trajectory
+    pgens : prepared trajectory
+    n_frames : int
+        number of frames in ptraj
+    frame_block : int
+        number of frames per tile
+    gen_block : int
+        number of generators per tile
+
+    Returns
+    -------
+    assignments : np.ndarray, dtype=int
+    distances : np.ndarray, dtype=float
+    """
+    if not supports_blocks(metric, ptraj, pgens):
+        return exhaustive(metric, ptraj, pgens, n_frames)
+
+    n_gens = len(pgens)
+    distances = np.empty(n_frames)
+    distances.fill(np.inf)
+    assignments = np.zeros(n_frames, dtype=int)
+
+    for f_start in xrange(0, n_frames, frame_block):
+        f_stop = min(f_start + frame_block, n_frames)
+        rows = np.arange(f_stop - f_start)
+        # views, so the updates below go straight into the output
+        best_d = distances[f_start:f_stop]
+        best_a = assignments[f_start:f_stop]
+
+        for g_start in xrange(0, n_gens, gen_block):
+            g_stop = min(g_start + gen_block, n_gens)
+            try:
+                tile = metric.all_to_all(ptraj[f_start:f_stop],
+                                         pgens[g_start:g_stop])
+            except NotImplementedError:
+                return exhaustive(metric, ptraj, pgens, n_frames)
+
+            tile_a = np.argmin(tile, axis=1)
+            tile_d = tile[rows, tile_a]
+            # strict inequality so that on a tie the earlier block wins, just
+            # like np.argmin over the full row
+            better = tile_d < best_d
+            best_d[better] = tile_d[better]
+            best_a[better] = tile_a[better] + g_start
+
+    return assignments, distances
+
+
+# scipy.spatial.distance metrics, as used by msmbuilder.metrics.Vectorized,
+# that obey the triangle inequality
+TRUE_SCIPY_METRICS = ['euclidean', 'cityblock', 'chebyshev', 'canberra',
+                      'seuclidean', 'mahalanobis']
+
+# slack on the triangle inequality bound, so that roundoff in the distances
+# can never cause us to skip the true nearest generator
+PRUNE_RTOL = 1e-4
+PRUNE_ATOL = 1e-6
+
+
+def is_true_metric(metric):
+    """Does `metric` obey the triangle inequality?
+
+    This is true for RMSD and for the vectorized metrics (dihedral, contact)
+    with a true distance like euclidean or cityblock. Custom metrics can opt
+    in by setting an attribute `triangle_inequality = True`.
+    """
+    if getattr(metric, 'triangle_inequality', False):
+        return True
+
+    from msmbuilder import metrics
+    if isinstance(metric, metrics.RMSD):
+        return True
+    if isinstance(metric, metrics.Vectorized):
+        if metric.metric == 'minkowski':
+            return float(metric.p) >= 1
+        return metric.metric in TRUE_SCIPY_METRICS
+    return False
+
+
+def pairwise(metric, pgens, n_gens):
+    """Square matrix of the distances between every pair of generators
+
+    This is the input to `pruned`. It takes n_gens**2 float32s of memory.
+
+    Parameters
+    ----------
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    pgens : prepared trajectory
+    n_gens : int
+
+    Returns
+    -------
+    gens_distances : np.ndarray, shape=[n_gens, n_gens], dtype=np.float32
+    """
+    gens_distances = np.zeros((n_gens, n_gens), dtype=np.float32)
+    for i in xrange(n_gens):
+        gens_distances[i] = metric.one_to_all(pgens, pgens, i)
+    return gens_distances
+
+
+def pruned(metric, ptraj, pgens, n_frames, gens_distances, seed=0):
+    """Assign frames, using the triangle inequality to skip generators that
+    can't be the closest one.
+
+    For each frame x, we first compute the distance to a seed generator s,
+    which is the assignment of the previous frame (consecutive frames are
+    usually assigned to the same state). Any generator g with
+    d(s, g) > 2 d(x, s) is further from x than s is, because
+    d(x, g) >= d(s, g) - d(x, s) > d(x, s), so we only need to compute the
+    distance to the remaining generators.
+
+    This is only valid for metrics that obey the triangle inequality (see
+    `is_true_metric`), for which it gives the same assignments as
+    `exhaustive`.
+
+    Parameters
+    ----------
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    ptraj : prepared trajectory
+    pgens : prepared trajectory
+    n_frames : int
+        number of frames in ptraj
+    gens_distances : np.ndarray, shape=[n_gens, n_gens]
+        the distance between every pair of generators (see `pairwise`)
+    seed : int
+        the seed generator for the first frame, e.g. the assignment of the
+        frame before it
+
+    Returns
+    -------
+    assignments : np.ndarray, dtype=int
+    distances : np.ndarray, dtype=float
+    n_evaluated : int
+        number of frame-generator distances that were actually computed
+    """
+    distances = np.zeros(n_frames)
+    assignments = np.zeros(n_frames, dtype=int)
+    n_evaluated = 0
+
+    for i in xrange(n_frames):
+        d_seed = metric.one_to_many(ptraj, pgens, i, np.array([seed]))[0]
+        bound = 2 * d_seed * (1 + PRUNE_RTOL) + PRUNE_ATOL
+        # includes the seed itself, since its distance to itself is zero
+        candidates = np.where(gens_distances[seed] <= bound)[0]
+
+        others = candidates != seed
+        d_candidates = np.empty(len(candidates))
+        d_candidates[np.logical_not(others)] = d_seed
+        if np.any(others):
+            d_candidates[others] = metric.one_to_many(ptraj, pgens, i,
+                                                      candidates[others])
+        n_evaluated += 1 + np.count_nonzero(others)
+
+        # candidates are sorted, so on a tie the lowest index wins, just like
+        # in exhaustive
+        best = np.argmin(d_candidates)
+        assignments[i] = candidates[best]
+        distances[i] = d_candidates[best]
+        seed = assignments[i]
+
+    return assignments, distances, n_evaluated
+
+
+# the order p of the minkowski distance computed by each of the
+# scipy.spatial.distance metrics that a KD-tree can search exactly
+MINKOWSKI_SCIPY_METRICS = {'euclidean': 2, 'cityblock': 1,
+                           'chebyshev': np.inf}
+
+
+def minkowski_p(metric):
+    """If `metric` is the minkowski distance between its prepared frames,
+    the order p of that distance, and otherwise None
+
+    This is the case for the vectorized metrics (dihedral, contact) with
+    euclidean, cityblock, chebyshev or minkowski (p >= 1) distances. Custom
+    metrics can opt in by setting an attribute `minkowski_p`.
+    """
+    p = getattr(metric, 'minkowski_p', None)
+    if p is not None:
+        return p
+
+    from msmbuilder import metrics
+    if isinstance(metric, metrics.Vectorized):
+        if metric.metric == 'minkowski' and float(metric.p) >= 1:
+            return float(metric.p)
+        return MINKOWSKI_SCIPY_METRICS.get(metric.metric)
+    return None
+
+
+def build_index(metric, pgens):
+    """Build a nearest neighbor index over the generators, if the metric
+    allows it
+
+    The index is a KD-tree (scipy.spatial.cKDTree), which finds the nearest
+    generator to a frame without computing the distance to all of them. It's
+    exact, but only works for a minkowski distance between prepared frames
+    that are plain vectors (see minkowski_p). It pays off when there are many
+    generators and the vectors don't have too many dimensions -- in very high
+    dimensions, it ends up looking at most of the generators anyways.
+
+    Returns
+    -------
+    index : tuple or None
+        (tree, p), to pass to `indexed`, or None if the metric or the
+        generators don't qualify (then use `blocked`)
+    """
+    p = minkowski_p(metric)
+    if p is None or not isinstance(pgens, np.ndarray) or pgens.ndim != 2:
+        return None
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        return None
+    return cKDTree(pgens), p
+
+
+def indexed(index, ptraj, n_frames):
+    """Assign frames with a nearest neighbor index (see build_index)
+
+    The assignments are the same as those from `exhaustive`, except that on
+    an exact tie between two generators, either one may be picked.
+
+    Parameters
+    ----------
+    index : tuple
+        the output of build_index
+    ptraj : np.ndarray
+        the prepared frames
+    n_frames : int
+        number of frames in ptraj
+
+    Returns
+    -------
+    assignments : np.ndarray, dtype=int
+    distances : np.ndarray, dtype=float
+    """
+    tree, p = index
+    distances, assignments = tree.query(ptraj[:n_frames], k=1, p=p)
+    return assignments.astype(int), distances
@@ -1,60 +1,416 @@
 import os
+import sys
+import time
+import threading
+import Queue
+from hashlib import sha1
 import numpy as np
 import tables
 
-from msmbuilder.parallel_assign.vtraj import VTraj
-from msmbuilder import Serializer
+from msmbuilder.parallel_assign.vtraj import VTraj, VTrajPlan, PLAN_DTYPE
+from msmbuilder.parallel_assign.vtraj import _hash
+from msmbuilder import Trajectory
 
-def partition(project, chunk_size):
+class CostModel(object):
+    """Estimate of how long it takes to assign a vtraj
+    
+    The cost of a vtraj is the cost of computing the distances for each of its
+    frames, plus the cost of reading them, plus the cost of opening each of
+    the files it touches. Any units will do, as long as they're consistent;
+    measure_costs gives them in seconds.
+    
+    Parameters
+    ----------
+    frame_cost : float
+        cost of computing the distances from one frame to the generators
+    open_cost : float
+        cost of opening a trajectory file
+    read_cost : float
+        cost of reading one frame, for trajectories not in `read_costs`
+    read_costs : dict, optional
+        traj index -> cost of reading one frame from that trajectory, where
+        it's been measured
+    """
+    def __init__(self, frame_cost=1.0, open_cost=0.0, read_cost=0.0,
+                 read_costs=None):
+        self.frame_cost = frame_cost
+        self.open_cost = open_cost
+        self.read_cost = read_cost
+        self.read_costs = {} if read_costs is None else read_costs
+    
+    def __repr__(self):
+        return 'CostModel(frame_cost=%g, open_cost=%g, read_cost=%g)' % (
+            self.frame_cost, self.open_cost, self.read_cost)
+    
+    def per_frame(self, traj):
+        "cost of one frame of trajectory `traj`"
+        return self.frame_cost + self.read_costs.get(traj, self.read_cost)
+    
+    def cost(self, vtraj):
+        "estimated cost of assigning a vtraj"
+        return sum(self.open_cost + len(chunk) * self.per_frame(chunk.traj)
+                   for chunk in vtraj)
+    
+    def budget(self, chunk_size):
+        """the cost of a typical vtraj of chunk_size frames from a single
+        trajectory, which is the target cost of each vtraj in partition()"""
+        return self.open_cost + chunk_size * (self.frame_cost + self.read_cost)
+
+
+def measure_costs(project, gens_fn, metric, n_samples=8, n_frames=32):
+    """Measure a CostModel, in seconds, by assigning a few samples of frames
+    in this process
+    
+    For each of `n_samples` trajectories, spread evenly over the project, two
+    consecutive blocks of up to `n_frames` frames are assigned with
+    remote.assign. The file is opened for the first block, and already open
+    for the second, so the difference in I/O time is the cost of the open.
+    
+    Returns
+    -------
+    cost_model : CostModel
+    """
+    from msmbuilder.parallel_assign import remote
+    
+    traj_lengths = project['TrajLengths']
+    n_samples = min(n_samples, len(traj_lengths))
+    samples = np.unique(np.linspace(0, len(traj_lengths) - 1,
+                                    n_samples).astype(int))
+    
+    # prepare the generators before starting the clock
+    remote.load_gens(gens_fn, project['ConfFilename'], metric)
+    
+    frame_costs, open_costs, read_costs = [], [], {}
+    for i in samples:
+        n = min(n_frames, traj_lengths[i])
+        first = VTraj(project, (i, 0, n))
+        stats0 = remote.assign(first, gens_fn, metric)[3]
+        frame_costs.append(stats0['compute_time'] / n)
+        
+        m = min(n_frames, traj_lengths[i] - n)
+        if m > 0:
+            second = VTraj(project, (i, n, n + m))
+            stats1 = remote.assign(second, gens_fn, metric)[3]
+            read_costs[i] = stats1['io_time'] / m
+            open_costs.append(max(0.0, stats0['io_time'] - n * read_costs[i]))
+        else:
+            read_costs[i] = stats0['io_time'] / n
+    
+    read_cost = float(np.median(read_costs.values()))
+    open_cost = float(np.median(open_costs)) if open_costs else 0.0
+    return CostModel(float(np.median(frame_costs)), open_cost, read_cost,
+                     read_costs)
+
+
+def largest_first(vtrajs, cost_model=None):
+    """Order vtrajs by decreasing cost, so that when they're handed out to
+    the engines in this order, the small ones fill in at the end and the
+    engines finish at about the same time
+    
+    Parameters
+    ----------
+    vtrajs : list
+    cost_model : CostModel, optional
+        defaults to the number of frames in each vtraj
+    """
+    if cost_model is None and isinstance(vtrajs, VTrajPlan):
+        # a stable sort, like sorted()
+        order = np.argsort(-vtrajs.lengths(), kind='mergesort')
+        return [vtrajs[i] for i in order]
+    if cost_model is None:
+        cost = len
+    else:
+        cost = cost_model.cost
+    return sorted(vtrajs, key=cost, reverse=True)
+
+
+def _segments(traj_lengths, completed=None):
+    """missing_segments, as arrays of the traj, start and stop of each run"""
+    traj_lengths = np.asarray(traj_lengths, dtype=np.int64)
+    if completed is None:
+        return (np.arange(len(traj_lengths)), np.zeros_like(traj_lengths),
+                traj_lengths.copy())
+    
+    offsets = traj_offsets(traj_lengths)
+    if len(completed) != offsets[-1]:
+        raise ValueError('completed has the wrong number of frames')
+    
+    # a run of missing frames starts where the previous frame is completed
+    # or in another trajectory, and stops likewise
+    missing = ~np.asarray(completed, dtype=np.bool)
+    nonempty = traj_lengths > 0
+    first = np.ones(len(missing), dtype=np.bool)
+    first[1:] = ~missing[:-1]
+    first[offsets[:-1][nonempty]] = True
+    last = np.ones(len(missing), dtype=np.bool)
+    last[:-1] = ~missing[1:]
+    last[offsets[1:][nonempty] - 1] = True
+    
+    starts, = np.where(missing & first)
+    stops, = np.where(missing & last)
+    traj = np.searchsorted(offsets, starts, side='right') - 1
+    return traj, starts - offsets[traj], stops + 1 - offsets[traj]
+
+
+def missing_segments(traj_lengths, completed=None):
+    """The runs of frames that still have to be assigned
+    
+    Parameters
+    ----------
+    traj_lengths : list
+        length of each trajectory
+    completed : np.ndarray, optional
+        one bool per frame of the concatenated trajectories (see
+        completed_frames). Defaults to nothing being completed
+    
+    Returns
+    -------
+    segments : list
+        (traj, start, stop) tuples, in order
+    """
+    traj, start, stop = _segments(traj_lengths, completed)
+    return zip(traj.tolist(), start.tolist(), stop.tolist())
+
+
+def _cut_rows(segments, cost_model, budget):
+    """The greedy cutting of cut_segments, as (vtraj, traj, start, stop)
+    rows of a plan"""
+    remaining = sum((stop - start) * cost_model.per_frame(i)
+                    for i, start, stop in segments)
+    target = budget(remaining)
+    if target is None:
+        return
+    
+    n_vtrajs, last_frames, last_cost = 0, 0, 0.0
+    for i, start, end in segments:
+        per_frame = cost_model.per_frame(i)
+        while start < end:
+            room = target - last_cost - cost_model.open_cost
+            n = int(room // per_frame) if per_frame > 0 else end - start
+            if n < 1 and last_frames > 0:
+                n_vtrajs += 1
+                target = budget(remaining)
+                if target is None:
+                    return
+                last_frames, last_cost = 0, 0.0
+                continue
+            stop = min(end, start + max(n, 1))
+            yield (n_vtrajs, i, start, stop)
+            last_frames += stop - start
+            last_cost += cost_model.open_cost + (stop - start) * per_frame
+            remaining -= (stop - start) * per_frame
+            start = stop
+
+
+def cut_segments(project, segments, cost_model, budget):
+    """Cut runs of frames into vtrajs, greedily, in order
+    
+    Parameters
+    ----------
+    segments : list
+        (traj, start, stop) runs of frames (see missing_segments)
+    cost_model : CostModel
+    budget : callable
+        budget(remaining) is the target cost of the next vtraj, given the cost
+        of the frames that haven't been cut yet, or None to stop cutting
+    
+    Yields
+    ------
+    vtraj : VTraj
+    """
+    rows = np.array(list(_cut_rows(segments, cost_model, budget)),
+                    dtype=PLAN_DTYPE)
+    for vtraj in VTrajPlan(project, rows):
+        yield vtraj
+
+
+def _cut_uniform(traj, start, stop, chunk_size, n_engines=None,
+                 min_chunk_size=1):
+    """The cutting of partition, vectorized, for when every frame costs the
+    same and opening a file is free
+    
+    Then the greedy cutting comes down to concatenating the runs of frames,
+    and cutting them every chunk_size frames, or with n_engines, into vtrajs
+    of min(chunk_size, max(min_chunk_size, remaining / (2*n_engines))) frames,
+    where remaining is the number of frames that are left to cut.
+    
+    Returns
+    -------
+    rows : np.ndarray, dtype=PLAN_DTYPE
+    """
+    lengths = stop - start
+    # the position in the concatenation where each run ends
+    ends = np.cumsum(lengths)
+    total = int(ends[-1]) if len(ends) > 0 else 0
+    
+    if n_engines is None:
+        cuts = np.arange(0, total, chunk_size, dtype=np.int64)
+    else:
+        # the vtrajs are full size while the frames left are at least
+        # 2*n_engines*chunk_size, and the few after that are cut one by one
+        n_full = 0
+        if total >= 2 * n_engines * chunk_size:
+            n_full = (total - 2 * n_engines * chunk_size) // chunk_size + 1
+        smallest = min(min_chunk_size, chunk_size)
+        position = n_full * chunk_size
+        tail = []
+        while position < total:
+            tail.append(position)
+            position += max(1, int(min(chunk_size, max(smallest,
+                (total - position) / (2.0 * n_engines)))))
+        cuts = np.concatenate([np.arange(0, n_full * chunk_size, chunk_size),
+                               tail]).astype(np.int64)
+    
+    # a row for each piece between a cut and the end of a run. both are
+    # sorted already, which the merge sort takes advantage of
+    edges = np.concatenate([cuts, ends])
+    edges.sort(kind='mergesort')
+    edges = np.concatenate([[0], edges[1:][edges[1:] != edges[:-1]]])
+    piece_start, piece_stop = edges[:-1], edges[1:]
+    run = np.searchsorted(ends, piece_start, side='right')
+    
+    rows = np.empty(len(piece_start), dtype=PLAN_DTYPE)
+    rows['vtraj'] = np.searchsorted(cuts, piece_start, side='right') - 1
+    rows['traj'] = traj[run]
+    rows['start'] = start[run] + piece_start - (ends[run] - lengths[run])
+    rows['stop'] = rows['start'] + piece_stop - piece_start
+    return rows
+
+
+def partition(project, chunk_size, cost_model=None, completed=None,
+              n_engines=None, min_chunk_size=1):
     """Partition the frames in a project into a list of virtual trajectories
     (VTraj) of length <= chunk_size
     
+    If a cost_model is given, the vtraj are instead cut so that each costs
+    about as much as chunk_size frames from a single trajectory (see
+    CostModel.budget). A vtraj which spans many short trajectories then gets
+    fewer frames, to make up for the files it has to open, and one made of
+    cheap frames gets more.
+    
+    If `completed` is given (see completed_frames), only the frames that
+    aren't completed are partitioned. This is how a run is resumed, and it
+    doesn't matter how the completed frames were partitioned.
+    
+    If `n_engines` is given, the last vtrajs are made smaller, so that the
+    engines run out of work at about the same time (guided self-scheduling):
+    none costs more than 1/(2*n_engines) of the frames that were left to
+    partition when it was cut, down to min_chunk_size frames. Hand them out with largest_first.
+    
+    The partition is computed with vectorized operations when every frame
+    costs the same and opening a file is free (as with the default cost
+    model), so it's fast even for projects of millions of trajectories.
+    
     Returns
     -------
-    vtrajs : list
-        list of VTrajs
+    vtrajs : VTrajPlan
+        a sequence of VTrajs. vtrajs[i].index == i
     """
-    traj_lengths = project['TrajLengths']
+    traj_lengths = np.asarray(project['TrajLengths'])
     
-    if not all(int(e) == e for e in traj_lengths):
+    if not np.all(traj_lengths.astype(np.int64) == traj_lengths):
         raise ValueError('must me ints')
-    if not all(e > 0 for e in traj_lengths):
+    if not np.all(traj_lengths > 0):
         raise ValueError('must be >0')
+    if cost_model is None:
+        # with the default costs, a vtraj is cut after chunk_size frames
+        cost_model = CostModel()
     
-    def generate():
-        "generator for the sections"
-        last = VTraj(project)
-        for i in xrange(0, len(traj_lengths)):
-            end = 0
-            if len(last) != 0:
-                end = chunk_size - len(last)
-                if  end < traj_lengths[i]:
-                    last.append((i, 0, end))
-                    yield last
-                    last = VTraj(project)
-                else:
-                    end = traj_lengths[i]
-                    last.append((i, 0, end))
-                    
-            for j in xrange(end, traj_lengths[i], chunk_size):
-                if j + chunk_size <= traj_lengths[i]:
-                    yield VTraj(project, (i, j, j + chunk_size))
-                    last = VTraj(project)
-                else:
-                    last.append((i, j, traj_lengths[i]))
-                
-        if len(last) > 0:
-            yield last
-            
-    all_vtrajs = list(generate())
+    traj, start, stop = _segments(traj_lengths, completed)
+    
+    if cost_model.open_cost == 0 and not cost_model.read_costs and \
+            cost_model.frame_cost + cost_model.read_cost > 0:
+        rows = _cut_uniform(traj, start, stop, chunk_size, n_engines,
+                            min_chunk_size)
+    else:
+        full = cost_model.budget(chunk_size)
+        if n_engines is None:
+            budget = lambda remaining: full
+        else:
+            smallest = cost_model.budget(min(min_chunk_size, chunk_size))
+            budget = lambda remaining: min(full, max(smallest,
+                remaining / (2.0 * n_engines)))
+        segments = zip(traj.tolist(), start.tolist(), stop.tolist())
+        rows = np.array(list(_cut_rows(segments, cost_model, budget)),
+                        dtype=PLAN_DTYPE)
     
-    if sum(len(vt) for vt in all_vtrajs) != np.sum(project['TrajLengths']):
+    if np.sum(rows['stop'] - rows['start']) != np.sum(stop - start):
         raise ValueError('Chunking error. Lengths dont match')
-        
-    return all_vtrajs
+    
+    # each vtraj carries its index, so that results can be logged without
+    # looking it up
+    return VTrajPlan(project, rows)
+
+
+def generator_hashes(gens_fn):
+    """Identify each of the generators in a file by a hash of its coordinates
+    
+    Returns
+    -------
+    hashes : list
+        one sha1 hash per generator
+    """
+    xyzlist = Trajectory.LoadTrajectoryFile(gens_fn)['XYZList']
+    return [sha1(frame.tostring()).hexdigest() for frame in xyzlist]
+
+
+# compression for the output containers. Unwritten chunks of Data aren't
+# stored at all, they read back as the fill value (-1)
+FILTERS = tables.Filters(complevel=5, complib='blosc', shuffle=True)
+
+LAYOUTS = ['dense', 'ragged']
+
+
+def traj_offsets(traj_lengths):
+    """Offset of each trajectory in the concatenation of all of them, plus
+    the total number of frames at the end"""
+    return np.concatenate([[0], np.cumsum(traj_lengths)]).astype(np.int64)
+
+
+def _create_container(filename, atom, traj_lengths, layout, chunk_frames,
+                      bitmap, gens_hashes=None):
+    """Write an empty container, with a fill value of -1
+    
+    Parameters
+    ----------
+    filename : str
+    atom : tables.Atom
+        the type of the Data
+    traj_lengths : np.ndarray
+    layout : {'dense', 'ragged'}
+    chunk_frames : int
+        number of frames per chunk of the Data
+    bitmap : bool
+        create the completed_frames bitmap, with no frames completed
+    gens_hashes : list, optional
+        hashes of the generators, to record in the container
+    """
+    n_trajs = len(traj_lengths)
+    max_n_frames = int(np.max(traj_lengths))
+    offsets = traj_offsets(traj_lengths)
+    
+    f = tables.openFile(filename, mode='w')
+    try:
+        if layout == 'dense':
+            f.createCArray(f.root, 'Data', atom, (n_trajs, max_n_frames),
+                           filters=FILTERS, chunkshape=(1, chunk_frames))
+        else:
+            f.createCArray(f.root, 'Data', atom, (int(offsets[-1]),),
+                           filters=FILTERS, chunkshape=(chunk_frames,))
+            f.createArray(f.root, 'offsets', offsets)
+        f.createArray(f.root, 'traj_lengths', traj_lengths)
+        if bitmap:
+            n_bytes = (int(offsets[-1]) + 7) // 8
+            f.createArray(f.root, 'completed_frames',
+                          np.zeros(n_bytes, dtype=np.uint8))
+        if gens_hashes is not None:
+            f.createArray(f.root, 'gens_hashes', np.array(gens_hashes))
+    finally:
+        f.close()
 
 
-def setup_containers(outputdir, project, all_vtrajs):
+def setup_containers(outputdir, project, all_vtrajs, gens_hashes=None,
+                     layout='dense', extend=False, chunk_size=None):
     """
     Setup the files on disk (Assignments.h5 and Assignments.h5.distances) that
     results will be sent to.
@@ -62,6 +418,21 @@ def setup_containers(outputdir, project, all_vtrajs):
     Check to ensure that if they exist (and contain partial results), the
     containers are not corrupted
     
+    The Data in the containers is stored in chunked, compressed arrays which
+    are created empty, with a fill value of -1, so nothing is allocated or
+    written for padding. Assignments are stored as int32 and distances as
+    float32. With the 'dense' layout, Data has shape (n_trajs, max_n_frames),
+    just like the legacy format. With the 'ragged' layout, Data is the
+    concatenation of all the trajectories, and trajectory i is
+    Data[offsets[i]:offsets[i+1]] (see export_dense to convert it).
+    
+    Which frames have been completed is kept in the assignments file as a
+    bitmap, with one bit per frame of the concatenated trajectories (see
+    completed_frames). Unlike the list of completed vtrajs that it replaces,
+    it doesn't depend on how the frames were partitioned, so a run can be
+    resumed with a different chunk size. Containers with a list of completed
+    vtrajs are converted, if chunk_size is the one they were made with.
+    
     Parameters
     ----------
     outputdir : str
@@ -69,9 +440,24 @@ def setup_containers(outputdir, project, all_vtrajs):
     project : msmbuilder.Project
         The msmbuilder project file. Only the NumTrajs and TrajLengths are
         actully used (if you want to spoof it, you can just pass a dict)
-    all_vtrajs : list
-        The VTrajs are used to check that the containers on disk, if they
-        exist, contain the right stuff
+    all_vtrajs : VTrajPlan or list
+        The VTrajs that the frames are partitioned into. The chunks of Data
+        are aligned with them
+    gens_hashes : list, optional
+        The hashes of the generators (see generator_hashes). If supplied, they
+        are recorded in new containers, so that later runs can detect which
+        generators have been added.
+    layout : {'dense', 'ragged'}
+        how to lay out the Data in new containers
+    extend : bool
+        if the project has grown since the containers were made (new
+        trajectories, or longer ones), extend them to cover it (see
+        extend_container) instead of raising an error. Only the new frames
+        are then not completed.
+    chunk_size : int, optional
+        the chunk_size that all_vtrajs was partitioned with. Only used to
+        convert containers with a list of completed vtrajs, which were
+        partitioned with it. Defaults to the length of the longest vtraj
         
     Returns
     -------
@@ -80,44 +466,59 @@ def setup_containers(outputdir, project, all_vtrajs):
     f_distances : tables.File
         pytables handle to the assignments file, open in 'append' mode    
     """
+    if layout not in LAYOUTS:
+        raise ValueError('layout must be one of %s' % LAYOUTS)
     if not os.path.exists(outputdir):
         os.mkdir(outputdir)
     
     assignments_fn = os.path.join(outputdir, 'Assignments.h5')
     distances_fn = os.path.join(outputdir, 'Assignments.h5.distances')
     
-    n_trajs = project['NumTrajs']
-    max_n_frames = np.max(project['TrajLengths'])
-    n_vtrajs = len(all_vtrajs)
-    hashes = [c.hash() for c in all_vtrajs]
-    
-    minus_ones = -1 * np.ones((n_trajs, max_n_frames))
+    traj_lengths = np.asarray(project['TrajLengths'], dtype=np.int64)
+    if len(traj_lengths) != project['NumTrajs']:
+        raise ValueError('NumTrajs does not match TrajLengths')
+    max_n_frames = int(np.max(traj_lengths))
     
-    def save_container(filename, dtype):
-        s = Serializer({'Data': np.array(minus_ones, dtype=dtype),
-                        'completed_vtrajs': np.zeros((n_vtrajs), dtype=np.bool),
-                        'hashes': hashes})
-        s.SaveToHDF(filename)
+    # align the chunks with the writes, which are (at most) a vtraj long
+    plan = VTrajPlan.from_vtrajs(project, all_vtrajs)
+    chunk_frames = int(min(max_n_frames, np.max(plan.lengths())))
     
     def check_container(filename):
-        ondisk = Serializer.LoadFromHDF(filename)
-        if n_vtrajs != len(ondisk['hashes']):
-            raise ValueError('You asked for {} vtrajs, but your checkpoint \
-file has {}'.format(n_vtrajs, len(ondisk['hashes'])))
-        if not np.all(ondisk['hashes'] ==
-                hashes):
-            raise ValueError('Hash mismatch. Are these checkpoint files for \
-the right project?')
+        f = tables.openFile(filename, mode='r')
+        try:
+            if 'traj_lengths' in f.root:
+                ondisk_lengths = f.root.traj_lengths[:]
+            else:
+                ondisk_lengths = None
+            ondisk_layout = 'dense' if f.root.Data.ndim == 2 else 'ragged'
+        finally:
+            f.close()
+        if ondisk_layout != layout:
+            raise ValueError('Your checkpoint file has the {} layout, but you \
+asked for {}'.format(ondisk_layout, layout))
+        if ondisk_lengths is not None and not (
+                len(ondisk_lengths) == len(traj_lengths) and
+                np.all(ondisk_lengths == traj_lengths)):
+            if extend:
+                extend_container(filename, traj_lengths)
+            else:
+                raise ValueError('Trajectory length mismatch. Are these \
+checkpoint files for the right project? (Use append mode if trajectories \
+were added to it or extended)')
         
     
     # save assignments container
     if (not os.path.exists(assignments_fn)) \
             and (not os.path.exists(distances_fn)):
-        save_container(assignments_fn, np.int)
-        save_container(distances_fn, np.float32)
+        _create_container(assignments_fn, tables.Int32Atom(dflt=-1),
+                          traj_lengths, layout, chunk_frames, True, gens_hashes)
+        _create_container(distances_fn, tables.Float32Atom(dflt=-1),
+                          traj_lengths, layout, chunk_frames, False, gens_hashes)
     elif os.path.exists(assignments_fn) and os.path.exists(distances_fn):
-        check_container(assignments_fn)
+        # the distances first: the assignments hold the completed frames, so
+        # if we're interrupted between the two, the extension is redone
         check_container(distances_fn)
+        check_container(assignments_fn)
     else:
         raise ValueError("You're missing one of the containers")
     
@@ -125,13 +526,575 @@ the right project?')
     f_assignments = tables.openFile(assignments_fn, mode='a')
     f_distances = tables.openFile(distances_fn, mode='a')
     
+    if 'completed_frames' not in f_assignments.root:
+        if chunk_size is None:
+            chunk_size = int(np.max(plan.lengths()))
+        _convert_completed_vtrajs(f_assignments, traj_lengths, chunk_size)
+    if 'completed_vtrajs' in f_distances.root:
+        # the old distances have their own copy of the list, which isn't
+        # used, and no lengths, which extend_container needs
+        f_distances.removeNode(f_distances.root, 'completed_vtrajs')
+        f_distances.removeNode(f_distances.root, 'hashes')
+        if 'traj_lengths' not in f_distances.root:
+            f_distances.createArray(f_distances.root, 'traj_lengths',
+                                    traj_lengths)
+        f_distances.flush()
+    
     return f_assignments, f_distances
+
+
+def _legacy_partition(traj_lengths, chunk_size):
+    """The chunks of each vtraj, as partition cut them before the completion
+    bitmap. The hashes of these are what the old containers recorded.
+    
+    Unlike partition now, this ends a vtraj that was exactly full with an
+    empty chunk of the next trajectory, e.g. lengths [2, 1, 10] with a
+    chunk_size of 3 give [(0, 0, 2), (1, 0, 1), (2, 0, 0)], [(2, 0, 3)], ...
+    
+    Returns
+    -------
+    vtrajs : list
+        list of (traj, start, stop) tuples for each vtraj
+    """
+    vtrajs = []
+    last = []
+    for i, length in enumerate(traj_lengths):
+        end = 0
+        if len(last) != 0:
+            end = chunk_size - sum(stop - start for _, start, stop in last)
+            if end < length:
+                last.append((i, 0, end))
+                vtrajs.append(last)
+                last = []
+            else:
+                end = length
+                last.append((i, 0, end))
+        for j in xrange(end, length, chunk_size):
+            if j + chunk_size <= length:
+                vtrajs.append([(i, j, j + chunk_size)])
+                last = []
+            else:
+                last.append((i, j, length))
+    if sum(stop - start for _, start, stop in last) > 0:
+        vtrajs.append(last)
+    return vtrajs
+
+
+def _convert_completed_vtrajs(f_assignments, traj_lengths, chunk_size):
+    """Replace the list of completed vtrajs in containers from before the
+    completion bitmap with the bitmap"""
+    root = f_assignments.root
+    vtrajs = _legacy_partition(traj_lengths.tolist(), chunk_size)
+    hashes = [_hash(chunks) for chunks in vtrajs]
+    if len(root.hashes) != len(hashes) or \
+            not np.all(root.hashes[:] == np.array(hashes)):
+        raise ValueError('Hash mismatch. These checkpoint files record which \
+vtrajs were completed, so to resume them you need to use the same chunk_size \
+as before (once).')
+    
+    # +1 where each completed chunk starts and -1 where it stops, so frames
+    # are completed where the running sum is positive. the chunks don't
+    # overlap, so they all start (and stop) at different frames, except for
+    # the empty ones, which cancel out
+    offsets = traj_offsets(traj_lengths)
+    done = np.array([chunk for chunks, completed in
+                     zip(vtrajs, root.completed_vtrajs[:]) if completed
+                     for chunk in chunks],
+                    dtype=[('traj', np.int64), ('start', np.int64),
+                           ('stop', np.int64)]).reshape(-1)
+    n_frames = int(offsets[-1])
+    edges = np.bincount(offsets[done['traj']] + done['start'],
+                        minlength=n_frames + 1) - \
+        np.bincount(offsets[done['traj']] + done['stop'],
+                    minlength=n_frames + 1)
+    completed = np.cumsum(edges[:n_frames]) > 0
     
+    f_assignments.createArray(root, 'completed_frames', np.packbits(completed))
+    if 'traj_lengths' not in root:
+        f_assignments.createArray(root, 'traj_lengths', traj_lengths)
+    f_assignments.removeNode(root, 'completed_vtrajs')
+    f_assignments.removeNode(root, 'hashes')
+    f_assignments.flush()
+
 
-def save(f_assignments, f_distances, assignments, distances, vtraj):
+def extend_container(filename, traj_lengths, block_frames=2**20):
+    """Extend a container to trajectories that were added to the project, or
+    that got longer
+    
+    The Data can't be resized in place, so the container is rewritten to a
+    temporary file with the new shape, the existing results are copied over
+    (which is cheap compared to computing them) and it's then renamed over
+    the original. The new frames read back as -1 and aren't completed.
+    
+    Parameters
+    ----------
+    filename : str
+        path to the container
+    traj_lengths : np.ndarray
+        the new length of each trajectory. Trajectories can only be added at
+        the end, and can't get shorter
+    block_frames : int
+        maximum number of frames to copy at a time
+    """
+    source = tables.openFile(filename, mode='r')
+    try:
+        root = source.root
+        if 'traj_lengths' not in root:
+            raise ValueError("This container doesn't record the lengths of \
+the trajectories, so it can't be extended")
+        if 'completed_vtrajs' in root:
+            raise ValueError('This container is in the old checkpoint format. \
+Resume it with the original project once to convert it, before extending it')
+        if getattr(root._v_attrs, 'incremental_from', None) is not None:
+            raise ValueError('This container is in the middle of an \
+incremental assignment. Finish it before extending it')
+        
+        old_lengths = root.traj_lengths[:]
+        if len(traj_lengths) < len(old_lengths) or \
+                np.any(traj_lengths[:len(old_lengths)] < old_lengths):
+            raise ValueError('Trajectory length mismatch. Trajectories can \
+only be added or extended, not removed or shortened.')
+        
+        data = root.Data
+        layout = 'dense' if data.ndim == 2 else 'ragged'
+        gens_hashes = root.gens_hashes[:] if 'gens_hashes' in root else None
+        bitmap = 'completed_frames' in root
+        
+        old_offsets = traj_offsets(old_lengths)
+        new_offsets = traj_offsets(traj_lengths)
+        tmp_fn = filename + '.extending'
+        # containers converted from the old format were written with a fill
+        # value of 0, which would read as state 0 at distance 0
+        atom = tables.Atom.from_dtype(data.atom.dtype, dflt=-1)
+        if data.chunkshape is not None:
+            chunk_frames = data.chunkshape[-1]
+        else:
+            chunk_frames = int(min(np.max(traj_lengths), 2**14))
+        _create_container(tmp_fn, atom, traj_lengths, layout, chunk_frames,
+                          bitmap, gens_hashes)
+        
+        dest = tables.openFile(tmp_fn, mode='a')
+        try:
+            out = dest.root.Data
+            for i, length in enumerate(old_lengths):
+                for start in xrange(0, int(length), block_frames):
+                    stop = min(length, start + block_frames)
+                    if layout == 'dense':
+                        out[i, start:stop] = data[i, start:stop]
+                    else:
+                        out[new_offsets[i] + start:new_offsets[i] + stop] = \
+                            data[old_offsets[i] + start:old_offsets[i] + stop]
+            
+            if bitmap:
+                old_bits = np.unpackbits(root.completed_frames[:])
+                bits = np.zeros(int(new_offsets[-1]), dtype=np.uint8)
+                for i in xrange(len(old_lengths)):
+                    bits[new_offsets[i]:new_offsets[i] + old_lengths[i]] = \
+                        old_bits[old_offsets[i]:old_offsets[i+1]]
+                dest.root.completed_frames[:] = np.packbits(bits)
+        finally:
+            dest.close()
+    finally:
+        source.close()
+    
+    os.rename(tmp_fn, filename)
+
+
+def completed_frames(f_assignments):
+    """Which frames have been assigned
+    
+    Returns
+    -------
+    completed : np.ndarray, dtype=bool
+        one entry per frame of the concatenated trajectories
+    """
+    n_frames = int(np.sum(f_assignments.root.traj_lengths[:]))
+    bits = np.unpackbits(f_assignments.root.completed_frames[:])
+    return bits[:n_frames].astype(np.bool)
+
+
+def mark_completed(f_assignments, runs):
+    """Mark runs of frames as completed in the bitmap
+    
+    Parameters
+    ----------
+    f_assignments : tables.File
+    runs : list
+        (start, stop) ranges, in the concatenated trajectories
+    """
+    bitmap = f_assignments.root.completed_frames
+    for start, stop in runs:
+        # the bytes that the run touches. the bits at either end that are
+        # outside of the run are left as they are
+        lo, hi = start // 8, (stop + 7) // 8
+        bits = np.unpackbits(bitmap[lo:hi])
+        bits[start - 8 * lo:stop - 8 * lo] = 1
+        bitmap[lo:hi] = np.packbits(bits)
+
+
+def clear_completed(f_assignments):
+    "Mark all of the frames as not completed"
+    f_assignments.root.completed_frames[:] = 0
+
+
+def export_dense(filename, output_fn):
+    """Export a container to the legacy dense format, with Data as an
+    (n_trajs, max_n_frames) array padded with -1, which is what downstream
+    tools (e.g. Serializer.LoadData) expect
+    
+    The data is copied one trajectory at a time, so this doesn't need to hold
+    the whole array in memory.
+    
+    Parameters
+    ----------
+    filename : str
+        the container to export (Assignments.h5 or Assignments.h5.distances)
+    output_fn : str
+        path to write the dense copy to
+    """
+    source = tables.openFile(filename, mode='r')
+    try:
+        data = source.root.Data
+        if data.ndim == 2:
+            n_trajs, max_n_frames = data.shape
+            traj_lengths = None
+        else:
+            offsets = source.root.offsets[:]
+            traj_lengths = np.diff(offsets)
+            n_trajs, max_n_frames = len(traj_lengths), int(np.max(traj_lengths))
+        
+        # the legacy assignments are np.int
+        if data.atom.kind == 'int':
+            atom = tables.Atom.from_dtype(np.dtype(np.int), dflt=-1)
+        else:
+            atom = tables.Atom.from_dtype(data.atom.dtype, dflt=-1)
+        
+        dest = tables.openFile(output_fn, mode='w')
+        try:
+            out = dest.createCArray(dest.root, 'Data', atom,
+                                    (n_trajs, max_n_frames), filters=FILTERS)
+            for i in xrange(n_trajs):
+                if traj_lengths is None:
+                    out[i] = data[i]
+                else:
+                    out[i, :traj_lengths[i]] = data[offsets[i]:offsets[i+1]]
+        finally:
+            dest.close()
+    finally:
+        source.close()
+
+
+def check_generators(f_assignments, gens_hashes):
+    """Check that the generators are the ones the containers were started with
+    
+    Containers that don't record their generators can't be checked, and pass.
+    
+    Parameters
+    ----------
+    f_assignments : tables.File
+        pytables handle to the assignments file
+    gens_hashes : list
+        The hashes of the current generators (see generator_hashes)
+    """
+    if getattr(f_assignments.root._v_attrs, 'incremental_from', None) is not None:
+        raise ValueError('These containers are in the middle of an \
+incremental assignment. Resume it in incremental mode.')
+    if 'gens_hashes' not in f_assignments.root:
+        return
+    if list(f_assignments.root.gens_hashes[:]) != list(gens_hashes):
+        raise ValueError('Generator mismatch. These containers were started \
+with different generators. (Use incremental mode if you appended some)')
+
+
+def start_incremental(f_assignments, gens_hashes):
+    """Start (or resume) an incremental assignment against generators that
+    were appended to the ones in the containers
+    
+    Only the distances to the new generators need to be computed. They are
+    merged into the existing assignments with `save(..., merge=True)`. The
+    containers must hold a completed assignment against the old generators,
+    which must be a prefix of the new ones. All of the frames are marked as
+    not completed, so that they are assigned against the new generators, and
+    the progress of this pass is checkpointed just like a regular run.
+    
+    Parameters
+    ----------
+    f_assignments : tables.File
+        pytables handle to the assignments file
+    gens_hashes : list
+        The hashes of the new generators (see generator_hashes)
+    
+    Returns
+    -------
+    gens_start : int
+        Index of the first new generator. If this is equal to the number of
+        generators, there is nothing to do.
+    """
+    root = f_assignments.root
+    if 'gens_hashes' not in root:
+        raise ValueError("These containers don't record which generators \
+they were assigned with, so they can't be updated incrementally.")
+    
+    old_hashes = list(root.gens_hashes[:])
+    gens_start = getattr(root._v_attrs, 'incremental_from', None)
+    
+    if gens_start is not None:
+        # resuming an incremental pass that was interrupted
+        if old_hashes != list(gens_hashes):
+            raise ValueError('Generator mismatch. This incremental assignment \
+was started with different generators.')
+        return int(gens_start)
+    
+    gens_start = len(old_hashes)
+    if list(gens_hashes[:gens_start]) != old_hashes:
+        raise ValueError('The generators in the containers are not a prefix \
+of the new generators. Only appending generators is supported.')
+    if not np.all(completed_frames(f_assignments)):
+        raise ValueError('The assignment against the old generators has to \
+be completed before new generators can be added.')
+    
+    if gens_start < len(gens_hashes):
+        f_assignments.removeNode(root, 'gens_hashes')
+        f_assignments.createArray(root, 'gens_hashes', np.array(gens_hashes))
+        clear_completed(f_assignments)
+        root._v_attrs.incremental_from = gens_start
+        f_assignments.flush()
+    
+    return gens_start
+
+
+def finish_incremental(f_assignments):
+    """Mark an incremental assignment as done, once all the frames have been
+    saved"""
+    root = f_assignments.root
+    if getattr(root._v_attrs, 'incremental_from', None) is not None \
+            and np.all(completed_frames(f_assignments)):
+        del root._v_attrs.incremental_from
+        f_assignments.flush()
+
+
+class Saver(object):
+    """Write results into the containers, with constant-time bookkeeping per
+    result
+    
+    Marking frames as completed is batched: the data for a vtraj is written
+    right away, but its frames are only marked as completed (in runs of
+    consecutive frames) once `flush_every` results have been saved, after the
+    data has been flushed to disk. So if we crash, a frame that's marked as
+    completed is always on disk, and at most `flush_every` vtrajs have to be
+    redone.
+    
+    Parameters
+    ----------
+    f_assignments : tables.File
+        pytables handle to the assignments file to write to
+    f_distances : tables.File
+        pytables handle to the distances file to write to
+    flush_every : int
+        flush after this many results
+    """
+    def __init__(self, f_assignments, f_distances, flush_every=1):
+        self.f_assignments = f_assignments
+        self.f_distances = f_distances
+        self.flush_every = flush_every
+        
+        self._traj_offsets = traj_offsets(f_assignments.root.traj_lengths[:])
+        self._offsets = None
+        if f_assignments.root.Data.ndim == 1:
+            self._offsets = f_assignments.root.offsets[:]
+        self._n_pending = 0
+        # (start, stop) ranges of frames saved since the last flush
+        self._pending = []
+    
+    @property
+    def n_pending(self):
+        "Number of vtrajs saved, but not yet marked as completed"
+        return self._n_pending
+    
+    def _data_index(self, trj_i, start, stop):
+        """Index into Data for frames start:stop of trajectory trj_i, for
+        either layout"""
+        if self._offsets is None:
+            return (trj_i, slice(start, stop))
+        offset = int(self._offsets[trj_i])
+        return slice(offset + start, offset + stop)
+    
+    def save(self, assignments, distances, vtraj, merge=False):
+        """Save the results for a vtraj
+        
+        Parameters
+        ----------
+        assignments : np.ndarray
+            1D array of the assignments for vtraj
+        distances : np.ndarray
+            1D array of the distances for vtraj
+        vtraj : passign.VTraj
+            logical trajectory object listing which physical trajectory/frames
+            these assignments/distances correspond to
+        merge : bool
+            Instead of overwriting what's on disk, only update the frames that
+            are closer to their new assignment than to their old one. This is
+            used for incremental assignment against new generators.
+        """
+        data_a = self.f_assignments.root.Data
+        data_d = self.f_distances.root.Data
+        
+        ptr = 0
+        for trj_i, start, stop in vtraj:
+            end = ptr + stop - start
+            
+            index = self._data_index(trj_i, start, stop)
+            chunk_a, chunk_d = assignments[ptr:end], distances[ptr:end]
+            if merge:
+                old_a = data_a[index]
+                old_d = data_d[index]
+                # compare at the precision of what's on disk. on a tie, the
+                # old generator has the lower index, so it wins
+                keep = np.asarray(chunk_d, dtype=old_d.dtype) >= old_d
+                chunk_a = np.where(keep, old_a, chunk_a)
+                chunk_d = np.where(keep, old_d, chunk_d)
+            
+            data_a[index] = chunk_a
+            data_d[index] = chunk_d
+            ptr = end
+            
+            offset = int(self._traj_offsets[trj_i])
+            self._pending.append((offset + start, offset + stop))
+        
+        self._n_pending += 1
+        if self._n_pending >= self.flush_every:
+            self.flush()
+    
+    def flush(self):
+        """Flush the data to disk, and then mark the frames saved since the
+        last flush as completed"""
+        self.f_assignments.flush()
+        self.f_distances.flush()
+        if not self._pending:
+            return
+        
+        # merge the ranges into runs of consecutive frames
+        pending = sorted(self._pending)
+        runs = [list(pending[0])]
+        for start, stop in pending[1:]:
+            if start <= runs[-1][1]:
+                runs[-1][1] = max(runs[-1][1], stop)
+            else:
+                runs.append([start, stop])
+        mark_completed(self.f_assignments, runs)
+        
+        self._pending = []
+        self._n_pending = 0
+        self.f_assignments.flush()
+
+
+class AsyncWriter(object):
+    """Save results with a Saver on a dedicated thread, so that the thread
+    collecting results from the engines never waits on the disk
+    
+    Results are put on a bounded queue. The writer thread takes all of the
+    results that are waiting, sorts them by trajectory (so that writes to
+    nearby parts of the containers are together) and saves them. The Saver
+    flushes after every `saver.flush_every` results, and the writer also
+    flushes if results have been waiting more than `flush_interval` seconds.
+    As with the Saver, a vtraj is only marked as completed after its data is
+    on disk.
+    
+    Once the writer is started, the containers must only be accessed through
+    it, until close() has returned.
+    
+    Parameters
+    ----------
+    saver : Saver
+    flush_interval : float
+        maximum number of seconds between a result being saved and it being
+        marked as completed
+    max_queue : int
+        maximum number of results waiting to be written. put() blocks when the
+        queue is full
+    """
+    def __init__(self, saver, flush_interval=10.0, max_queue=256):
+        self.saver = saver
+        self.flush_interval = flush_interval
+        self.n_saved = 0
+        self._queue = Queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def put(self, assignments, distances, vtraj, merge=False):
+        "Queue a result to be saved"
+        if self._error is not None:
+            raise self._error
+        self._queue.put((assignments, distances, vtraj, merge))
+    
+    def close(self):
+        """Save everything that's queued, flush, and stop the writer thread.
+        Errors from the writer thread are raised here"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+    
+    def _run(self):
+        try:
+            self._loop()
+        except Exception:
+            self._error = sys.exc_info()[1]
+            # unblock anybody waiting in put()
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+    
+    def _loop(self):
+        last_flush = time.time()
+        done = False
+        while not done:
+            timeout = None
+            if self.saver.n_pending > 0:
+                timeout = max(0, last_flush + self.flush_interval - time.time())
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except Queue.Empty:
+                batch = []
+            # coalesce whatever else is waiting
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            
+            if None in batch:
+                done = True
+                batch = [e for e in batch if e is not None]
+            
+            batch.sort(key=lambda result: tuple(result[2].chunks[0]))
+            for assignments, distances, vtraj, merge in batch:
+                n_pending = self.saver.n_pending
+                self.saver.save(assignments, distances, vtraj, merge)
+                self.n_saved += 1
+                if self.saver.n_pending <= n_pending:
+                    # the saver flushed by itself
+                    last_flush = time.time()
+            
+            if self.saver.n_pending > 0 and (done or
+                    time.time() - last_flush >= self.flush_interval):
+                self.saver.flush()
+                last_flush = time.time()
+
+
+def save(f_assignments, f_distances, assignments, distances, vtraj,
+         merge=False):
     """
     Save assignments to disk
     
+    This is a one-off Saver.save(), followed by a flush. To save many results,
+    use a Saver.
+    
     Parameters
     ----------
     f_assignments : tables.File
@@ -145,23 +1108,10 @@ def save(f_assignments, f_distances, assignments, distances, vtraj):
     vtraj : passign.VTraj
         logical trajectory object listing which physical trajectory/frames these
         assignments/distances correspond to
+    merge : bool
+        Instead of overwriting what's on disk, only update the frames that are
+        closer to their new assignment than to their old one. This is used
+        for incremental assignment against new generators.
     """
-    
-    ptr = 0
-    for trj_i, start, stop in vtraj:
-        end = ptr + stop - start
-            
-        f_assignments.root.Data[trj_i, start:stop] = assignments[ptr:end]
-        f_distances.root.Data[trj_i, start:stop] = distances[ptr:end]           
-        ptr = end
-    
-    vtraj_i = np.where(f_assignments.root.hashes[:] == vtraj.hash())[0]
-    if len(vtraj_i) != 1:
-        raise ValueError('no matching vtraj?')
-    vtraj_i = vtraj_i[0]
-    
-    f_assignments.root.completed_vtrajs[vtraj_i] = True
-    f_assignments.flush()
-    f_distances.flush()   
-    
-    return vtraj_i 
+    saver = Saver(f_assignments, f_distances)
+    saver.save(assignments, distances, vtraj, merge)
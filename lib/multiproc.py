@@ -0,0 +1,208 @@
+"""
+Run the assignment in a pool of local processes, without IPython.parallel
+
+On a single machine, this avoids starting a controller and engines, and the
+serialization of every task and result through ZeroMQ. The worker processes
+are forked after everything they need (the vtrajs and the metric) has been
+set up, so a task is just the index of a vtraj, and the generators are loaded
+once per process. The assignments and distances are passed back through
+shared memory: each task writes into one of a fixed number of result slots,
+and the slot is reused once the master has copied the results out.
+"""
+import time
+import ctypes
+import traceback
+import multiprocessing
+import Queue
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+from msmbuilder.parallel_assign import remote
+
+# how long to block waiting for a result. waiting with a timeout (rather than
+# none at all) lets KeyboardInterrupt through
+_FOREVER = 1e9
+
+# worker process globals, set by _init_worker
+_VTRAJS, _GENS_SETS, _OPTIONS = None, None, None
+_SLOTS_A, _SLOTS_D = None, None
+
+# the traceback of an error in _init_worker, which is reported by the tasks
+_INIT_ERROR = None
+
+
+def _init_worker(vtrajs, gens_sets, conf_fn, options, slots_a, slots_d,
+                 max_frames):
+    """Runs once in each worker process, when it's started
+
+    An exception raised here would make the pool start new workers forever,
+    so instead it's kept, and reported by the first task.
+    """
+    global _VTRAJS, _GENS_SETS, _OPTIONS, _SLOTS_A, _SLOTS_D, _INIT_ERROR
+    from msmbuilder.parallel_assign import kernels, vtraj
+
+    try:
+        # the files that the master had open (e.g. to measure the costs) are
+        # the master's. don't share their handles, or close them
+        vtraj.HANDLES = vtraj.HandlePool()
+
+        _VTRAJS, _GENS_SETS, _OPTIONS = vtrajs, gens_sets, options
+        shape = (-1, len(gens_sets), max_frames)
+        _SLOTS_A = np.frombuffer(slots_a, dtype=np.int64).reshape(shape)
+        _SLOTS_D = np.frombuffer(slots_d, dtype=np.float64).reshape(shape)
+
+        for gens_fn, metric, pruned, gens_start, index in gens_sets:
+            pruned = pruned and kernels.is_true_metric(metric)
+            remote.load_gens(gens_fn, conf_fn, metric, pruned, gens_start,
+                             options.get('shared', False), index,
+                             len(gens_sets))
+    except Exception:
+        _INIT_ERROR = traceback.format_exc()
+
+
+def _assign(i, slot):
+    """Assign vtraj i, writing the results into a slot
+
+    Returns
+    -------
+    result : tuple
+        (i, slot, n_frames, stats), or None if there was an error
+    error : str
+        the traceback, if there was an error
+
+    The time taken to copy the results into the slot is returned as
+    stats['serialize_time'].
+    """
+    if _INIT_ERROR is not None:
+        return None, _INIT_ERROR
+    try:
+        assignments, distances, _, stats = remote.assign_sets(_VTRAJS[i],
+            _GENS_SETS, **_OPTIONS)
+        start = time.time()
+        n_frames = len(_VTRAJS[i])
+        for k in xrange(len(_GENS_SETS)):
+            _SLOTS_A[slot, k, :n_frames] = assignments[k]
+            _SLOTS_D[slot, k, :n_frames] = distances[k]
+        stats['serialize_time'] = time.time() - start
+    except Exception:
+        return None, traceback.format_exc()
+    return (i, slot, n_frames, stats), None
+
+
+def assign(vtrajs, gens_fn, conf_fn, metric, n_procs=None, options=None):
+    """Assign vtrajs in a pool of local processes
+
+    This is a generator, which yields the results as they complete, in the
+    same form as remote.assign returns them.
+
+    Parameters
+    ----------
+    vtrajs : list
+        the VTrajs to assign
+    gens_fn : str
+        path to the generators
+    conf_fn : str
+        path to the conformation file for the project
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    n_procs : int, optional
+        number of worker processes. Defaults to the number of cores
+    options : dict, optional
+        keyword arguments to remote.assign (pruned, gens_start, prefetch,
+        shared, index, features)
+
+    Yields
+    ------
+    assignments : np.ndarray
+    distances : np.ndarray
+    vtraj : VTraj
+    stats : dict
+    """
+    options = dict(options or {})
+    gens_set = (gens_fn, metric, options.pop('pruned', False),
+                options.pop('gens_start', 0), options.pop('index', False))
+    for assignments, distances, vtraj, stats in assign_sets(vtrajs,
+            [gens_set], conf_fn, n_procs, options):
+        yield assignments[0], distances[0], vtraj, stats
+
+
+def assign_sets(vtrajs, gens_sets, conf_fn, n_procs=None, options=None):
+    """Assign vtrajs to several sets of generators in a pool of local
+    processes, loading their frames once (see remote.assign_sets)
+
+    This is a generator, which yields the results as they complete, in the
+    same form as remote.assign_sets returns them.
+
+    Parameters
+    ----------
+    vtrajs : list
+        the VTrajs to assign
+    gens_sets : list
+        (gens_fn, metric, pruned, gens_start, index) for each set of
+        generators
+    conf_fn : str
+        path to the conformation file for the project
+    n_procs : int, optional
+        number of worker processes. Defaults to the number of cores
+    options : dict, optional
+        keyword arguments to remote.assign_sets (prefetch, shared,
+        features)
+
+    Yields
+    ------
+    assignments : list
+    distances : list
+    vtraj : VTraj
+    stats : dict
+    """
+    if len(vtrajs) == 0:
+        return
+    if n_procs is None:
+        n_procs = multiprocessing.cpu_count()
+    if options is None:
+        options = {}
+
+    # two slots per process, so that every process can start on its next
+    # task while the master copies out the results of its last one
+    n_slots = 2 * n_procs
+    n_sets = len(gens_sets)
+    max_frames = max(len(vtraj) for vtraj in vtrajs)
+    shape = (n_slots, n_sets, max_frames)
+    slots_a = RawArray(ctypes.c_int64, n_slots * n_sets * max_frames)
+    slots_d = RawArray(ctypes.c_double, n_slots * n_sets * max_frames)
+    view_a = np.frombuffer(slots_a, dtype=np.int64).reshape(shape)
+    view_d = np.frombuffer(slots_d, dtype=np.float64).reshape(shape)
+
+    pool = multiprocessing.Pool(n_procs, _init_worker,
+        (vtrajs, gens_sets, conf_fn, options, slots_a, slots_d, max_frames))
+    done = Queue.Queue()
+    remaining = iter(xrange(len(vtrajs)))
+
+    def submit(slot):
+        "Start the next vtraj in `slot`. Returns False if there are none left"
+        for i in remaining:
+            pool.apply_async(_assign, (i, slot), callback=done.put)
+            return True
+        return False
+
+    try:
+        n_running = sum(submit(slot) for slot in xrange(n_slots))
+        while n_running > 0:
+            result, error = done.get(timeout=_FOREVER)
+            n_running -= 1
+            if error is not None:
+                raise RuntimeError('Error in worker process:\n' + error)
+
+            i, slot, n_frames, stats = result
+            assignments = [np.array(view_a[slot, k, :n_frames])
+                           for k in xrange(n_sets)]
+            distances = [np.array(view_d[slot, k, :n_frames])
+                         for k in xrange(n_sets)]
+            n_running += submit(slot)
+
+            yield assignments, distances, vtrajs[i], stats
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,88 @@
+"""
+Overlap trajectory I/O with distance computation on the workers
+
+A Prefetcher runs the loading of the next blocks of frames on a background
+thread, while the current block is being assigned on the main thread. It keeps
+track of how long each side waited for the other, so we can tell whether a run
+is I/O-bound or CPU-bound.
+"""
+import sys
+import time
+import threading
+import Queue
+
+_DONE = object()
+
+
+class Prefetcher(object):
+    """Iterate over `load(item)` for each of `items`, with the loading done on a
+    background thread, at most `depth` items ahead of the consumer.
+
+    Attributes
+    ----------
+    io_time : float
+        seconds spent in load(), on the background thread
+    wait_time : float
+        seconds the consumer spent blocked, waiting for a loaded item. If this
+        is a large fraction of the total time, the run is I/O-bound
+
+    Examples
+    --------
+    >>> prefetcher = Prefetcher(load, items, depth=1)
+    >>> try:
+    ...     for loaded in prefetcher:
+    ...         compute(loaded)
+    ... finally:
+    ...     prefetcher.close()
+    """
+    def __init__(self, load, items, depth=1):
+        if depth < 1:
+            raise ValueError('depth must be >= 1')
+        self.io_time = 0.0
+        self.wait_time = 0.0
+        self._queue = Queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(load, items))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, message):
+        # give up if the consumer has gone away, instead of blocking forever
+        while not self._stop.is_set():
+            try:
+                self._queue.put(message, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self, load, items):
+        try:
+            for item in items:
+                start = time.time()
+                loaded = load(item)
+                self.io_time += time.time() - start
+                if not self._put((None, loaded)):
+                    return
+        except Exception:
+            self._put((sys.exc_info()[1], None))
+            return
+        self._put((None, _DONE))
+
+    def __iter__(self):
+        while True:
+            start = time.time()
+            error, loaded = self._queue.get()
+            self.wait_time += time.time() - start
+
+            if error is not None:
+                raise error
+            if loaded is _DONE:
+                return
+            yield loaded
+
+    def close(self):
+        """Stop the background thread, and wait for it to exit. After this,
+        the load function is no longer being called."""
+        self._stop.set()
+        self._thread.join()
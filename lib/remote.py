@@ -1,71 +1,478 @@
 """
 Functions that execute remotely on the workers
 
-Note that there are thre globals on each worker, pgens, conf and metric. Also,
-due to the way that IPython.parallel works, we do imports inside the functions
+Each worker keeps a small cache of States -- the prepared generators, the
+conformation and the metric they were prepared with -- keyed on the identity
+of the generators and conformation files and a fingerprint of the metric. A
+long-lived engine can therefore be reused across runs with different
+generators, and sees it if the generators file changes. Also, due to the way
+that IPython.parallel works, we do imports inside the functions
 
 
 """
-PREPARED, PGENS, CONF, METRIC = False, None, None, None
+# the cached States, as (key, state) pairs, least recently used first
+STATES = []
 
-def load_gens(gens_fn, conf_fn, metric):
-    """Setup a worker by adding pgens to its global namespace
+# maximum number of States to keep on each worker
+MAX_STATES = 2
+
+# metrics sent to this worker with warm(), by fingerprint
+METRICS = {}
+
+# coordinate buffers for prefetching, reused across tasks
+BUFFERS = []
+
+# default number of frames per block when prefetching
+PREFETCH_BLOCK = 250
+
+
+class State(object):
+    """What a worker needs to assign frames to a set of generators
+    
+    Attributes
+    ----------
+    conf : msmbuilder.Trajectory
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    pgens : prepared trajectory
+        the generators from gens_start on, prepared with the metric
+    gens_start : int
+    gens_distances : np.ndarray or None
+        the distance matrix between the generators, if it's been computed
+    index : tuple or None
+        the nearest neighbor index over pgens (see kernels.build_index), if
+        it's been built
+    """
+    def __init__(self, conf, metric, pgens, gens_start):
+        self.conf = conf
+        self.metric = metric
+        self.pgens = pgens
+        self.gens_start = gens_start
+        self.gens_distances = None
+        self.index = None
+
+
+def warm(gens_fn, conf_fn, metric, pruned=False, gens_start=0, shared=False,
+         index=False, n_sets=1):
+    """Get a worker ready to assign to some generators, before any tasks are
+    sent to it
+    
+    This is meant to be run on all of the engines with a DirectView. The
+    metric is also kept on the worker, by fingerprint.
+    
+    Returns
+    -------
+    fingerprint : str
+        this can be passed to assign() in place of the metric, but only on
+        this worker. Tasks that may run on an engine that wasn't warmed (one
+        that connected later, or was restarted) need to send the metric
+    """
+    from msmbuilder.parallel_assign.shared import metric_fingerprint
+    
+    fingerprint = metric_fingerprint(metric)
+    METRICS[fingerprint] = metric
+    load_gens(gens_fn, conf_fn, metric, pruned, gens_start, shared, index,
+              n_sets)
+    return fingerprint
+
+
+def warm_sets(gens_sets, conf_fn, shared=False):
+    """warm() for several sets of generators, to assign to all of them with
+    assign_sets
+    
+    Parameters
+    ----------
+    gens_sets : list
+        (gens_fn, metric, pruned, gens_start, index) for each set
+    
+    Returns
+    -------
+    fingerprints : list
+        the fingerprint of the metric of each set
+    """
+    return [warm(gens_fn, conf_fn, metric, pruned, gens_start, shared, index,
+                 len(gens_sets))
+            for gens_fn, metric, pruned, gens_start, index in gens_sets]
+
+
+def _lookup(metric):
+    "The metric, given it or the fingerprint it was sent to warm() with"
+    if isinstance(metric, basestring):
+        try:
+            return METRICS[metric]
+        except KeyError:
+            raise RuntimeError('This engine was not sent the metric. Engines '
+                               'that are started after the run has begun '
+                               'cannot be used')
+    return metric
+
+
+def _gens_key(gens_fn, gens_start, metric):
+    "The key of the shared segment of some prepared generators"
+    from msmbuilder.parallel_assign.shared import key, file_identity
+    from msmbuilder.parallel_assign.shared import metric_fingerprint
+    
+    return key(file_identity(gens_fn), gens_start, metric_fingerprint(metric))
+
+
+def release_shared(gens_sets):
+    """Remove the shared memory segments of some sets of generators from this
+    node, at the end of a run with `shared`
+    
+    This is meant to be run on all of the engines with a DirectView. Engines
+    that still have the segments mapped keep working, and the memory is
+    released when they're done with them.
+    
+    Parameters
+    ----------
+    gens_sets : list
+        (gens_fn, metric, pruned, gens_start, index) for each set, as for
+        warm_sets
+    
+    Returns
+    -------
+    n_removed : int
+        the number of segments removed
+    """
+    from msmbuilder.parallel_assign.shared import key, remove
+    
+    keys = []
+    for gens_fn, metric, _, gens_start, _ in gens_sets:
+        gens_key = _gens_key(gens_fn, gens_start, _lookup(metric))
+        keys.extend([gens_key, key(gens_key, 'distances')])
+    return remove(keys)
+
+
+def load_gens(gens_fn, conf_fn, metric, pruned=False, gens_start=0,
+              shared=False, index=False, n_sets=1):
+    """Get the State for some generators, from the cache or by loading them
+    
+    The pgens have to be made on the worker because they are not necessarily
+    picklable, so we can't just prepare them on the master and then push them
+    to the remote workers -- instead we want to actually load the pgens from
+    disk and prepare them on the remote node
     
-    This is necessary because pgens are not necessarily picklable, so we can't
-    just prepare them on the master and then push them to the remote workers --
-    instead we want to actually load the pgens from disk and prepare them on
-    the remote node
+    If `pruned`, the distance matrix between the generators, which is needed
+    for pruned assignment, is also computed and cached with the pgens.
+    
+    If `gens_start` is given, only the generators from that index on are
+    prepared. This is used to assign against generators that were appended to
+    an existing set.
+    
+    If `shared`, the pgens (and distance matrix) are prepared once per node,
+    and memory-mapped from shared memory by all of the engines on it (see
+    shared.cached).
+    
+    If `index`, a nearest neighbor index over the pgens is also built and
+    cached, if the metric allows it (see kernels.build_index). It's built by
+    each worker, even if the pgens are shared.
+    
+    The cache keeps MAX_STATES States, or `n_sets` if that's more, so that
+    the States of all of the sets being assigned at once stay in it.
+    
+    Returns
+    -------
+    state : State
     """
     from msmbuilder import Trajectory
+    from msmbuilder.parallel_assign import kernels
+    from msmbuilder.parallel_assign.shared import cached, key, file_identity
+    
+    gens_key = _gens_key(gens_fn, gens_start, metric)
+    state_key = (gens_key, file_identity(conf_fn))
+    
+    for i, (k, state) in enumerate(STATES):
+        if k == state_key:
+            # move it to the most recently used end
+            STATES.append(STATES.pop(i))
+            break
+    else:
+        def prepare():
+            gens = Trajectory.LoadTrajectoryFile(gens_fn)
+            if gens_start > 0:
+                gens['XYZList'] = gens['XYZList'][gens_start:]
+            return metric.prepare_trajectory(gens)
+        
+        if shared:
+            pgens = cached(gens_key, prepare)
+        else:
+            pgens = prepare()
+        state = State(Trajectory.LoadTrajectoryFile(conf_fn), metric, pgens,
+                      gens_start)
+        STATES.append((state_key, state))
+        del STATES[:-max(MAX_STATES, n_sets)]
+    
+    if pruned and state.gens_distances is None:
+        pairwise = lambda: kernels.pairwise(metric, state.pgens,
+                                            len(state.pgens))
+        if shared:
+            state.gens_distances = cached(key(gens_key, 'distances'), pairwise)
+        else:
+            state.gens_distances = pairwise()
+    
+    if index and state.index is None:
+        state.index = kernels.build_index(metric, state.pgens)
     
-    global PGENS, CONF, METRIC, PREPARED
+    return state
     
-    METRIC = metric
-    CONF = Trajectory.LoadTrajectoryFile(conf_fn)
-    gens = Trajectory.LoadTrajectoryFile(gens_fn)
-    PGENS = metric.prepare_trajectory(gens)
-    PREPARED = True
+
+def _assign_prepared(state, ptraj, n_frames, pruned, seed, index=False):
+    """Assign prepared frames to state.pgens
+    
+    Returns
+    -------
+    assignments, distances : np.ndarray
+    n_distances : int
+        the number of distances computed. The index doesn't count them, so
+        with the index this is the number without it
+    """
+    from msmbuilder.parallel_assign import kernels
+    
+    if index and state.index is not None:
+        assignments, distances = kernels.indexed(state.index, ptraj, n_frames)
+        return assignments, distances, n_frames * len(state.pgens)
+    
+    if pruned:
+        return kernels.pruned(state.metric, ptraj, state.pgens, n_frames,
+                              state.gens_distances, seed)
     
+    assignments, distances = kernels.blocked(state.metric, ptraj, state.pgens,
+                                             n_frames)
+    return assignments, distances, n_frames * len(state.pgens)
 
-def assign(vtraj, gens_fn, metric):
+
+def assign(vtraj, gens_fn, metric, pruned=False, gens_start=0, prefetch=0,
+           block_size=PREFETCH_BLOCK, shared=False, index=False,
+           features=None):
     """
     Assign a VTraj to the generators
     
-    This executes on the remote workers. It uses two global variables which
-    are worker-local
+    This executes on the remote workers. The generators are loaded and
+    prepared the first time they're needed, and cached (see load_gens)
     
+    The distances are computed in frame-block x generator-block tiles when
+    the metric supports it (see kernels.blocked), and frame by frame
+    otherwise.
+
     Parameters
     ----------
     vtraj : VTraj
         A list of tuples like (traj_index, slice(start, end))
+    gens_fn : str
+        path to the generators
+    metric : msmbuilder.metrics.AbstractDistanceMetric or str
+        the metric, or the fingerprint of a metric that was already sent to
+        this worker with warm()
+    pruned : bool
+        use the triangle inequality to skip generators that can't be the
+        closest (see kernels.pruned). Only valid for metrics that obey the
+        triangle inequality -- for other metrics this is ignored.
+    gens_start : int
+        only compute the distances to the generators from this index on. The
+        returned assignments are still indices into the full set of
+        generators
+    prefetch : int
+        If > 0, split the vtraj into blocks of `block_size` frames, and load
+        up to `prefetch` blocks ahead on a background thread while the
+        current block is being assigned (see pipeline.Prefetcher)
+    block_size : int
+        number of frames per block when prefetching
+    shared : bool
+        share the prepared generators between the engines on a node (see
+        load_gens)
+    index : bool
+        find the nearest generators with a nearest neighbor index (see
+        kernels.build_index) instead of computing the distances to all of
+        them. Metrics that don't allow it fall back to the other kernels.
+        Takes precedence over `pruned`.
+    features : features.FeatureCache, optional
+        take the prepared frames from this cache if they're in it, without
+        loading them, and put them in it if they're not. With prefetching,
+        this is done for each block
     
-    
-    Globals
+    Returns
     -------
-    conf : msmbuilder.Trajectory
-    metric : msmbuilder.metrics.AbstractDistanceMetric
+    assignments : np.ndarray
+    distances : np.ndarray
+    vtraj : VTraj
+    stats : dict
+        'n_distances' is the number of frame-generator distances that were
+        computed, and 'n_distances_exhaustive' the number that would have been
+        computed without pruning. 'io_time' is the time spent loading frames,
+        'io_wait_time' the part of that the computation was blocked on, and
+        'compute_time' the time spent preparing and assigning them.
+        'n_opened' is the number of trajectory files that had to be opened,
+        and 'bytes_read' the number of bytes of coordinates read from them.
+        
+        The times are further broken down into 'open_time', 'read_time' and
+        'decode_time' (opening the files, reading the lossy integers and
+        converting them to coordinates, which together make up io_time), and
+        'prepare_time' and 'distance_time' (metric.prepare_trajectory and the
+        distance computation, which make up compute_time). 'task_time' is the
+        time spent in this function, and 'n_frames' the number of frames.
+        
+        'n_cached_frames' is the number of frames whose prepared features
+        were all found in the feature cache, and 'cache_time' the time spent
+        looking them up and storing them.
+    """
+    assignments, distances, vtraj, stats = assign_sets(vtraj,
+        [(gens_fn, metric, pruned, gens_start, index)], prefetch, block_size,
+        shared, features)
+    return assignments[0], distances[0], vtraj, stats
+
+
+def assign_sets(vtraj, gens_sets, prefetch=0, block_size=PREFETCH_BLOCK,
+                shared=False, features=None):
+    """
+    Assign a VTraj to several sets of generators, loading its frames once
+    
+    This is how assign() works, for each set of generators in turn, except
+    that the frames are read from disk and decoded only once for all of the
+    sets, and prepared only once for all of the sets with the same metric.
     
+    Parameters
+    ----------
+    vtraj : VTraj
+    gens_sets : list
+        (gens_fn, metric, pruned, gens_start, index) for each set of
+        generators, as in assign()
+    prefetch, block_size, shared, features
+        see assign
+    
+    Returns
+    -------
+    assignments : list
+        the assignments to each set, as an np.ndarray
+    distances : list
+        the distances to each set, as an np.ndarray
+    vtraj : VTraj
+    stats : dict
+        as for assign(). The counts and times of the distance computations
+        are summed over the sets, and those of loading the frames are for all
+        of them at once
     """
+    import time
     import numpy as np
-    global CONF
-    
-    if not PREPARED:
-        load_gens(gens_fn, vtraj.project['ConfFilename'], metric)
-
-    traj = vtraj.load(CONF)
+    from msmbuilder.parallel_assign import kernels
+    from msmbuilder.parallel_assign.vtraj import HANDLES
+    from msmbuilder.parallel_assign.shared import metric_fingerprint
     
-    ptraj = METRIC.prepare_trajectory(traj)
+    task_start = time.time()
+    counters = ['n_opened', 'bytes_read', 'open_time', 'read_time',
+                'decode_time']
+    before = dict((name, getattr(HANDLES, name)) for name in counters)
     
-    n_frames = len(traj)
+    # (state, pruned, index, fingerprint of the metric) for each set
+    sets = []
+    for gens_fn, metric, pruned, gens_start, index in gens_sets:
+        fingerprint = metric
+        metric = _lookup(metric)
+        if not isinstance(fingerprint, basestring):
+            fingerprint = metric_fingerprint(metric)
+        pruned = pruned and kernels.is_true_metric(metric)
+        state = load_gens(gens_fn, vtraj.project['ConfFilename'], metric,
+                          pruned, gens_start, shared, index, len(gens_sets))
+        sets.append((state, pruned, index, fingerprint))
+    conf = sets[0][0].conf
+    n_atoms = conf.GetNumberOfAtoms()
+    fingerprints = set(fingerprint for _, _, _, fingerprint in sets)
     
-    distances = np.zeros(n_frames)
-    assignments = np.zeros(n_frames, dtype=int)
+    # the frames are loaded and prepared in units: the blocks when
+    # prefetching, or else the whole vtraj. a unit only has to be loaded if
+    # it's missing from the feature cache for at least one of the metrics
+    if prefetch > 0:
+        units = vtraj.split(block_size)
+    else:
+        units = [vtraj]
+    # fingerprint -> the prepared frames, from the cache, for each unit
+    hits = [{} for _ in units]
+    cache_time = 0.0
+    if features is not None:
+        start = time.time()
+        for unit, unit_hits in zip(units, hits):
+            for fingerprint in fingerprints:
+                prepared = features.get(unit, fingerprint)
+                if prepared is not None:
+                    unit_hits[fingerprint] = prepared
+        cache_time += time.time() - start
+    missing = [unit for unit, unit_hits in zip(units, hits)
+               if len(unit_hits) < len(fingerprints)]
     
-    for i in xrange(n_frames):
-        d_o2a = METRIC.one_to_all(ptraj, PGENS, i)
-        #d = np.zeros(len(ptraj))
-        assignments[i] = np.argmin(d_o2a)
-        distances[i] = d_o2a[assignments[i]]
+    if prefetch > 0:
+        from msmbuilder.parallel_assign.vtraj import CoordinateBuffer
+        from msmbuilder.parallel_assign.pipeline import Prefetcher
         
+        # one buffer for the block being assigned, `prefetch` for the ones
+        # waiting in the queue and one for the block being loaded
+        n_buffers = prefetch + 2
+        while len(BUFFERS) < n_buffers:
+            BUFFERS.append(CoordinateBuffer())
         
-    return assignments, distances, vtraj
+        def load(item):
+            k, block = item
+            return block.load_xyz(n_atoms, buffer=BUFFERS[k % n_buffers])
+        blocks = Prefetcher(load, enumerate(missing), prefetch)
+    else:
+        start = time.time()
+        blocks = [unit.load_xyz(n_atoms) for unit in missing]
+        io_time = time.time() - start
+    
+    results = [[] for _ in sets]
+    prepare_time = distance_time = 0.0
+    seeds = [0] * len(sets)
+    n_cached_frames = 0
+    loaded = iter(blocks)
+    try:
+        for unit, unit_hits in zip(units, hits):
+            if len(unit_hits) < len(fingerprints):
+                conf['XYZList'] = next(loaded)
+            else:
+                n_cached_frames += len(unit)
+            # fingerprint -> the frames prepared with that metric
+            ptrajs = dict(unit_hits)
+            for k, (state, pruned, index, fingerprint) in enumerate(sets):
+                if fingerprint not in ptrajs:
+                    start = time.time()
+                    ptrajs[fingerprint] = state.metric.prepare_trajectory(conf)
+                    prepare_time += time.time() - start
+                    if features is not None:
+                        start = time.time()
+                        features.put(unit, fingerprint, ptrajs[fingerprint])
+                        cache_time += time.time() - start
+                start = time.time()
+                results[k].append(_assign_prepared(state, ptrajs[fingerprint],
+                    len(unit), pruned, seeds[k], index))
+                seeds[k] = results[k][-1][0][-1]
+                distance_time += time.time() - start
+    finally:
+        if prefetch > 0:
+            blocks.close()
+    
+    if prefetch > 0:
+        io_time, io_wait_time = blocks.io_time, blocks.wait_time
+    else:
+        io_wait_time = io_time
+    
+    assignments, distances = [], []
+    n_gens = 0
+    for (state, _, _, _), set_results in zip(sets, results):
+        n_gens += len(state.pgens)
+        assignments.append(np.concatenate([r[0] for r in set_results]) +
+                           state.gens_start)
+        distances.append(np.concatenate([r[1] for r in set_results]))
+    
+    stats = {'n_frames': len(vtraj),
+             'n_distances': sum(r[2] for set_results in results
+                                for r in set_results),
+             'n_distances_exhaustive': len(vtraj) * n_gens,
+             'io_time': io_time,
+             'io_wait_time': io_wait_time,
+             'compute_time': prepare_time + distance_time,
+             'prepare_time': prepare_time,
+             'distance_time': distance_time,
+             'n_cached_frames': n_cached_frames,
+             'cache_time': cache_time,
+             'task_time': time.time() - task_start}
+    for name in counters:
+        stats[name] = getattr(HANDLES, name) - before[name]
+
+    return assignments, distances, vtraj, stats
@@ -0,0 +1,158 @@
+"""
+Keep track of where the time goes in a run
+
+Each task returns a breakdown of the time it spent (see remote.assign). A
+RunReport adds those up on the master, in total and per engine, which gives
+the throughput of each engine, an estimate of the time left that is weighted
+by the number of frames rather than the number of chunks (which can differ a
+lot in size), and, at the end of the run, a report that is written next to
+the results: a JSON file with the totals and a CSV file with a line per
+engine. That's what's needed to decide how many nodes to ask for, and how
+many threads to give each engine.
+"""
+import csv
+import json
+import time
+
+# the parts of a task, in the order they happen. with prefetching, the first
+# three overlap with the rest
+PHASES = ['open_time', 'read_time', 'decode_time', 'prepare_time',
+          'distance_time', 'serialize_time']
+
+# the columns of the CSV report, after the engine id
+COLUMNS = ['n_chunks', 'n_frames', 'task_time', 'frames_per_second'] + \
+    PHASES + ['n_opened', 'bytes_read', 'n_cached_frames']
+
+
+def transfer_time(async_result):
+    """Seconds between an engine finishing a task and the client receiving
+    its result, i.e. serializing the result and sending it to the master
+
+    This compares the clocks of the engine and the master, so it's only as
+    good as their synchronization. Returns 0 if it's not known (before
+    IPython 0.13)
+    """
+    from msmbuilder.parallel_assign.schedule import _seconds
+    try:
+        return max(0.0, _seconds(async_result.received -
+                                 async_result.completed))
+    except (AttributeError, TypeError):
+        return 0.0
+
+
+class RunReport(object):
+    """Add up the stats of the tasks in a run
+
+    Parameters
+    ----------
+    n_frames : int
+        number of frames to be assigned in this run
+    info : dict, optional
+        anything else to put in the report, e.g. the options of the run
+
+    Attributes
+    ----------
+    n_done : int
+        number of frames assigned so far
+    totals : dict
+        the stats returned by the tasks, summed
+    engines : dict
+        engine id -> the stats of its tasks, summed, and the number of tasks
+        ('n_chunks')
+    """
+    def __init__(self, n_frames, info=None):
+        self.n_frames = n_frames
+        self.info = dict(info or {})
+        self.n_done = 0
+        self.totals = {}
+        self.engines = {}
+        self.start = time.time()
+        self.end = None
+
+    def add(self, stats, engine_id=None):
+        "Account for a completed task, given the stats it returned"
+        engine = self.engines.setdefault(engine_id, {'n_chunks': 0})
+        engine['n_chunks'] += 1
+        for key, value in stats.iteritems():
+            self.totals[key] = self.totals.get(key, 0) + value
+            engine[key] = engine.get(key, 0) + value
+        self.n_done += stats.get('n_frames', 0)
+
+    def finish(self):
+        "Stop the clock, at the end of the run"
+        self.end = time.time()
+
+    @property
+    def elapsed(self):
+        "Seconds since the start of the run (until finish() was called)"
+        if self.end is None:
+            return time.time() - self.start
+        return self.end - self.start
+
+    def frames_per_second(self):
+        "Overall throughput so far"
+        elapsed = self.elapsed
+        return self.n_done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """When the run is expected to finish (in seconds since the epoch), at
+        the rate frames have been assigned so far. None if no frames have been
+        assigned yet"""
+        if self.n_done == 0:
+            return None
+        now = time.time()
+        return now + (self.n_frames - self.n_done) * (now - self.start) \
+            / float(self.n_done)
+
+    def engine_rates(self):
+        """Frames per second that each engine assigned while it was busy,
+        i.e. its number of frames over the time spent in its tasks"""
+        rates = {}
+        for engine_id, engine in self.engines.iteritems():
+            busy = engine.get('task_time', 0)
+            rates[engine_id] = engine.get('n_frames', 0) / busy if busy > 0 \
+                else 0.0
+        return rates
+
+    def breakdown(self):
+        """Fraction of the time in the tasks spent in each of PHASES (which
+        add up to 1, unless nothing was timed)"""
+        total = sum(self.totals.get(phase, 0) for phase in PHASES)
+        if total <= 0:
+            return dict((phase, 0.0) for phase in PHASES)
+        return dict((phase, self.totals.get(phase, 0) / total)
+                    for phase in PHASES)
+
+    def summary(self):
+        "Everything in the report, as a dict that can be saved as JSON"
+        rates = self.engine_rates()
+        engines = []
+        for engine_id in sorted(self.engines):
+            engine = dict(self.engines[engine_id])
+            engine['engine'] = engine_id
+            engine['frames_per_second'] = rates[engine_id]
+            engines.append(engine)
+
+        return {'info': self.info,
+                'start': self.start,
+                'elapsed': self.elapsed,
+                'n_frames': self.n_frames,
+                'n_done': self.n_done,
+                'frames_per_second': self.frames_per_second(),
+                'totals': self.totals,
+                'breakdown': self.breakdown(),
+                'engines': engines}
+
+    def write(self, prefix):
+        """Write the report to prefix + '.json', and the per-engine numbers
+        to prefix + '.csv'"""
+        summary = self.summary()
+        with open(prefix + '.json', 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+        with open(prefix + '.csv', 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['engine'] + COLUMNS)
+            for engine in summary['engines']:
+                writer.writerow([engine['engine']] +
+                                [engine.get(column, 0) for column in COLUMNS])
@@ -0,0 +1,362 @@
+"""
+Run the vtrajs on the engines, coping with stragglers and lost engines
+
+The Scheduler submits a task per vtraj to a load-balanced view and yields
+the results as they complete, like a plain lview.map would, with two
+additions:
+
+* If an engine dies, the IPython.parallel client fails its outstanding
+  tasks with a RemoteError wrapping an EngineError. Those vtrajs are resubmitted to the engines that
+  are left, instead of the run failing.
+
+* Locality-aware scheduling (optional). Instead of handing each vtraj to
+  whichever engine is free, each trajectory is given an affinity to one
+  engine, and the master feeds every engine the vtrajs from its own
+  trajectories, a couple at a time. So each trajectory file is mostly read by
+  one engine, which keeps it open (see vtraj.HandlePool) and finds it in the
+  page cache. An engine that runs out of its own vtrajs steals from the
+  engine with the most left.
+
+* Speculative execution (optional). Once there are no more tasks waiting to
+  be handed out, a task which has been running for much longer than the
+  median task is run a second time on an engine that would otherwise be idle.
+  Whichever copy finishes first wins and the other is discarded, so a single
+  slow node can't hold up the end of the run. (Saving a result twice would be
+  harmless anyways: Saver.save writes the same frames with the same values.)
+"""
+import time
+import collections
+import numpy as np
+from IPython.parallel.error import RemoteError
+
+
+def _engine_lost(async):
+    "Did a task fail because its engine went away"
+    try:
+        async.result
+    except RemoteError as e:
+        return e.ename == 'EngineError'
+    except Exception:
+        # e.g. aborted
+        pass
+    return False
+
+
+def _seconds(td):
+    "td.total_seconds(), which was introduced in python 2.7"
+    return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) \
+        / float(10**6)
+
+
+class Scheduler(object):
+    """Run `task(vtraj, *args)` on the engines for a list of vtrajs
+
+    Parameters
+    ----------
+    client : IPython.parallel.Client
+    collector : collect.ResultCollector
+        collector hooked into `client`
+    task : callable
+        the function to run on the engines, e.g. remote.assign
+    args : tuple
+        the rest of the arguments to `task`, which are the same for every
+        vtraj
+    speculate : bool
+        run copies of straggling tasks on idle engines
+    straggler_factor : float
+        a task is straggling once it's been running for this many times the
+        median running time of the completed tasks
+    check_interval : float
+        how often to look for stragglers, in seconds
+    min_samples : int
+        number of completed tasks needed before the median is trusted
+    locality : bool
+        give each trajectory an affinity to one engine
+    depth : int
+        with locality, the number of tasks each engine is given at a time
+
+    Attributes
+    ----------
+    n_duplicates : int
+        number of copies of straggling tasks that were started
+    n_duplicates_won : int
+        number of those which finished before the original
+    n_resubmitted : int
+        number of tasks resubmitted because their engine was lost
+    n_stolen : int
+        with locality, number of vtrajs that were run by an engine other than
+        the one their trajectory has an affinity to
+    """
+    def __init__(self, client, collector, task, args=(), speculate=False,
+                 straggler_factor=3.0, check_interval=5.0, min_samples=5,
+                 locality=False, depth=2):
+        self.client = client
+        self.collector = collector
+        self.task = task
+        self.args = tuple(args)
+        self.speculate = speculate
+        self.straggler_factor = straggler_factor
+        self.check_interval = check_interval
+        self.min_samples = min_samples
+        self.locality = locality
+        self.depth = depth
+        self.view = client.load_balanced_view()
+
+        self.n_duplicates = 0
+        self.n_duplicates_won = 0
+        self.n_resubmitted = 0
+        self.n_stolen = 0
+
+        self._vtrajs = []
+        # msg_id -> index of its vtraj, for the tasks in flight
+        self._job_of = {}
+        # index of a vtraj -> msg_ids of its tasks in flight
+        self._tasks = {}
+        self._done = set()
+        self._duplicated = set()
+        # msg_ids of the copies of straggling tasks
+        self._copies = set()
+        # msg_id -> when we first saw it running
+        self._started = {}
+        self._durations = []
+        self._last_check = time.time()
+        # with locality: engine id -> deque of the vtraj indices waiting for
+        # it, the engines that are still alive, which engine each msg_id was
+        # sent to, and how many tasks each engine has
+        self._queues = {}
+        self._alive = set()
+        self._engine_of = {}
+        self._in_flight = collections.defaultdict(int)
+
+    @property
+    def n_remaining(self):
+        "Number of vtrajs whose results haven't been returned yet"
+        return len(self._vtrajs) - len(self._done)
+
+    def _track(self, j, msg_ids):
+        for msg_id in msg_ids:
+            self._job_of[msg_id] = j
+            self._tasks.setdefault(j, set()).add(msg_id)
+        self.collector.watch(msg_ids)
+
+    def _submit(self, j, targets=None):
+        """Submit one more task for vtraj j. Returns its msg_ids
+        
+        It's submitted as a map of one vtraj, like the ones submitted
+        together in run(), so that all of the results have the same shape
+        """
+        view = self.view
+        if targets is not None:
+            view = self.client.load_balanced_view(targets=targets)
+        async = view.map(self.task, [self._vtrajs[j]],
+                         *[[arg] for arg in self.args], chunksize=1)
+        self._track(j, async.msg_ids)
+        if targets is not None and len(targets) == 1:
+            for msg_id in async.msg_ids:
+                self._engine_of[msg_id] = targets[0]
+                self._in_flight[targets[0]] += 1
+        return async.msg_ids
+
+    def _affinity(self, engine_ids):
+        """Give each trajectory an affinity to one of the engines, balancing
+        the number of frames, and queue up each engine's vtrajs.
+        
+        A vtraj belongs to the trajectory that most of its frames are from.
+        """
+        frames = collections.defaultdict(int)
+        owner = []
+        for vtraj in self._vtrajs:
+            traj, n = max(((c.traj, len(c)) for c in vtraj),
+                          key=lambda e: e[1])
+            owner.append(traj)
+            frames[traj] += len(vtraj)
+        
+        # the biggest trajectories first, each to the least loaded engine
+        load = dict((engine_id, 0) for engine_id in engine_ids)
+        engine_of_traj = {}
+        for traj in sorted(frames, key=frames.get, reverse=True):
+            engine_id = min(load, key=lambda e: (load[e], e))
+            engine_of_traj[traj] = engine_id
+            load[engine_id] += frames[traj]
+        
+        self._queues = dict((engine_id, collections.deque())
+                            for engine_id in engine_ids)
+        for j, traj in enumerate(owner):
+            self._queues[engine_of_traj[traj]].append(j)
+        self._alive = set(engine_ids)
+
+    def _next_for(self, engine_id):
+        """The next vtraj for an engine to run: one of its own, or one stolen
+        from the engine with the most left. None if there are none left"""
+        if self._queues[engine_id]:
+            return self._queues[engine_id].popleft()
+        victim = max(self._queues, key=lambda e: len(self._queues[e]))
+        if not self._queues[victim]:
+            return None
+        self.n_stolen += 1
+        # take from the end, the furthest from what the victim is reading now
+        return self._queues[victim].pop()
+
+    def _feed(self, engine_id):
+        "Keep `depth` tasks on an engine, while there's work left"
+        while engine_id in self._alive and \
+                self._in_flight[engine_id] < self.depth:
+            j = self._next_for(engine_id)
+            if j is None:
+                return
+            self._submit(j, targets=[engine_id])
+
+    def _feed_all(self):
+        """Feed every engine that's alive, after work was put back in the
+        queues. Engines are only fed as their tasks complete, so the ones
+        with nothing in flight would never get it"""
+        for engine_id in sorted(self._alive):
+            self._feed(engine_id)
+
+    def _release(self, msg_id, lost=False):
+        """A task is done, one way or another. Give its engine more work,
+        unless the engine was `lost`"""
+        engine_id = self._engine_of.pop(msg_id, None)
+        if engine_id is None:
+            return
+        self._in_flight[engine_id] -= 1
+        if lost:
+            # the rest of its queue will be stolen by the others
+            self._alive.discard(engine_id)
+        else:
+            self._feed(engine_id)
+
+    def _n_queued(self):
+        "Number of vtrajs waiting on the master for an engine"
+        return sum(len(queue) for queue in self._queues.itervalues())
+
+    def run(self, vtrajs):
+        """Submit the vtrajs, and iterate over the results as they complete
+
+        Yields
+        ------
+        result : object
+            what task returned, once per vtraj
+        async_result : AsyncResult
+            the task that produced it (for its metadata)
+        """
+        self._vtrajs = list(vtrajs)
+        n = len(self._vtrajs)
+        if n == 0:
+            return
+
+        if self.locality:
+            self._affinity(self.client.ids)
+            for engine_id in sorted(self._queues):
+                self._feed(engine_id)
+        else:
+            columns = [[arg] * n for arg in self.args]
+            amr = self.view.map(self.task, self._vtrajs, *columns, chunksize=1)
+            for j, msg_id in enumerate(amr.msg_ids):
+                self._track(j, [msg_id])
+
+        while self.n_remaining > 0:
+            timeout = self.check_interval if self.speculate else None
+            msg_id = self.collector.next_completed(timeout)
+            if self.speculate and \
+                    time.time() - self._last_check >= self.check_interval:
+                self._check_stragglers()
+            if msg_id is None:
+                if self.collector.n_pending == 0:
+                    raise RuntimeError('No tasks are running, but %d vtrajs '
+                                       'are not done' % self.n_remaining)
+                continue
+
+            j = self._job_of.pop(msg_id, None)
+            if j is None:
+                continue
+            self._tasks[j].discard(msg_id)
+            async = self.client.get_result(msg_id)
+            if j in self._done:
+                # a copy that lost the race, which was aborted or ran to
+                # completion. only now is its engine free
+                lost = _engine_lost(async)
+                self._release(msg_id, lost=lost)
+                self._started.pop(msg_id, None)
+                if lost:
+                    self._feed_all()
+                continue
+            try:
+                result = async.result[0]
+            except RemoteError as e:
+                if e.ename != 'EngineError':
+                    raise
+                # the engine went away. run it somewhere else, unless there's
+                # a copy of it running already
+                engine_id = self._engine_of.get(msg_id)
+                self._release(msg_id, lost=True)
+                self._started.pop(msg_id, None)
+                self._copies.discard(msg_id)
+                if j not in self._done and not self._tasks[j]:
+                    self.n_resubmitted += 1
+                    if self.locality and engine_id in self._queues:
+                        # back in the lost engine's queue, which the others
+                        # steal from
+                        self._queues[engine_id].appendleft(j)
+                    else:
+                        self._submit(j)
+                self._feed_all()
+                continue
+
+            self._release(msg_id)
+            self._done.add(j)
+            self._finished(j, msg_id, async)
+            yield result, async
+        
+        # the copies that lost the race and are still running
+        for msg_id in self._job_of:
+            self.collector.forget(msg_id)
+
+    def _finished(self, j, msg_id, async):
+        "Bookkeeping once the first task for vtraj j has completed"
+        if msg_id in self._copies:
+            self.n_duplicates_won += 1
+        others = list(self._tasks[j])
+        if others:
+            # the rest are copies that lost the race. the ones that haven't
+            # started yet are aborted, the others run to completion. either
+            # way their replies are ignored, and their engines are given more
+            # work when they arrive
+            self.client.abort(others, block=False)
+        
+        self._started.pop(msg_id, None)
+        for m in [msg_id] + others:
+            self._copies.discard(m)
+        try:
+            self._durations.append(_seconds(async.completed - async.started))
+        except (AttributeError, TypeError):
+            pass
+
+    def _check_stragglers(self):
+        """Start copies of straggling tasks on idle engines, once there are no
+        more tasks waiting for an engine"""
+        self._last_check = now = time.time()
+        status = self.client.queue_status(verbose=True)
+        unassigned = status.pop('unassigned', [])
+        idle = []
+        for engine_id, engine in sorted(status.items()):
+            if not engine['queue'] and not engine['tasks']:
+                idle.append(engine_id)
+            for msg_id in engine['tasks']:
+                self._started.setdefault(msg_id, now)
+        if len(unassigned) > 0 or self._n_queued() > 0 or not idle or \
+                len(self._durations) < self.min_samples:
+            return
+
+        threshold = self.straggler_factor * np.median(self._durations)
+        stragglers = [(started, msg_id) for msg_id, started
+                      in self._started.iteritems()
+                      if now - started > threshold and msg_id in self._job_of
+                      and self._job_of[msg_id] not in self._duplicated]
+        # the ones that have been running the longest first
+        stragglers.sort()
+        for engine_id, (_, msg_id) in zip(idle, stragglers):
+            j = self._job_of[msg_id]
+            self._duplicated.add(j)
+            self._copies.update(self._submit(j, targets=[engine_id]))
+            self.n_duplicates += 1
@@ -0,0 +1,246 @@
+"""
+Share the prepared generators between the engines on a node
+
+Normally every engine loads the generators and runs metric.prepare_trajectory
+on them itself, and holds its own copy of the result. With many engines per
+node and a large set of generators, that's a lot of memory and a lot of
+repeated work at startup.
+
+Instead, the first engine on a node to need the prepared generators writes
+them into a segment in shared memory (/dev/shm, where it exists), and every
+engine, including that one, memory-maps the arrays from there. The pages are
+shared between all of the engines on the node, and nothing is copied until an
+engine writes to them, which the metrics don't do.
+
+Segments are keyed on the identity of the generators file (its path, mtime and
+size) and a fingerprint of the metric's parameters, so a changed file or a
+different metric gets a new segment rather than a stale one.
+"""
+import os
+import errno
+import fcntl
+import shutil
+import types
+import tempfile
+import cPickle as pickle
+from hashlib import sha1
+import numpy as np
+
+# name prefix of the segments, so clear() knows what's ours
+PREFIX = 'msmb-pgens-'
+
+if os.path.isdir('/dev/shm'):
+    DIRECTORY = '/dev/shm'
+else:
+    DIRECTORY = tempfile.gettempdir()
+
+
+def file_identity(filename):
+    """Identity of a file: its absolute path, mtime and size
+
+    Two calls return the same thing only if the file (very probably) hasn't
+    changed in between.
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    return (filename, stat.st_mtime, stat.st_size)
+
+
+def metric_fingerprint(metric):
+    """A string that identifies a metric's type and parameters
+
+    Metrics whose fingerprints are the same prepare trajectories, and compute
+    distances, in the same way. The fingerprint is the same in every process,
+    also for metrics that hold other objects (like the base metrics of a
+    Hybrid), whose reprs would include their addresses.
+    """
+    digest = sha1()
+    _digest(digest, metric, set())
+    return digest.hexdigest()
+
+
+def _digest(digest, value, seen):
+    "Add a value to a digest, looking inside containers and objects"
+    if isinstance(value, np.ndarray):
+        digest.update(str(value.dtype) + str(value.shape))
+        digest.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (types.FunctionType, types.BuiltinFunctionType,
+                            type, types.ClassType)):
+        digest.update('%s.%s' % (value.__module__, value.__name__))
+    elif isinstance(value, types.ModuleType):
+        digest.update(value.__name__)
+    elif isinstance(value, types.MethodType):
+        digest.update(value.__name__)
+        _digest(digest, value.__self__, seen)
+    elif isinstance(value, (list, tuple, dict)) or hasattr(value, '__dict__'):
+        value_id = id(value)
+        if value_id in seen:
+            digest.update('<cycle>')
+            return
+        seen.add(value_id)
+        if isinstance(value, (list, tuple)):
+            digest.update('%s%d' % (type(value).__name__, len(value)))
+            for e in value:
+                _digest(digest, e, seen)
+        else:
+            if not isinstance(value, dict):
+                digest.update('%s.%s' % (type(value).__module__,
+                                         type(value).__name__))
+                value = vars(value)
+            digest.update('{%d' % len(value))
+            for name in sorted(value):
+                _digest(digest, name, seen)
+                _digest(digest, value[name], seen)
+        seen.discard(value_id)
+    else:
+        text = repr(value)
+        if ' at 0x' in text:
+            # the default repr, which has the address in it
+            try:
+                text = pickle.dumps(value, 2)
+            except (pickle.PicklingError, TypeError):
+                text = '%s.%s' % (type(value).__module__, type(value).__name__)
+        digest.update(text)
+
+
+def key(*parts):
+    "Turn some picklable parts (e.g. a file identity) into a segment key"
+    return sha1(pickle.dumps(parts, 2)).hexdigest()
+
+
+def _dump(prepared, path):
+    """Save a prepared trajectory as a directory of .npy files
+
+    The prepared trajectory is either an array, or an object (like
+    RMSD.TheoData) whose attributes are arrays and small picklable values.
+    """
+    os.mkdir(path)
+    if isinstance(prepared, np.ndarray):
+        np.save(os.path.join(path, 'prepared.npy'), prepared)
+        meta = None
+    else:
+        attrs = {}
+        for name, value in vars(prepared).iteritems():
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                np.save(os.path.join(path, name + '.npy'), value)
+                value = None
+            attrs[name] = value
+        meta = (type(prepared), attrs)
+
+    with open(os.path.join(path, 'meta.pickl'), 'wb') as f:
+        pickle.dump(meta, f, 2)
+
+
+def _load(path):
+    "Memory-map a prepared trajectory saved by _dump"
+    with open(os.path.join(path, 'meta.pickl'), 'rb') as f:
+        meta = pickle.load(f)
+
+    if meta is None:
+        return np.load(os.path.join(path, 'prepared.npy'), mmap_mode='c')
+
+    cls, attrs = meta
+    prepared = cls.__new__(cls)
+    for name, value in attrs.iteritems():
+        if value is None and os.path.exists(os.path.join(path, name + '.npy')):
+            value = np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+        setattr(prepared, name, value)
+    return prepared
+
+
+def cached(segment_key, build, directory=None):
+    """Get a prepared trajectory from shared memory, building it first if no
+    other process on this node has yet
+
+    Parameters
+    ----------
+    segment_key : str
+        identifies the contents, see key()
+    build : callable
+        called with no arguments to make the prepared trajectory (or any
+        array), if it's not there yet. Only one process on the node calls it
+    directory : str, optional
+        where to keep the segments. Defaults to DIRECTORY
+
+    Returns
+    -------
+    prepared : np.ndarray or object
+        with its arrays memory-mapped from the segment
+    """
+    if directory is None:
+        directory = DIRECTORY
+    path = os.path.join(directory, PREFIX + segment_key)
+
+    if not os.path.exists(path):
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # someone else may have made it while we waited for the lock
+                if not os.path.exists(path):
+                    # write it somewhere else first, so that a segment that
+                    # exists is always complete
+                    tmp = '%s.tmp-%d' % (path, os.getpid())
+                    try:
+                        _dump(build(), tmp)
+                        os.rename(tmp, path)
+                    except:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                        raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return _load(path)
+
+
+def remove(segment_keys, directory=None):
+    """Remove some segments, e.g. the ones used by a run that's over.
+    Processes that still have them mapped keep working
+
+    Returns
+    -------
+    n_removed : int
+    """
+    if directory is None:
+        directory = DIRECTORY
+    n_removed = 0
+    for segment_key in segment_keys:
+        path = os.path.join(directory, PREFIX + segment_key)
+        try:
+            shutil.rmtree(path)
+            n_removed += 1
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            os.unlink(path + '.lock')
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return n_removed
+
+
+def clear(directory=None):
+    """Remove all of the segments in a directory. Processes that still have
+    them mapped keep working; the memory is released when they're done.
+
+    Returns
+    -------
+    n_removed : int
+    """
+    if directory is None:
+        directory = DIRECTORY
+    n_removed = 0
+    for name in os.listdir(directory):
+        if not name.startswith(PREFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                n_removed += 1
+            else:
+                os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return n_removed
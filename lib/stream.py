@@ -0,0 +1,145 @@
+"""
+Assign from Python, getting the results as they complete
+
+AssignParallel.py writes the results to Assignments.h5 and exits, so
+whatever comes next has to read the whole file back. assign_iter does the
+same assignment from within a Python program, and yields the results for
+each run of frames as soon as it's been assigned, so that they can be
+consumed incrementally (e.g. counting transitions while the rest is still
+being assigned). The results can also be saved to the containers on the way.
+"""
+import numpy as np
+
+from msmbuilder.parallel_assign import local, remote, multiproc, kernels
+
+
+def _results(vtrajs, gens_fn, conf_fn, metric, n_procs, client, options):
+    "The results of remote.assign for each vtraj, as they complete"
+    try:
+        if client is not None:
+            from msmbuilder.parallel_assign import collect, schedule
+
+            fingerprints = client[:].apply_sync(remote.warm, gens_fn,
+                conf_fn, metric, options['pruned'], options['gens_start'],
+                options['shared'], options['index'])
+            if len(set(fingerprints)) != 1:
+                raise RuntimeError('The engines disagree about the metric')
+
+            scheduler = schedule.Scheduler(client,
+                collect.ResultCollector(client), remote.assign,
+                (gens_fn, metric, options['pruned'], options['gens_start'],
+                 options['prefetch'], remote.PREFETCH_BLOCK,
+                 options['shared'], options['index'], options['features']))
+            for result, _ in scheduler.run(vtrajs):
+                yield result
+        elif n_procs == 1:
+            for vtraj in vtrajs:
+                yield remote.assign(vtraj, gens_fn, metric, **options)
+        else:
+            for result in multiproc.assign(vtrajs, gens_fn, conf_fn, metric,
+                                           n_procs, options):
+                yield result
+    finally:
+        # also when the caller stops early, or a task fails
+        if options['shared']:
+            gens_sets = [(gens_fn, metric, options['pruned'],
+                          options['gens_start'], options['index'])]
+            if client is not None:
+                client[:].apply_sync(remote.release_shared, gens_sets)
+            else:
+                remote.release_shared(gens_sets)
+
+
+def assign_iter(project, gens_fn, metric, chunk_size=1000, n_procs=1,
+                client=None, output_dir=None, layout='dense', pruned=False,
+                prefetch=0, index=False, shared=False, features=None):
+    """Assign the frames of a project to generators, yielding the results as
+    they complete
+
+    The frames are partitioned into vtrajs of chunk_size frames (see
+    local.partition) and assigned with remote.assign, in this process, in a
+    pool of processes on this machine, or on the engines of an
+    IPython.parallel cluster. The results come in no particular order.
+
+    Parameters
+    ----------
+    project : msmbuilder.Project
+    gens_fn : str
+        path to the generators
+    metric : msmbuilder.metrics.AbstractDistanceMetric
+    chunk_size : int
+        number of frames per task
+    n_procs : int
+        number of processes on this machine. With 1, the frames are
+        assigned in this process. None is one per core
+    client : IPython.parallel.Client, optional
+        assign on the engines of this client instead
+    output_dir : str, optional
+        also save the results to Assignments.h5 and Assignments.h5.distances
+        in this directory, like AssignParallel.py. If they already hold some
+        results, only the frames that are missing are assigned (and yielded)
+    layout : {'dense', 'ragged'}
+        layout of the containers, if they're created
+    pruned, prefetch, index, shared, features
+        see remote.assign
+
+    Yields
+    ------
+    traj_index : int
+    start, stop : int
+        the frames of trajectory traj_index that the results are for
+    assignments : np.ndarray
+        the index of the generator each of the frames is assigned to
+    distances : np.ndarray
+        the distance from each of the frames to that generator
+
+    Examples
+    --------
+    >>> counts = collections.defaultdict(int)
+    >>> for traj, start, stop, a, d in assign_iter(project, 'Gens.lh5', metric):
+    ...     for i, j in zip(a[:-1], a[1:]):
+    ...         counts[i, j] += 1
+    """
+    # as in AssignParallel.py, pruning is only done with metrics that it's
+    # valid for, and not with the index, since it needs n_gens**2 distances
+    pruned = pruned and kernels.is_true_metric(metric) and \
+        not (index and kernels.minkowski_p(metric) is not None)
+    options = {'pruned': pruned, 'gens_start': 0, 'prefetch': prefetch,
+               'shared': shared, 'index': index, 'features': features}
+    vtrajs = local.partition(project, chunk_size)
+
+    saver = None
+    if output_dir is not None:
+        gens_hashes = local.generator_hashes(gens_fn)
+        f_assignments, f_distances = local.setup_containers(output_dir,
+            project, vtrajs, gens_hashes, layout, chunk_size=chunk_size)
+        saver = local.Saver(f_assignments, f_distances, flush_every=16)
+        try:
+            local.check_generators(f_assignments, gens_hashes)
+            completed = local.completed_frames(f_assignments)
+        except:
+            f_assignments.close()
+            f_distances.close()
+            raise
+        if np.any(completed):
+            vtrajs = local.partition(project, chunk_size, completed=completed)
+
+    results = _results(vtrajs, gens_fn, project['ConfFilename'], metric,
+                       n_procs, client, options)
+    try:
+        for assignments, distances, vtraj, _ in results:
+            if saver is not None:
+                saver.save(assignments, distances, vtraj)
+
+            offset = 0
+            for traj, start, stop in vtraj:
+                end = offset + stop - start
+                yield (traj, start, stop, assignments[offset:end],
+                       distances[offset:end])
+                offset = end
+    finally:
+        results.close()
+        if saver is not None:
+            saver.flush()
+            f_assignments.close()
+            f_distances.close()
@@ -1,8 +1,122 @@
+import os
+import time
 from hashlib import sha1
 import numpy
 import tables
 from msmbuilder import Trajectory
-from msmbuilder.Trajectory import _ConvertFromLossyIntegers
+
+# lh5 files store the coordinates as integers, in units of 1/LOSSY_PRECISION
+# nm. This is the same as in msmbuilder.Trajectory._ConvertFromLossyIntegers
+LOSSY_PRECISION = 1000
+
+
+class HandlePool(object):
+    """A least-recently-used pool of open (read-only) trajectory files
+    
+    Opening an HDF5 file is expensive compared to reading a chunk of frames
+    from it, especially over a network filesystem, so workers keep the files
+    they've read from recently open. A handle is reopened if the file has
+    changed on disk since it was opened.
+    
+    Attributes
+    ----------
+    n_opened : int
+        number of times a file was opened
+    bytes_read : int
+        number of bytes of coordinates read through the pool's handles (see
+        VTraj.load_xyz)
+    open_time : float
+        seconds spent opening files
+    read_time, decode_time : float
+        seconds spent reading the lossy integers from the files, and
+        converting them to coordinates (see VTraj.load_xyz)
+    """
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self.n_opened = 0
+        self.bytes_read = 0
+        self.open_time = 0.0
+        self.read_time = 0.0
+        self.decode_time = 0.0
+        # filename -> (handle, (mtime, size) when opened)
+        self._handles = {}
+        # filenames, least recently used first
+        self._order = []
+        
+    def __len__(self):
+        return len(self._handles)
+        
+    def get(self, filename):
+        """Get an open handle to `filename`
+        
+        Returns
+        -------
+        handle : tables.File
+            The handle belongs to the pool -- don't close it.
+        """
+        stat = os.stat(filename)
+        identity = (stat.st_mtime, stat.st_size)
+        
+        if filename in self._handles:
+            handle, opened_identity = self._handles[filename]
+            if opened_identity == identity:
+                self._order.remove(filename)
+                self._order.append(filename)
+                return handle
+            self._close(filename)
+        
+        start = time.time()
+        handle = tables.openFile(filename, mode='r')
+        self.open_time += time.time() - start
+        self.n_opened += 1
+        self._handles[filename] = (handle, identity)
+        self._order.append(filename)
+        while len(self._order) > self.max_open:
+            self._close(self._order[0])
+        return handle
+    
+    def _close(self, filename):
+        handle, _ = self._handles.pop(filename)
+        self._order.remove(filename)
+        handle.close()
+        
+    def close(self):
+        "Close all of the handles in the pool"
+        for filename in list(self._order):
+            self._close(filename)
+
+
+class CoordinateBuffer(object):
+    """A grow-only float32 buffer for XYZ coordinates
+    
+    Once the buffer has grown to fit the largest vtraj, loading doesn't
+    allocate any more memory for the coordinates.
+    """
+    def __init__(self):
+        self._data = numpy.zeros(0, dtype=numpy.float32)
+    
+    def get(self, n_frames, n_atoms):
+        """Get an (uninitialized) array of shape (n_frames, n_atoms, 3)
+        
+        The array is a view into the buffer, so it's only valid until the
+        next call to get()
+        """
+        size = n_frames * n_atoms * 3
+        if size > len(self._data):
+            self._data = numpy.empty(size, dtype=numpy.float32)
+        return self._data[:size].reshape(n_frames, n_atoms, 3)
+
+
+# default pools for VTraj.load, one per worker process
+HANDLES = HandlePool()
+BUFFER = CoordinateBuffer()
+
+
+# a row of a partition plan: frames start:stop of trajectory traj, which are
+# part of vtraj number vtraj
+PLAN_DTYPE = numpy.dtype([('vtraj', numpy.int64), ('traj', numpy.int64),
+                          ('start', numpy.int64), ('stop', numpy.int64)])
+
 
 class Chunk(object):
     def __init__(self, traj, start, stop):
@@ -27,38 +141,51 @@ class VTraj(object):
     of a physical trajectory, and itself is represented by the index of the
     physical trajectory, and a starting ending index (of where) the slice is
     
+    The chunks are stored as rows of PLAN_DTYPE. The VTrajs of a VTrajPlan
+    are views of its rows, which are copied if the VTraj is appended to.
+    
     The VTraj provides a load() method to load the frames from disk.
     
     """
 
     def __init__(self, project, *args):
-        self.chunks = []
+        self.rows = numpy.zeros(0, dtype=PLAN_DTYPE)
         self.project = project
+        # position in the list of vtrajs the project was partitioned into
+        self.index = None
         
         for arg in args:
-            if isinstance(arg, tuple):
-                self.append(Chunk(*arg))
-            elif isinstance(arg, Chunk):
-                self.append(arg)
-            else:
-                raise TypeError()
+            self.append(arg)
+    
+    @classmethod
+    def view(cls, project, rows, index):
+        "A VTraj of the given rows (not copied)"
+        vtraj = cls(project)
+        vtraj.rows = rows
+        vtraj.index = index
+        return vtraj
             
     def __repr__(self):
         return str(self.chunks)
     
     def append(self, arg):
-        if isinstance(arg, tuple):
-            self.chunks.append(Chunk(*arg))
-        elif isinstance(arg, Chunk):
-            self.chunks.append(arg)
-        else:
+        if isinstance(arg, Chunk):
+            arg = tuple(arg)
+        elif not isinstance(arg, tuple) or len(arg) != 3:
             raise TypeError()
+        index = -1 if self.index is None else self.index
+        row = numpy.array([(index,) + arg], dtype=PLAN_DTYPE)
+        self.rows = numpy.concatenate([self.rows, row])
+    
+    @property
+    def chunks(self):
+        return [Chunk(*e) for e in self.canonical()]
     
     def __iter__(self):
-        return (e for e in self.chunks)
+        return (Chunk(*e) for e in self.canonical())
     
     def __len__(self):
-        return sum(len(e) for e in self.chunks)
+        return int(numpy.sum(self.rows['stop'] - self.rows['start']))
         
     def hash(self):
         """Unique identifier of VTraj
@@ -71,9 +198,77 @@ class VTraj(object):
         hash : str
             A unique identifier (sha1 hash)
         """
-        return sha1(str([str(e) for e in self.chunks])).hexdigest()
+        return _hash(self.canonical())
+        
+    def split(self, n_frames):
+        """Split into consecutive VTrajs of at most n_frames each
+        
+        Returns
+        -------
+        blocks : list
+            list of VTrajs, which together contain the same frames, in the same
+            order, as this one
+        """
+        blocks = [VTraj(self.project)]
+        for trj_i, start, stop in self.canonical():
+            while start < stop:
+                room = n_frames - len(blocks[-1])
+                if room == 0:
+                    blocks.append(VTraj(self.project))
+                    room = n_frames
+                end = min(stop, start + room)
+                blocks[-1].append((trj_i, start, end))
+                start = end
+        return blocks
+        
+    def load_xyz(self, n_atoms, handles=None, buffer=None):
+        """Load just the XYZ coordinates from disk
+        
+        Parameters
+        ----------
+        n_atoms : int
+            number of atoms in each frame
+        handles : HandlePool, optional
+            Pool of open trajectory files to read from. Defaults to the
+            module-level pool, HANDLES
+        buffer : CoordinateBuffer, optional
+            Buffer to decode the coordinates into. Defaults to the
+            module-level buffer, BUFFER
+        
+        Returns
+        -------
+        xyzlist : np.ndarray, shape=[len(self), n_atoms, 3], dtype=float32
+            A view into `buffer`, so it's only valid until the buffer is
+            reused
+        """
+        if handles is None:
+            handles = HANDLES
+        if buffer is None:
+            buffer = BUFFER
+        
+        xyzlist = buffer.get(len(self), n_atoms)
+        last_frame = 0
+        
+        for trj_i, start, stop in self.canonical():
+            f = handles.get(self.project.GetTrajFilename(trj_i))
+            
+            read_start = time.time()
+            lossy = f.root.XYZList[start:stop]
+            decode_start = time.time()
+            
+            # decode the lossy integers into the buffer, which is equivalent
+            # to _ConvertFromLossyIntegers without the float temporary
+            frames = xyzlist[last_frame:last_frame + stop - start]
+            frames[...] = lossy
+            frames /= LOSSY_PRECISION
+            handles.read_time += decode_start - read_start
+            handles.decode_time += time.time() - decode_start
+            handles.bytes_read += lossy.nbytes
+            last_frame += len(frames)
+        
+        return xyzlist
         
-    def load(self, conf):
+    def load(self, conf, handles=None, buffer=None):
         """Load the coordinates and get a physical trajectory
         
         The filename to load from is taken from the project file.
@@ -84,28 +279,18 @@ class VTraj(object):
             When we load the trajectories from disk, at this point we're only
             getting the XYZ coordinates. The XYZ coordinates will be injected
             into conf as a "container"
+        handles : HandlePool, optional
+        buffer : CoordinateBuffer, optional
+            see load_xyz
             
         Returns
         -------
         traj : msmbuilder.Trajectory
-            This is `conf`, with the XYZ coordinates loaded from disk
+            This is `conf`, with the XYZ coordinates loaded from disk. Like
+            conf itself, the coordinates are reused by the next call to load()
         """
-        n_atoms = conf.GetNumberOfAtoms()
-        
-        xyzlist = numpy.zeros((len(self), n_atoms, 3), dtype=numpy.float32)
-        last_frame = 0
-        
-        for trj_i, start, stop in self.chunks:
-            f = tables.File(self.project.GetTrajFilename(trj_i))
-            frames = _ConvertFromLossyIntegers(f.root.XYZList[start:stop], 1000)
-            
-            xyzlist[last_frame:last_frame + len(frames), :, :] = frames
-            last_frame += len(frames)
-            
-            f.close()
-            
-        conf['XYZList'] = xyzlist
-        
+        conf['XYZList'] = self.load_xyz(conf.GetNumberOfAtoms(), handles,
+                                        buffer)
         return conf
         
     def canonical(self):
@@ -118,4 +303,79 @@ class VTraj(object):
             tuples.
         """
         
-        return list(tuple(e) for e in self)
+        return zip(self.rows['traj'].tolist(), self.rows['start'].tolist(),
+                   self.rows['stop'].tolist())
+
+
+def _hash(chunks):
+    "VTraj.hash of a list of (traj, start, stop) tuples"
+    return sha1(str([str(e) for e in chunks])).hexdigest()
+
+
+class VTrajPlan(object):
+    """The VTrajs that a project is partitioned into, as one array
+    
+    Instead of a VTraj object with a list of Chunk objects for each vtraj, the
+    partition is one structured array of PLAN_DTYPE rows, sorted by vtraj,
+    which takes 32 bytes per chunk and is built with vectorized operations
+    (see local.partition). Indexing or iterating over the plan gives VTrajs
+    that are views of its rows, with plan[i].index == i.
+    
+    Parameters
+    ----------
+    project : msmbuilder.Project
+    rows : np.ndarray, dtype=PLAN_DTYPE
+        the chunks, sorted by vtraj, which are numbered from 0
+    """
+    def __init__(self, project, rows):
+        self.project = project
+        self.rows = rows
+        n = int(rows['vtraj'][-1]) + 1 if len(rows) > 0 else 0
+        # vtraj i is rows[bounds[i]:bounds[i+1]]
+        self.bounds = numpy.searchsorted(rows['vtraj'], numpy.arange(n + 1))
+    
+    @classmethod
+    def from_vtrajs(cls, project, vtrajs):
+        "The plan of a list of VTrajs, numbered in order"
+        if isinstance(vtrajs, cls):
+            return vtrajs
+        if len(vtrajs) == 0:
+            return cls(project, numpy.zeros(0, dtype=PLAN_DTYPE))
+        rows = numpy.concatenate([vtraj.rows for vtraj in vtrajs])
+        rows['vtraj'] = numpy.repeat(numpy.arange(len(vtrajs)),
+                                     [len(vtraj.rows) for vtraj in vtrajs])
+        return cls(project, rows)
+    
+    def __repr__(self):
+        return 'VTrajPlan(%d vtrajs, %d chunks)' % (len(self), len(self.rows))
+    
+    def __len__(self):
+        return len(self.bounds) - 1
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('vtraj index out of range')
+        return VTraj.view(self.project,
+                          self.rows[self.bounds[i]:self.bounds[i + 1]], i)
+    
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)))
+    
+    def lengths(self):
+        "Number of frames in each vtraj"
+        if len(self) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.add.reduceat(self.rows['stop'] - self.rows['start'],
+                                  self.bounds[:-1])
+    
+    def hashes(self):
+        "VTraj.hash() of each vtraj, without making the VTrajs"
+        chunks = zip(self.rows['traj'].tolist(), self.rows['start'].tolist(),
+                     self.rows['stop'].tolist())
+        bounds = self.bounds.tolist()
+        return [_hash(chunks[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
-import sys, os
+import sys, os, datetime
+import cPickle as pickle
+import multiprocessing
 import numpy as np
 import logging
 import IPython as ip
@@ -10,7 +12,9 @@ from msmbuilder.scripts.Cluster import add_argument, construct_metric
 from msmbuilder import metrics
 from msmbuilder import Project
 
-from msmbuilder.parallel_assign import remote, local
+from msmbuilder.parallel_assign import remote, local, kernels, collect, multiproc
+from msmbuilder.parallel_assign import schedule, report, adaptive
+from msmbuilder.parallel_assign.features import FeatureCache
 
 def setup_logger(console_stream=sys.stdout):
     """
@@ -26,15 +30,247 @@ def setup_logger(console_stream=sys.stdout):
     return logger
 
 
+def generator_sets(args, metric):
+    """The sets of generators to assign to, from the -g options
+    
+    Each -g is the path to a generators file, optionally followed by a colon
+    and the path to a pickled metric to use for that set. The others use
+    `metric`, from the command line.
+    
+    Returns
+    -------
+    gens_sets : list
+        (absolute path to the generators, metric) for each set
+    """
+    specs = args.generators
+    if isinstance(specs, basestring):
+        specs = [specs]
+    
+    gens_sets = []
+    for spec in specs:
+        gens_fn, set_metric = spec, metric
+        if ':' in spec:
+            gens_fn, metric_fn = spec.rsplit(':', 1)
+            with open(metric_fn, 'rb') as f:
+                set_metric = pickle.load(f)
+        if not os.path.exists(gens_fn):
+            raise IOError('Could not open generators %s' % gens_fn)
+        gens_sets.append((os.path.abspath(gens_fn), set_metric))
+    return gens_sets
+
+
+def set_output_dirs(output_dir, generators):
+    """Where to save the results for each set of generators
+    
+    With one set, that's output_dir. With several, each set gets a
+    subdirectory of it, named after the path to its generators from the
+    directory they all have in common, e.g. Data/k100/Gens.lh5 and
+    Data/k200/Gens.lh5 are saved to OUTPUT_DIR/k100_Gens and
+    OUTPUT_DIR/k200_Gens.
+    """
+    output_dir = os.path.abspath(output_dir)
+    if len(generators) == 1:
+        return [output_dir]
+    
+    parts = [os.path.splitext(fn)[0].split(os.sep) for fn in generators]
+    n_common = 0
+    while all(len(e) > n_common + 1 and e[n_common] == parts[0][n_common]
+              for e in parts):
+        n_common += 1
+    names = ['_'.join(e[n_common:]) for e in parts]
+    if len(set(names)) != len(names):
+        raise ValueError('Each set of generators needs its own generators '
+                         'file')
+    return [os.path.join(output_dir, name) for name in names]
+
+
 def main(args, logger):
-    metric = construct_metric(args)
+    gens_sets = generator_sets(args, construct_metric(args))
+    generators = [gens_fn for gens_fn, _ in gens_sets]
+    output_dirs = set_output_dirs(args.output_dir, generators)
     
     project = Project.LoadFromHDF(args.project)
-    if not os.path.exists(args.generators):
-        raise IOError('Could not open generators')
-    generators = os.path.abspath(args.generators)
-    output_dir = os.path.abspath(args.output_dir)
+    pruned = getattr(args, 'pruned', False)
+    incremental = getattr(args, 'incremental', False)
+    prefetch = getattr(args, 'prefetch', 0)
+    shared = getattr(args, 'shared_gens', False)
+    if pruned and not all(kernels.is_true_metric(metric)
+                          for _, metric in gens_sets):
+        raise ValueError('Pruned assignment requires a metric that obeys the '
+                         'triangle inequality')
+    index = getattr(args, 'index', False)
+    
+    # (gens_fn, metric, pruned, index) for each set. the index is only used
+    # where the metric allows it, and then pruning isn't
+    set_options = []
+    for gens_fn, metric in gens_sets:
+        set_index = index and kernels.minkowski_p(metric) is not None
+        if index and not set_index:
+            logger.info("The metric for %s can't be searched with an index; "
+                        "computing all of the distances", gens_fn)
+        elif set_index and pruned:
+            # the index is faster, and pruning needs n_gens**2 distances
+            logger.info('Using the index instead of pruning for %s', gens_fn)
+        set_options.append((gens_fn, metric, pruned and not set_index,
+                            set_index))
+    
+    # partition the frames into a bunch of vtrajs
+    cost_model = None
+    if getattr(args, 'balance', False):
+        cost_model = local.measure_costs(project, generators[0],
+                                         gens_sets[0][1])
+        logger.info('Measured costs (seconds): %s', cost_model)
+    all_vtrajs = local.partition(project, args.chunk_size, cost_model)
+    
+    # initialze the containers to save to disk, a pair for each set of
+    # generators
+    layout = getattr(args, 'layout', 'dense')
+    if not os.path.exists(os.path.abspath(args.output_dir)):
+        os.makedirs(os.path.abspath(args.output_dir))
+    containers = []
+    task_sets = []
+    n_gens = []
+    for (gens_fn, metric, set_pruned, set_index), output_dir in \
+            zip(set_options, output_dirs):
+        gens_hashes = local.generator_hashes(gens_fn)
+        f_assignments, f_distances = local.setup_containers(output_dir,
+            project, all_vtrajs, gens_hashes, layout,
+            extend=getattr(args, 'append', False),
+            chunk_size=args.chunk_size)
+        
+        # in incremental mode, only the generators from gens_start on are new
+        gens_start = 0
+        if incremental:
+            gens_start = local.start_incremental(f_assignments, gens_hashes)
+            logger.info('%s: %d new generators', gens_fn,
+                        len(gens_hashes) - gens_start)
+        else:
+            local.check_generators(f_assignments, gens_hashes)
+        
+        containers.append((f_assignments, f_distances, gens_start))
+        task_sets.append((gens_fn, metric, set_pruned, gens_start, set_index))
+        n_gens.append(len(gens_hashes))
+    
+    # the sets that are already complete (or have no new generators) are
+    # left out, so their frames aren't assigned again for the others
+    bitmaps = [local.completed_frames(f_assignments)
+               for f_assignments, _, _ in containers]
+    active = [k for k, (_, _, gens_start) in enumerate(containers)
+              if gens_start < n_gens[k] and not np.all(bitmaps[k])]
+    for k in range(len(containers)):
+        if k not in active:
+            logger.info('%s: already complete', task_sets[k][0])
+    task_sets = [task_sets[k] for k in active]
+    active_containers = [containers[k] for k in active]
     
+    # partition the frames that have not been computed yet, for any of the
+    # sets. they don't have to be partitioned the same way as the last time
+    if active:
+        completed = np.logical_and.reduce([bitmaps[k] for k in active])
+    else:
+        completed = np.ones_like(bitmaps[0])
+    n_remaining = len(completed) - np.count_nonzero(completed)
+    
+    # the vtrajs are run in rounds, given the number of engines: a single
+    # round normally, or with an adaptive chunk size, a round of probes and
+    # then the rest
+    plan = None
+    if getattr(args, 'adaptive', False):
+        plan = adaptive.AdaptivePlan(project, completed, args.target_time,
+                                     cost_model)
+        rounds = plan.rounds
+        logger.info('%d/%d frames remaining, in chunks sized to take %gs',
+                    n_remaining, len(completed), args.target_time)
+    else:
+        if np.any(completed):
+            remaining_vtrajs = local.partition(project, args.chunk_size,
+                                               cost_model, completed)
+        else:
+            remaining_vtrajs = all_vtrajs
+        
+        # hand out the biggest jobs first, so the engines finish together
+        remaining_vtrajs = local.largest_first(remaining_vtrajs, cost_model)
+        rounds = lambda n_engines: [remaining_vtrajs]
+        logger.info('%d/%d frames remaining, in %d jobs', n_remaining,
+                    len(completed), len(remaining_vtrajs))
+    
+    # the prepared frames are kept on disk for the next run, if asked
+    feature_cache = getattr(args, 'feature_cache', None)
+    features = None
+    if feature_cache is not None:
+        features = FeatureCache(feature_cache, int(1024 ** 3 *
+            getattr(args, 'feature_cache_size', 10.0)))
+    
+    options = {'prefetch': prefetch, 'shared': shared, 'features': features}
+    backend = getattr(args, 'backend', 'ipython')
+    run_report = report.RunReport(n_remaining, {
+        'backend': backend, 'metric': args.metric, 'chunk_size': args.chunk_size,
+        'adaptive': plan is not None, 'generators': generators,
+        'n_gens': n_gens,
+        'options': dict(options, pruned=pruned, index=index,
+                        incremental=incremental, features=feature_cache),
+        'OMP_NUM_THREADS': os.environ.get('OMP_NUM_THREADS')})
+    if backend == 'local':
+        results = run_local(args, logger, rounds, task_sets,
+                            project['ConfFilename'], options, run_report)
+    else:
+        results = run_ipython(args, logger, rounds, task_sets,
+                              project['ConfFilename'], options, run_report)
+    
+    writers = []
+    for f_assignments, f_distances, gens_start in active_containers:
+        saver = local.Saver(f_assignments, f_distances,
+                            flush_every=getattr(args, 'flush_every', 16))
+        writers.append(local.AsyncWriter(saver,
+            flush_interval=getattr(args, 'flush_interval', 10.0)))
+    
+    for assignments, distances, chunk, stats in results:
+        for writer, a, d, (_, _, gens_start) in zip(writers, assignments,
+                distances, active_containers):
+            writer.put(a, d, chunk, merge=gens_start > 0)
+        if plan is not None:
+            plan.observe(stats)
+    
+    for writer in writers:
+        writer.close()
+    run_report.finish()
+    if plan is not None and plan.chunk_size is not None:
+        run_report.info['chunk_size'] = plan.chunk_size
+    for f_assignments, f_distances, _ in containers:
+        if incremental:
+            local.finish_incremental(f_assignments)
+        f_assignments.close()
+        f_distances.close()
+    
+    if getattr(args, 'export_dense', False):
+        for output_dir in output_dirs:
+            for fn in ['Assignments.h5', 'Assignments.h5.distances']:
+                local.export_dense(os.path.join(output_dir, fn),
+                    os.path.join(output_dir, fn.replace('.h5', '.dense.h5')))
+        logger.info('Exported the results to the dense format')
+    
+    if plan is not None and plan.chunk_size is not None:
+        logger.info('Adaptive chunk size: %d frames (%.3gs overhead per task, '
+                    '%.3gs per frame)', plan.chunk_size, plan.overhead,
+                    plan.per_frame)
+    log_totals(logger, run_report, pruned)
+    log_engines(logger, run_report)
+    prefix = os.path.join(os.path.abspath(args.output_dir),
+                          'Assignments.h5.report')
+    run_report.write(prefix)
+    logger.info('Wrote a performance report to %s.json and %s.csv', prefix,
+                prefix)
+    logger.info('All done, exiting.')
+
+def run_ipython(args, logger, rounds, gens_sets, conf_fn, options,
+                run_report):
+    """Assign vtrajs on the IPython.parallel engines
+    
+    This is a generator, which yields the results of remote.assign_sets as
+    they come back from the engines, after adding their stats to
+    `run_report`. `rounds(n_engines)` gives the lists of vtrajs to run, one
+    after the other.
+    """
     # connect to the workers
     try:
         json_file = client_json_file(args.profile, args.cluster_id)
@@ -45,55 +281,150 @@ def main(args, logger):
         msg += "(hint, use ipcluster start)"
         print >> sys.stderr, msg
         sys.exit(1)
+    
+    # get the workers to load the generators once up front. the tasks still
+    # carry the metrics (which are small), so that engines that connect
+    # later, or are restarted, load them when their first task arrives
+    dview = client[:]
+    fingerprints = dview.apply_sync(remote.warm_sets, gens_sets, conf_fn,
+                                    options['shared'])
+    if len(set(tuple(e) for e in fingerprints)) != 1:
+        raise RuntimeError('The engines disagree about the metric')
+    
+    # get the workers going. the collector hooks into the client before any
+    # replies can arrive
+    collector = collect.ResultCollector(client)
+    for vtrajs in rounds(len(client.ids)):
+        scheduler = schedule.Scheduler(client, collector, remote.assign_sets,
+            (gens_sets, options['prefetch'], remote.PREFETCH_BLOCK,
+             options['shared'], options['features']),
+            speculate=getattr(args, 'speculate', False),
+            straggler_factor=getattr(args, 'straggler_factor', 3.0),
+            locality=getattr(args, 'locality', False))
+        n_jobs = len(vtrajs)
+        
+        for result, async in scheduler.run(vtrajs):
+            result[3]['serialize_time'] = report.transfer_time(async)
+            run_report.add(result[3], async.metadata.engine_id)
+            log_status(logger, scheduler.n_remaining, n_jobs, result[2].index,
+                       async, run_report)
+            yield result
+        
+        if scheduler.locality:
+            logger.info('%d chunks were stolen from other engines',
+                        scheduler.n_stolen)
         
-    lview = client.load_balanced_view()
+        if scheduler.n_resubmitted > 0:
+            logger.info('Resubmitted %d chunks from lost engines',
+                        scheduler.n_resubmitted)
+        if scheduler.n_duplicates > 0:
+            logger.info('Ran %d copies of straggling chunks, %d of which '
+                        'finished first', scheduler.n_duplicates,
+                        scheduler.n_duplicates_won)
     
-    # partition the frames into a bunch of vtrajs
-    all_vtrajs = local.partition(project, args.chunk_size)
+    if options['shared']:
+        # don't leave the prepared generators in the nodes' memory
+        n_removed = sum(dview.apply_sync(remote.release_shared, gens_sets))
+        logger.info('Removed %d shared memory segments', n_removed)
+
+
+def run_local(args, logger, rounds, gens_sets, conf_fn, options, run_report):
+    """Assign vtrajs in a pool of processes on this machine
+    
+    This is a generator, which yields the results of remote.assign_sets as
+    they complete, after adding their stats to `run_report`. The processes are
+    reported together, as engine 'local'. `rounds(n_procs)` gives the lists of
+    vtrajs to run, one after the other, each with a new pool.
+    """
+    n_procs = getattr(args, 'n_procs', None) or multiprocessing.cpu_count()
     
-    # initialze the containers to save to disk
-    f_assignments, f_distances = local.setup_containers(output_dir,
-        project, all_vtrajs)
+    for vtrajs in rounds(n_procs):
+        n_jobs = len(vtrajs)
+        results = multiproc.assign_sets(vtrajs, gens_sets, conf_fn, n_procs,
+                                        options)
+        for n_done, result in enumerate(results):
+            run_report.add(result[3], 'local')
+            logger.info('chunk %s; %s/%s remaining; %.0f frames/s; eta %s',
+                        result[2].index, n_jobs - n_done - 1, n_jobs,
+                        run_report.frames_per_second(), format_eta(run_report))
+            yield result
     
-    # get the chunks that have not been computed yet
-    valid_indices = np.where(f_assignments.root.completed_vtrajs[:] == False)[0]
-    remaining_vtrajs = np.array(all_vtrajs)[valid_indices].tolist()
+    if options['shared']:
+        remote.release_shared(gens_sets)
 
-    logger.info('%d/%d jobs remaining', len(remaining_vtrajs), len(all_vtrajs))
-    
-    # send the workers the files they need to get started
-    # dview.apply_sync(remote.load_gens, generators, project['ConfFilename'],
-    #    metric)
-    
-    # get the workers going
-    n_jobs = len(remaining_vtrajs)
-    amr = lview.map(remote.assign, remaining_vtrajs,
-                    [generators]*n_jobs, [metric]*n_jobs, chunksize=1)
-    
-    pending = set(amr.msg_ids)
-    
-    while pending:
-        client.wait(pending, 1e-3)
-        # finished is the set of msg_ids that are complete
-        finished = pending.difference(client.outstanding)
-        # update pending to exclude those that just finished
-        pending = pending.difference(finished)
-        for msg_id in finished:
-            # we know these are done, so don't worry about blocking
-            async = client.get_result(msg_id)
-            
-            assignments, distances, chunk = async.result[0]
-            vtraj_id = local.save(f_assignments, f_distances, assignments, distances, chunk)
-            
-            log_status(logger, len(pending), n_jobs, vtraj_id, async)
-                
-            
-    f_assignments.close()
-    f_distances.close()
+
+def log_totals(logger, run_report, pruned):
+    """At the end of a run, log the statistics returned by the engines,
+    summed over all the jobs
     
-    logger.info('All done, exiting.')
+    Parameters
+    ----------
+    logger : logging.Logger
+        logger to print to
+    run_report : report.RunReport
+        the stats of the run
+    pruned : bool
+        was pruned assignment used
+    """
+    totals = run_report.totals
+    if not totals:
+        return
+    
+    if pruned and totals['n_distances_exhaustive'] > 0:
+        logger.info('Pruning skipped %.1f%% of the distance evaluations',
+                    100 * (1 - float(totals['n_distances']) /
+                           totals['n_distances_exhaustive']))
+    
+    busy = totals['io_wait_time'] + totals['compute_time']
+    if busy > 0:
+        logger.info('Engines spent %.1fs loading frames and %.1fs computing; '
+                    'computation was blocked on I/O %.1f%% of the time',
+                    totals['io_time'], totals['compute_time'],
+                    100 * totals['io_wait_time'] / busy)
+    
+    if totals.get('n_cached_frames', 0) > 0:
+        logger.info('The prepared features of %d frames were taken from the '
+                    'feature cache (%.1fs)', totals['n_cached_frames'],
+                    totals['cache_time'])
+    
+    breakdown = run_report.breakdown()
+    logger.info('Time in the tasks: %s', ', '.join(
+        '%s %.1f%%' % (phase[:-len('_time')], 100 * breakdown[phase])
+        for phase in report.PHASES))
+    logger.info('Assigned %d frames in %.1fs (%.0f frames/s)',
+                run_report.n_done, run_report.elapsed,
+                run_report.frames_per_second())
+
 
-def log_status(logger, n_pending, n_jobs, job_id, async_result):
+def log_engines(logger, run_report):
+    """At the end of a run, log how fast each engine was, and how much it
+    read
+    
+    Parameters
+    ----------
+    logger : logging.Logger
+        logger to print to
+    run_report : report.RunReport
+        the stats of the run
+    """
+    rates = run_report.engine_rates()
+    for engine_id in sorted(run_report.engines):
+        engine = run_report.engines[engine_id]
+        logger.info('engine %s: %d chunks, %.0f frames/s, opened %d files, '
+                    'read %.1f MB', engine_id, engine['n_chunks'],
+                    rates[engine_id], engine.get('n_opened', 0),
+                    engine.get('bytes_read', 0) / 1e6)
+
+
+def format_eta(run_report):
+    "The estimated time of completion of a run, for the log"
+    eta = run_report.eta()
+    if eta is None:
+        return '?'
+    return datetime.datetime.fromtimestamp(eta).strftime('%I:%M %p')
+
+
+def log_status(logger, n_pending, n_jobs, job_id, async_result, run_report):
     """After a job has completed, log the status of the map to the console
     
     Parameters
@@ -109,24 +440,22 @@ def log_status(logger, n_pending, n_jobs, job_id, async_result):
     async_esult : IPython.parallel.client.asyncresult.AsyncMapResult
          the container with the job results. includes not only the output,
          but also metadata describing execution time, etc.
+    run_report : report.RunReport
+         the stats of the run so far, which the ETA is estimated from
     """
 
     if ip.release.version >= '0.13':
-        t_since_submit = async_result.completed - async_result.submitted
-        time_remaining = n_pending * (t_since_submit) / (n_jobs - n_pending)
         td  = (async_result.completed - async_result.started)
         #this is equivalent to the td.total_seconds() method, which was
         #introduced in python 2.7
         execution_time = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / float(10**6)
-        eta = (async_result.completed + time_remaining).strftime('%I:%M %p')
-
     else:
-        execution_time, eta = '?', '?'
-        
+        execution_time = '?'
             
-    logger.info('engine: %s; chunk %s; %ss; status: %s; %s/%s remaining; eta %s',
-                async_result.metadata.engine_id, job_id, execution_time,
-                async_result.status, n_pending, n_jobs, eta)
+    logger.info('engine: %s; chunk %s; %ss; status: %s; %s/%s remaining; '
+                '%.0f frames/s; eta %s', async_result.metadata.engine_id,
+                job_id, execution_time, async_result.status, n_pending, n_jobs,
+                run_report.frames_per_second(), format_eta(run_report))
 
 
 def setup_parser():
@@ -156,15 +485,100 @@ directly in C, and can thus fully leverage all of the cores on a single node."""
     
     add_argument(parser, '-p', dest='project', help='Path to ProjectInfo file.',
         default='ProjectInfo.h5')
-    add_argument(parser, '-g', dest='generators', help='''Output trajectory file containing
+    parser.add_argument('-g', dest='generators', help='''Output trajectory file containing
         the structures of each of the cluster centers. Note that for hierarchical clustering
-        methods, this file will not be produced.''', default='Data/Gens.lh5')
+        methods, this file will not be produced. Give -g more than once to assign to several
+        sets of generators in one pass, reading the trajectories only once. Each set's results
+        are then saved in its own subdirectory of OUTPUT_DIR, named after its generators file
+        (e.g. Data/k100/Gens.lh5 and Data/k200/Gens.lh5 go to OUTPUT_DIR/k100_Gens and
+        OUTPUT_DIR/k200_Gens). To use a different metric for a set, follow its generators file
+        with a colon and the path to the metric, pickled (GENS:METRIC); the others use the
+        metric given below. Default: Data/Gens.lh5''', action='append', default=None)
     add_argument(parser, '-o', dest='output_dir', help='Location to save results/checkpoint. ', default='Data/')
     add_argument(parser, '-c', dest='chunk_size', help='''Number of frames to processes per worker.
         Each chunk requires some communication overhead, so you should use relativly large chunks''',
         default=1000, type=int)
     add_argument(parser, '-P', dest='profile', help='IPython.parallel profile to use.', default='default')
     add_argument(parser, '-C', dest='cluster_id', help='IPython.parallel cluster_id to use', default='')
+    add_argument(parser, '--backend', dest='backend', help='''Where to run the assignment.
+        "ipython" uses the engines of an IPython.parallel cluster. "local" uses a pool of processes
+        on this machine, and doesn't need a controller or engines.''', default='ipython',
+        choices=['ipython', 'local'])
+    add_argument(parser, '-n', dest='n_procs', help='''Number of processes for the local backend.
+        Defaults to the number of cores. (You probably want to set OMP_NUM_THREADS=1)''',
+        default=None, type=int)
+    add_argument(parser, '--pruned', dest='pruned', help='''Use the triangle inequality to skip
+        generators that cannot be the closest. Gives the same assignments, but requires a metric
+        that obeys the triangle inequality (rmsd, or dihedral/contact with e.g. euclidean), and
+        n_gens**2 floats of memory on each engine''', action='store_true', default=False)
+    add_argument(parser, '--index', dest='index', help='''Find the closest generator with a
+        KD-tree over the generators, instead of computing the distance to every one of them. The
+        assignments are the same. Only for the dihedral and contact metrics with the euclidean,
+        cityblock, chebyshev or minkowski distance (other metrics ignore it), and it pays off when
+        there are many generators and not too many dihedrals or contacts.''',
+        action='store_true', default=False)
+    add_argument(parser, '--incremental', dest='incremental', help='''Update a completed
+        assignment in OUTPUT_DIR after new generators were appended to the generators file. Only
+        the distances to the new generators are computed.''', action='store_true', default=False)
+    add_argument(parser, '--append', dest='append', help='''Update the assignment in OUTPUT_DIR
+        after trajectories were added to the project, or existing ones got longer. The containers
+        are extended to the new lengths, and only the new frames are assigned.''',
+        action='store_true', default=False)
+    add_argument(parser, '--prefetch', dest='prefetch', help='''Number of blocks of frames each
+        engine loads ahead on a background thread, overlapping I/O with the distance computation.
+        0 disables prefetching.''', default=0, type=int)
+    add_argument(parser, '--balance', dest='balance', help='''Partition the frames by estimated
+        cost rather than by frame count. The cost of computing the distances and of opening and
+        reading the trajectory files is measured on a few samples before the run, and each chunk
+        is made to cost about as much as chunk_size frames from one trajectory, so chunks that
+        span many short trajectories get fewer frames.''', action='store_true', default=False)
+    add_argument(parser, '--adaptive', dest='adaptive', help='''Pick the chunk size from the
+        measured throughput instead of using chunk_size. A few small chunks are run on every engine
+        first, to estimate the time per frame and the overhead per task, and the rest of the frames
+        are then cut into chunks that take about TARGET_TIME seconds, getting smaller towards the
+        end of the run so that the engines finish together.''', action='store_true', default=False)
+    add_argument(parser, '--target-time', dest='target_time', help='''With --adaptive, how long
+        each chunk should take, in seconds''', default=60.0, type=float)
+    add_argument(parser, '--shared-gens', dest='shared_gens', help='''Prepare the generators once
+        per node, in shared memory (/dev/shm), instead of once per engine. All of the engines on a
+        node then use the same copy, which saves memory and startup time when there are many
+        engines per node. The shared memory is freed at the end of the run.''', action='store_true',
+        default=False)
+    add_argument(parser, '--feature-cache', dest='feature_cache', help='''Keep the frames, as
+        prepared by the metric, in this directory, and take them from there when the same frames
+        are assigned again with the same metric (e.g. to other generators), instead of reading
+        the trajectories and preparing them again. They're kept per slice of each trajectory, so
+        they're found whatever the chunk size. (With the rmsd metric, they're only found for chunks
+        of frames from a single stored slice.) The directory can be local to each node.''',
+        default=None)
+    add_argument(parser, '--feature-cache-size', dest='feature_cache_size', help='''The most
+        that the feature cache may take up, in GB. The least recently used frames are removed to
+        stay under it''', default=10.0, type=float)
+    add_argument(parser, '--layout', dest='layout', help='''Layout of the output containers.
+        "dense" is an (n_trajs, max_n_frames) array padded with -1. "ragged" concatenates the
+        trajectories, which avoids the padding when their lengths vary a lot.''',
+        default='dense', choices=local.LAYOUTS)
+    add_argument(parser, '--export-dense', dest='export_dense', help='''At the end of the run, also
+        write copies of the results in the legacy dense format (Assignments.dense.h5 and
+        Assignments.dense.h5.distances), e.g. for the ragged layout''',
+        action='store_true', default=False)
+    add_argument(parser, '--locality', dest='locality', help='''Give each trajectory an
+        affinity to one engine, so that each trajectory file is mostly read by one engine, which
+        keeps it open and cached. Engines that run out of their own chunks take chunks from the
+        others. The number of files opened and bytes read by each engine are logged at the
+        end.''', action='store_true', default=False)
+    add_argument(parser, '--speculate', dest='speculate', help='''Near the end of the run, when
+        no chunks are waiting for an engine, run a second copy of any chunk that has been running
+        for much longer than usual on an idle engine, and keep whichever finishes first. This
+        keeps a single slow node from holding up the whole run.''', action='store_true',
+        default=False)
+    add_argument(parser, '--straggler-factor', dest='straggler_factor', help='''With --speculate,
+        a chunk is copied once it has been running for this many times the median time of the
+        completed chunks''', default=3.0, type=float)
+    add_argument(parser, '--flush-every', dest='flush_every', help='''Flush the results to disk
+        and checkpoint them after this many chunks''', default=16, type=int)
+    add_argument(parser, '--flush-interval', dest='flush_interval', help='''Flush the results to
+        disk and checkpoint them at least this often (in seconds)''', default=10.0, type=float)
     
     metrics_parsers = parser.add_subparsers(dest='metric')
     rmsd = metrics_parsers.add_parser('rmsd',
@@ -236,6 +650,8 @@ directly in C, and can thus fully leverage all of the cores on a single node."""
         help="Path to pickle file for the metric")
     
     args = parser.parse_args()
+    if args.generators is None:
+        args.generators = ['Data/Gens.lh5']
     return args
 
 
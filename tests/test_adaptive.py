@@ -0,0 +1,43 @@
+import numpy as np
+import numpy.testing as npt
+from nose.tools import eq_
+
+from msmbuilder.parallel_assign import adaptive
+from msmbuilder.parallel_assign.adaptive import AdaptivePlan, fit_costs
+
+
+def test_fit_costs():
+    overhead, per_frame = fit_costs([10, 20, 40], [1.1, 1.2, 1.4])
+    npt.assert_almost_equal(overhead, 1.0)
+    npt.assert_almost_equal(per_frame, 0.01)
+    
+    # all the same size
+    eq_(fit_costs([10, 10], [1.0, 3.0]), (0.0, 0.2))
+
+
+def test_plan():
+    project = {'TrajLengths': [1000, 500]}
+    completed = np.zeros(1500, dtype=bool)
+    completed[:100] = True
+    plan = AdaptivePlan(project, completed, target_time=1.0,
+                        probe_sizes=(10, 40))
+    rounds = plan.rounds(2)
+    
+    probes = next(rounds)
+    eq_([len(e) for e in probes], [10, 10, 40, 40])
+    eq_(probes[0].canonical(), [(0, 100, 110)])
+    for vtraj in probes:
+        # 0.1s of overhead, 0.01s per frame
+        plan.observe({'n_frames': len(vtraj), 'task_time': 0.1 + 0.01 * len(vtraj)})
+    
+    vtrajs = next(rounds)
+    npt.assert_almost_equal(plan.per_frame, 0.01)
+    assert plan.overhead >= 0.1
+    assert abs(plan.chunk_size - 90) <= 1
+    assert max(len(e) for e in vtrajs) <= plan.chunk_size
+    
+    # everything is assigned once
+    frames = sum(len(e) for e in probes + vtrajs)
+    eq_(frames, 1400)
+    eq_(sorted(e.index for e in probes + vtrajs), range(len(probes) + len(vtrajs)))
+    assert plan.completed[100:200].all()
@@ -0,0 +1,52 @@
+from nose.tools import eq_
+
+from msmbuilder.parallel_assign.collect import ResultCollector
+
+
+class FakeClient(object):
+    "Stand-in for IPython.parallel.Client. Replies are delivered by spin()"
+    def __init__(self):
+        self.results = {}
+        self.incoming = []
+        self._queue_handlers = {'apply_reply': self._handle_apply_reply}
+
+    def _handle_apply_reply(self, msg):
+        self.results[msg['parent_header']['msg_id']] = None
+
+    def reply(self, msg_id):
+        return {'parent_header': {'msg_id': msg_id}}
+
+    def spin(self):
+        while self.incoming:
+            self._queue_handlers['apply_reply'](self.reply(self.incoming.pop(0)))
+
+
+def test_order():
+    client = FakeClient()
+    collector = ResultCollector(client)
+    collector.watch(['a', 'b', 'c'])
+    eq_(collector.n_pending, 3)
+    client.incoming = ['c', 'a', 'b']
+    eq_(list(collector), ['c', 'a', 'b'])
+    eq_(collector.n_pending, 0)
+
+
+def test_already_done():
+    client = FakeClient()
+    collector = ResultCollector(client)
+    client.results['a'] = None
+    collector.watch(['a', 'b'])
+    eq_(collector.next_completed(timeout=0.01), 'a')
+    eq_(collector.next_completed(timeout=0.01), None)
+
+
+def test_stranded():
+    # replies the client makes up for tasks on a dead engine bypass the
+    # handler table
+    client = FakeClient()
+    collector = ResultCollector(client)
+    collector.watch(['a', 'b'])
+    client._handle_apply_reply(client.reply('b'))
+    eq_(collector.next_completed(), 'b')
+    collector.forget('a')
+    eq_(list(collector), [])
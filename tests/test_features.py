@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+
+from msmbuilder import Trajectory, Project
+from msmbuilder import metrics
+from msmbuilder.parallel_assign import shared
+from msmbuilder.parallel_assign.features import FeatureCache
+from msmbuilder.parallel_assign.local import partition
+from msmbuilder.parallel_assign.vtraj import VTraj
+from common import fixtures_dir
+
+
+class test_feature_cache():
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.metric = metrics.Dihedral()
+        self.fingerprint = shared.metric_fingerprint(self.metric)
+        pdb_fn = os.path.join(fixtures_dir(), 'native.pdb')
+        self.conf = Trajectory.LoadTrajectoryFile(pdb_fn)
+        self.project = Project({'NumTrajs': 1, 'TrajLengths': [501], 'TrajFileBaseName': 'trj', 'TrajFileType': '.lh5',
+                           'ConfFilename': pdb_fn,
+                           'TrajFilePath': fixtures_dir()})
+        self.vtrajs = partition(self.project, chunk_size=100)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def prepare(self, vtraj):
+        return self.metric.prepare_trajectory(vtraj.load(self.conf))
+
+    def test_0(self):
+        # what's put in comes back memory-mapped
+        features = FeatureCache(os.path.join(self.directory, 'new'))
+        vtraj = self.vtrajs[0]
+        assert features.get(vtraj, self.fingerprint) is None
+
+        ptraj = self.prepare(vtraj)
+        features.put(vtraj, self.fingerprint, ptraj)
+        got = features.get(vtraj, self.fingerprint)
+        assert isinstance(got, np.memmap)
+        npt.assert_array_equal(got, ptraj)
+        assert len(features.entries()) == 1
+
+    def test_1(self):
+        # other frames, or another metric, are other entries
+        features = FeatureCache(self.directory)
+        features.put(self.vtrajs[0], self.fingerprint, self.prepare(self.vtrajs[0]))
+        assert features.get(self.vtrajs[1], self.fingerprint) is None
+        other = shared.metric_fingerprint(metrics.Dihedral(angles='phi'))
+        assert features.get(self.vtrajs[0], other) is None
+        assert features.clear() == 1
+        assert features.entries() == []
+
+    def test_2(self):
+        # the least recently used entries are removed to stay under max_bytes
+        ptrajs = [self.prepare(vtraj) for vtraj in self.vtrajs[:3]]
+        features = FeatureCache(self.directory, max_bytes=int(2.5 * ptrajs[0].nbytes))
+        for vtraj, ptraj in zip(self.vtrajs[:2], ptrajs):
+            features.put(vtraj, self.fingerprint, ptraj)
+        # in the order they were put in. (the times are set, since mtimes
+        # can have a resolution of a second or more)
+        for path, _ in features.entries():
+            t = int(os.path.basename(path).split('-')[0])
+            os.utime(path, (t, t))
+        assert features.get(self.vtrajs[0], self.fingerprint) is not None
+
+        features.put(self.vtrajs[2], self.fingerprint, ptrajs[2])
+        assert len(features.entries()) == 2
+        assert features.get(self.vtrajs[1], self.fingerprint) is None
+        assert features.get(self.vtrajs[0], self.fingerprint) is not None
+        assert features.get(self.vtrajs[2], self.fingerprint) is not None
+
+    def test_3(self):
+        # the frames are found however they're cut, from the stored slices
+        features = FeatureCache(self.directory)
+        for vtraj in self.vtrajs[:3]:
+            features.put(vtraj, self.fingerprint, self.prepare(vtraj))
+        for chunk in [(0, 30, 80), (0, 90, 210), (0, 0, 300)]:
+            vtraj = VTraj(self.project, chunk)
+            npt.assert_array_almost_equal(features.get(vtraj, self.fingerprint),
+                                          self.prepare(vtraj))
+        assert features.get(VTraj(self.project, (0, 250, 350)),
+                            self.fingerprint) is None
+
+        # and only the slices that aren't there yet are stored
+        features.put(self.vtrajs[0], self.fingerprint,
+                     self.prepare(self.vtrajs[0]))
+        assert len(features.entries()) == 3
+
+    def test_4(self):
+        # the entries are only all looked at when the cache is over its limit
+        features = FeatureCache(self.directory)
+        n_scans = []
+        entries = features.entries
+        features.entries = lambda: n_scans.append(1) or entries()
+        for vtraj in self.vtrajs:
+            features.put(vtraj, self.fingerprint, self.prepare(vtraj))
+        # (once to start the running total)
+        assert len(n_scans) == 1
@@ -0,0 +1,102 @@
+import numpy as np
+import numpy.testing as npt
+
+from msmbuilder.parallel_assign import kernels
+
+
+class EuclideanMetric(object):
+    "Minimal vectorized metric over plain arrays"
+    triangle_inequality = True
+
+    def one_to_all(self, ptraj1, ptraj2, index1):
+        return np.sqrt(np.sum((ptraj2 - ptraj1[index1])**2, axis=1))
+
+    def one_to_many(self, ptraj1, ptraj2, index1, indices2):
+        return self.one_to_all(ptraj1, ptraj2[indices2], index1)
+
+    def all_to_all(self, ptraj1, ptraj2):
+        diff = ptraj1[:, np.newaxis, :] - ptraj2[np.newaxis, :, :]
+        return np.sqrt(np.sum(diff**2, axis=2))
+
+
+class LoopOnlyMetric(EuclideanMetric):
+    "Metric that can't do tiles"
+    def all_to_all(self, ptraj1, ptraj2):
+        raise NotImplementedError
+
+
+class test_blocked():
+    def setup(self):
+        random = np.random.RandomState(0)
+        self.metric = EuclideanMetric()
+        self.ptraj = random.randn(103, 4)
+        self.pgens = random.randn(37, 4)
+
+    def test_0(self):
+        # tiles that don't evenly divide the frames or the generators
+        a0, d0 = kernels.exhaustive(self.metric, self.ptraj, self.pgens, 103)
+        a1, d1 = kernels.blocked(self.metric, self.ptraj, self.pgens, 103,
+                                 frame_block=10, gen_block=7)
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_almost_equal(d0, d1)
+
+    def test_1(self):
+        # ties are broken towards the lowest generator index, across blocks
+        pgens = np.vstack([self.pgens, self.pgens])
+        a, d = kernels.blocked(self.metric, self.ptraj, pgens, 103,
+                               frame_block=16, gen_block=5)
+        assert np.all(a < len(self.pgens))
+
+    def test_2(self):
+        # falls back to the frame by frame loop
+        metric = LoopOnlyMetric()
+        a0, d0 = kernels.exhaustive(self.metric, self.ptraj, self.pgens, 103)
+        a1, d1 = kernels.blocked(metric, self.ptraj, self.pgens, 103)
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_equal(d0, d1)
+
+
+class test_pruned():
+    def setup(self):
+        random = np.random.RandomState(1)
+        self.metric = EuclideanMetric()
+        # a random walk, so that consecutive frames are close like in MD
+        self.ptraj = np.cumsum(0.1 * random.randn(200, 3), axis=0)
+        self.pgens = self.ptraj[::7] + 0.01 * random.randn(29, 3)
+
+    def test_0(self):
+        assert kernels.is_true_metric(self.metric)
+        gens_distances = kernels.pairwise(self.metric, self.pgens, 29)
+        npt.assert_array_almost_equal(gens_distances, gens_distances.T)
+
+        a0, d0 = kernels.exhaustive(self.metric, self.ptraj, self.pgens, 200)
+        a1, d1, n_evaluated = kernels.pruned(self.metric, self.ptraj,
+            self.pgens, 200, gens_distances)
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_equal(d0, d1)
+        assert n_evaluated < 200 * 29
+
+
+class MinkowskiMetric(EuclideanMetric):
+    "Euclidean metric that can be searched with an index"
+    minkowski_p = 2
+
+
+class test_indexed():
+    def setup(self):
+        random = np.random.RandomState(2)
+        self.ptraj = random.randn(150, 3)
+        self.pgens = random.randn(500, 3)
+
+    def test_0(self):
+        metric = MinkowskiMetric()
+        index = kernels.build_index(metric, self.pgens)
+        assert index is not None
+        a0, d0 = kernels.blocked(metric, self.ptraj, self.pgens, 150)
+        a1, d1 = kernels.indexed(index, self.ptraj, 150)
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_almost_equal(d0, d1)
+
+    def test_1(self):
+        # metrics that aren't a minkowski distance don't get an index
+        assert kernels.build_index(EuclideanMetric(), self.pgens) is None
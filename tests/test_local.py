@@ -1,12 +1,18 @@
 import numpy as np
 import numpy.testing as npt
 from msmbuilder.parallel_assign.local import partition, setup_containers, save
+from msmbuilder.parallel_assign.local import start_incremental, finish_incremental
+from msmbuilder.parallel_assign.local import export_dense, Saver, AsyncWriter
+from msmbuilder.parallel_assign.local import CostModel, largest_first
+from msmbuilder.parallel_assign.local import completed_frames, missing_segments
+from msmbuilder.parallel_assign.vtraj import VTraj
 from nose.tools import raises
 import tempfile
 import tables
 import IPython as ip
 import os
 import glob
+import shutil
 
 def test_partition_0():
     project = {'TrajLengths': [2,5]}
@@ -59,6 +65,75 @@ def test_partition_4():
     got = partition(project, chunk_size)
     correct = [[(0,0,1)]]
     assert [e.canonical() for e in got] == correct
+
+def test_partition_cost_0():
+    # with a cost model that only counts frames, the same as partitioning by
+    # frames. (read_costs takes the general, greedy path)
+    project = {'TrajLengths': [2,1,10,4,7]}
+    correct = {5: [[(0,0,2), (1,0,1), (2,0,2)],
+                   [(2,2,7)],
+                   [(2,7,10), (3,0,2)],
+                   [(3,2,4), (4,0,3)],
+                   [(4,3,7)]],
+               7: [[(0,0,2), (1,0,1), (2,0,4)],
+                   [(2,4,10), (3,0,1)],
+                   [(3,1,4), (4,0,4)],
+                   [(4,4,7)]]}
+    for chunk_size in sorted(correct):
+        for model in [CostModel(), CostModel(read_costs={0: 0.0})]:
+            got = partition(project, chunk_size, model)
+            assert [e.canonical() for e in got] == correct[chunk_size]
+
+def test_partition_cost_1():
+    # opening files is expensive, so vtrajs with many files have fewer frames
+    project = {'TrajLengths': [3]*10 + [100]}
+    model = CostModel(frame_cost=1.0, open_cost=5.0)
+    got = partition(project, 20, model)
+    
+    assert sum(len(e) for e in got) == 130
+    assert [e.index for e in got] == range(len(got))
+    assert len(got[0]) == 9
+    assert all(model.cost(e) <= model.budget(20) for e in got)
+
+def test_largest_first():
+    project = {'TrajLengths': [10, 3]}
+    vtrajs = partition(project, 4)
+    assert [len(e) for e in largest_first(vtrajs)] == [4, 4, 4, 1]
+    assert [e.index for e in largest_first(vtrajs)][-1] == 3
+
+def test_partition_completed():
+    # only the frames that aren't completed are partitioned
+    project = {'TrajLengths': [5, 4]}
+    completed = np.array([1,1,0,0,1, 0,0,1,0], dtype=np.bool)
+    assert missing_segments(project['TrajLengths'], completed) == \
+        [(0, 2, 4), (1, 0, 2), (1, 3, 4)]
+    
+    got = partition(project, 3, completed=completed)
+    assert [e.canonical() for e in got] == [[(0, 2, 4), (1, 0, 1)],
+                                            [(1, 1, 2), (1, 3, 4)]]
+
+def test_partition_guided():
+    # with n_engines, the vtrajs get smaller towards the end
+    project = {'TrajLengths': [100]}
+    got = [len(e) for e in partition(project, 20, n_engines=2, min_chunk_size=2)]
+    assert got[:2] == [20, 20]
+    assert got == sorted(got, reverse=True)
+    assert got[-2:] == [2, 1]
+    assert sum(got) == 100
+
+def test_partition_vectorized():
+    # the vectorized partition gives the same vtrajs as the greedy one, which
+    # is used when the trajectories cost differently
+    random = np.random.RandomState(0)
+    greedy = CostModel(read_costs={0: 0.0})
+    for _ in range(50):
+        project = {'TrajLengths': random.randint(1, 30, 6)}
+        completed = random.rand(np.sum(project['TrajLengths'])) < 0.3
+        chunk_size = random.randint(1, 40)
+        for n_engines in [None, 1, 3]:
+            got = partition(project, chunk_size, None, completed, n_engines, 2)
+            correct = partition(project, chunk_size, greedy, completed, n_engines, 2)
+            assert [e.canonical() for e in got] == [e.canonical() for e in correct]
     
 
 
@@ -76,10 +151,10 @@ class test_containers():
         assert isinstance(self.fd, tables.file.File)
         assert self.fa.root.Data.shape == (2,10)
         assert self.fd.root.Data.shape == (2,10)
-        assert self.fa.root.hashes.shape == (len(self.vtrajs), )
-        assert self.fd.root.hashes.shape == (len(self.vtrajs), )
-        assert self.fa.root.completed_vtrajs.shape == (len(self.vtrajs), )
-        assert self.fd.root.completed_vtrajs.shape == (len(self.vtrajs), )
+        # one bit per frame
+        assert self.fa.root.completed_frames.shape == (3, )
+        npt.assert_equal(self.fa.root.traj_lengths[:], [9, 10])
+        assert not np.any(completed_frames(self.fa))
 
     def test_1(self):
         vtraj = self.vtrajs[2]
@@ -98,9 +173,286 @@ class test_containers():
         npt.assert_equal(self.fa.root.Data, AData)
         npt.assert_equal(self.fd.root.Data, DData)
 
+    def test_2(self):
+        saver = Saver(self.fa, self.fd, flush_every=3)
+        for i in [4, 3]:
+            saver.save(np.ones(3), np.ones(3), self.vtrajs[i])
+        # not marked as completed until the flush
+        assert not np.any(completed_frames(self.fa))
+        
+        saver.save(np.ones(3), np.ones(3), VTraj(None, (0, 0, 3)))
+        correct = np.zeros(19, dtype=np.bool)
+        correct[0:3] = correct[9:15] = True
+        npt.assert_equal(completed_frames(self.fa), correct)
+        
+        # a resume can use any chunk size
+        got = partition({'TrajLengths': [9, 10]}, 5,
+                        completed=completed_frames(self.fa))
+        assert [e.canonical() for e in got] == [[(0, 3, 8)], [(0, 8, 9), (1, 6, 10)]]
+
+    def test_3(self):
+        writer = AsyncWriter(Saver(self.fa, self.fd, flush_every=100))
+        for vtraj in reversed(self.vtrajs):
+            writer.put(vtraj.index * np.ones(len(vtraj)), np.ones(len(vtraj)),
+                       vtraj)
+        writer.close()
+        
+        assert writer.n_saved == len(self.vtrajs)
+        assert np.all(completed_frames(self.fa))
+        npt.assert_equal(self.fa.root.Data[0], [0,0,0,1,1,1,2,2,2,-1])
+        npt.assert_equal(self.fa.root.Data[1], [3,3,3,4,4,4,5,5,5,6])
+
+    @raises(IndexError)
+    def test_4(self):
+        # errors on the writer thread are raised in the main thread
+        writer = AsyncWriter(Saver(self.fa, self.fd))
+        writer.put(np.ones(3), np.ones(3), VTraj(None, (5, 0, 3)))
+        writer.close()
+
     def teardown(self):
         self.fa.close()
         self.fd.close()
         for e in glob.glob(os.path.join(self.d, '*')):
             os.unlink(e)
         os.rmdir(self.d)
+
+
+class test_legacy_containers():
+    def setup(self):
+        self.d = tempfile.mkdtemp()
+        self.project = {'TrajLengths': [9,10], 'NumTrajs':2}
+        self.vtrajs = partition(self.project, 4)
+        fa, fd = setup_containers(self.d, self.project, self.vtrajs)
+        # what containers looked like before the completion bitmap
+        fa.removeNode(fa.root, 'completed_frames')
+        fa.createArray(fa.root, 'hashes', np.array([e.hash() for e in self.vtrajs]))
+        fa.createArray(fa.root, 'completed_vtrajs', np.array([1, 0, 0, 1, 1], dtype=np.bool))
+        fa.close()
+        fd.close()
+
+    def test_0(self):
+        fa, fd = setup_containers(self.d, self.project, self.vtrajs)
+        correct = np.zeros(19, dtype=np.bool)
+        correct[0:4] = correct[12:19] = True
+        npt.assert_equal(completed_frames(fa), correct)
+        assert 'hashes' not in fa.root
+        fa.close()
+        fd.close()
+
+    @raises(ValueError)
+    def test_1(self):
+        # the hashes are of a different partition
+        setup_containers(self.d, self.project, partition(self.project, 3))
+
+    def teardown(self):
+        shutil.rmtree(self.d)
+
+
+class test_legacy_boundary():
+    def setup(self):
+        # the lengths straddle the chunk boundaries, so the old partition
+        # ended the first vtraj with an empty chunk, which partition doesn't
+        self.d = tempfile.mkdtemp()
+        self.project = {'TrajLengths': [2,1,10], 'NumTrajs':3}
+        legacy = [VTraj(None, (0, 0, 2), (1, 0, 1), (2, 0, 0)),
+                  VTraj(None, (2, 0, 3)), VTraj(None, (2, 3, 6)),
+                  VTraj(None, (2, 6, 9)), VTraj(None, (2, 9, 10))]
+        vtrajs = partition(self.project, 3)
+        assert vtrajs[0].hash() != legacy[0].hash()
+        fa, fd = setup_containers(self.d, self.project, vtrajs)
+        fa.removeNode(fa.root, 'completed_frames')
+        fa.createArray(fa.root, 'hashes', np.array([e.hash() for e in legacy]))
+        fa.createArray(fa.root, 'completed_vtrajs', np.array([1, 0, 0, 1, 1], dtype=np.bool))
+        fa.close()
+        fd.close()
+
+    def test_0(self):
+        fa, fd = setup_containers(self.d, self.project,
+                                  partition(self.project, 3), chunk_size=3)
+        correct = np.zeros(13, dtype=np.bool)
+        correct[0:3] = correct[9:13] = True
+        npt.assert_equal(completed_frames(fa), correct)
+        fa.close()
+        fd.close()
+
+    @raises(ValueError)
+    def test_1(self):
+        setup_containers(self.d, self.project, partition(self.project, 4))
+
+    def teardown(self):
+        shutil.rmtree(self.d)
+
+
+class test_ragged_containers():
+    def setup(self):
+        self.d = tempfile.mkdtemp()
+        project = {'TrajLengths': [9,10], 'NumTrajs':2}
+        self.vtrajs = partition(project, 3)
+        self.fa, self.fd = setup_containers(self.d, project, self.vtrajs,
+                                            layout='ragged')
+
+    def test_0(self):
+        assert self.fa.root.Data.shape == (19,)
+        npt.assert_equal(self.fa.root.offsets[:], [0, 9, 19])
+        # created empty, reads back as the fill value
+        npt.assert_equal(self.fa.root.Data[:], -1 * np.ones(19))
+
+    def test_1(self):
+        vtraj = self.vtrajs[3]
+        assert vtraj.canonical() == [(1, 0, 3)]
+        save(self.fa, self.fd, 1234 * np.ones(3), np.ones(3), vtraj)
+        self.fa.flush()
+        self.fd.flush()
+        
+        dense_fn = os.path.join(self.d, 'dense.h5')
+        export_dense(os.path.join(self.d, 'Assignments.h5'), dense_fn)
+        f = tables.openFile(dense_fn)
+        AData = -1 * np.ones((2,10))
+        AData[1,0:3] = 1234
+        npt.assert_equal(f.root.Data[:], AData)
+        f.close()
+
+    def teardown(self):
+        self.fa.close()
+        self.fd.close()
+        for e in glob.glob(os.path.join(self.d, '*')):
+            os.unlink(e)
+        os.rmdir(self.d)
+
+
+class test_incremental():
+    def setup(self):
+        self.d = tempfile.mkdtemp()
+        project = {'TrajLengths': [4,4], 'NumTrajs':2}
+        self.vtraj0, self.vtraj1 = partition(project, 4)
+        self.fa, self.fd = setup_containers(self.d, project,
+            [self.vtraj0, self.vtraj1], gens_hashes=['a', 'b'])
+        
+        distances = np.array([1, 2, 3, 4], dtype=np.float32)
+        save(self.fa, self.fd, np.array([0, 1, 0, 1]), distances, self.vtraj0)
+        save(self.fa, self.fd, np.array([1, 1, 1, 1]), distances, self.vtraj1)
+    
+    def test_0(self):
+        gens_start = start_incremental(self.fa, ['a', 'b', 'c'])
+        assert gens_start == 2
+        assert not np.any(completed_frames(self.fa))
+        # resuming gives the same answer
+        assert start_incremental(self.fa, ['a', 'b', 'c']) == 2
+        
+        new_d = np.array([0.5, 2, 5, 0], dtype=np.float32)
+        save(self.fa, self.fd, 2*np.ones(4), new_d, self.vtraj0, merge=True)
+        save(self.fa, self.fd, 2*np.ones(4), 10*new_d, self.vtraj1, merge=True)
+        finish_incremental(self.fa)
+        
+        npt.assert_equal(self.fa.root.Data[0], [2, 1, 0, 2])
+        npt.assert_equal(self.fd.root.Data[0], [0.5, 2, 3, 0])
+        npt.assert_equal(self.fa.root.Data[1], [1, 1, 1, 2])
+        assert getattr(self.fa.root._v_attrs, 'incremental_from', None) is None
+    
+    @raises(ValueError)
+    def test_1(self):
+        # only appending is supported
+        start_incremental(self.fa, ['b', 'a', 'c'])
+    
+    def teardown(self):
+        self.fa.close()
+        self.fd.close()
+        for e in glob.glob(os.path.join(self.d, '*')):
+            os.unlink(e)
+        os.rmdir(self.d)
+
+
+class test_append():
+    def setup(self):
+        self.d = tempfile.mkdtemp()
+        self.project = {'TrajLengths': [4,3], 'NumTrajs':2}
+    
+    def check(self, layout):
+        vtrajs = partition(self.project, 4)
+        fa, fd = setup_containers(self.d, self.project, vtrajs, layout=layout)
+        save(fa, fd, np.array([0, 1, 2, 3]), np.ones(4), vtrajs[0])
+        fa.close()
+        fd.close()
+        
+        # the second trajectory got longer, and a third was added
+        project = {'TrajLengths': [4,5,2], 'NumTrajs':3}
+        vtrajs = partition(project, 4)
+        fa, fd = setup_containers(self.d, project, vtrajs, layout=layout,
+                                  extend=True)
+        try:
+            npt.assert_equal(fa.root.traj_lengths[:], [4, 5, 2])
+            npt.assert_equal(completed_frames(fa), [1,1,1,1, 0,0,0,0,0, 0,0])
+            if layout == 'dense':
+                npt.assert_equal(fa.root.Data[:], [[0, 1, 2, 3, -1],
+                                                   [-1]*5, [-1]*5])
+            else:
+                npt.assert_equal(fa.root.offsets[:], [0, 4, 9, 11])
+                npt.assert_equal(fa.root.Data[:4], [0, 1, 2, 3])
+                npt.assert_equal(fd.root.Data[:4], [1, 1, 1, 1])
+            # only the new frames, and the ones that weren't done, are left
+            got = partition(project, 4, completed=completed_frames(fa))
+            assert [e.canonical() for e in got] == [[(1, 0, 4)], [(1, 4, 5), (2, 0, 2)]]
+        finally:
+            fa.close()
+            fd.close()
+    
+    def test_0(self):
+        self.check('dense')
+    
+    def test_1(self):
+        self.check('ragged')
+    
+    @raises(ValueError)
+    def test_2(self):
+        # without extend, a change in the project is an error
+        vtrajs = partition(self.project, 4)
+        fa, fd = setup_containers(self.d, self.project, vtrajs)
+        fa.close()
+        fd.close()
+        project = {'TrajLengths': [4,5], 'NumTrajs':2}
+        setup_containers(self.d, project, partition(project, 4))
+    
+    @raises(ValueError)
+    def test_3(self):
+        # trajectories can't get shorter
+        vtrajs = partition(self.project, 4)
+        fa, fd = setup_containers(self.d, self.project, vtrajs)
+        fa.close()
+        fd.close()
+        project = {'TrajLengths': [2,3], 'NumTrajs':2}
+        setup_containers(self.d, project, partition(project, 4), extend=True)
+    
+    def test_4(self):
+        # containers in the old format were written out in full, with a
+        # fill value of 0, and no lengths
+        vtrajs = partition(self.project, 4)
+        for name, dtype in [('Assignments.h5', np.int64),
+                            ('Assignments.h5.distances', np.float32)]:
+            f = tables.openFile(os.path.join(self.d, name), mode='w')
+            data = -1 * np.ones((2, 4), dtype=dtype)
+            data[0] = [0, 1, 2, 3]
+            f.createCArray(f.root, 'Data', tables.Atom.from_dtype(data.dtype),
+                           data.shape)[:] = data
+            f.createArray(f.root, 'hashes', np.array([e.hash() for e in vtrajs]))
+            f.createArray(f.root, 'completed_vtrajs', np.array([1, 0], dtype=np.bool))
+            f.close()
+        # converted when it's resumed, and then extended
+        fa, fd = setup_containers(self.d, self.project, vtrajs)
+        fa.close()
+        fd.close()
+        project = {'TrajLengths': [4,5,2], 'NumTrajs':3}
+        fa, fd = setup_containers(self.d, project, partition(project, 4),
+                                  extend=True)
+        try:
+            npt.assert_equal(completed_frames(fa), [1,1,1,1, 0,0,0,0,0, 0,0])
+            npt.assert_equal(fa.root.Data[:], [[0, 1, 2, 3, -1],
+                                               [-1]*5, [-1]*5])
+            npt.assert_equal(fd.root.Data[1:], -1 * np.ones((2, 5)))
+        finally:
+            fa.close()
+            fd.close()
+    
+    def teardown(self):
+        for e in glob.glob(os.path.join(self.d, '*')):
+            os.unlink(e)
+        os.rmdir(self.d)
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import numpy.testing as npt
+
+from msmbuilder import Project
+from msmbuilder import metrics
+from msmbuilder.parallel_assign import remote, multiproc
+from msmbuilder.parallel_assign.local import partition
+from common import fixtures_dir
+
+
+class test_multiproc():
+    def setup(self):
+        self.metric = metrics.Dihedral()
+        self.pdb_fn = os.path.join(fixtures_dir(), 'native.pdb')
+        self.trj_fn = os.path.join(fixtures_dir(), 'trj0.lh5')
+        self.project = Project({'NumTrajs': 1, 'TrajLengths': [501], 'TrajFileBaseName': 'trj', 'TrajFileType': '.lh5',
+                           'ConfFilename': self.pdb_fn,
+                           'TrajFilePath': fixtures_dir()})
+        self.vtrajs = partition(self.project, chunk_size=100)
+
+    def test_0(self):
+        # same results as assigning each vtraj with remote.assign
+        results = list(multiproc.assign(self.vtrajs, self.trj_fn, self.pdb_fn,
+                                        self.metric, n_procs=2))
+        assert len(results) == len(self.vtrajs)
+        
+        del remote.STATES[:]
+        for a, d, vtraj, stats in results:
+            a2, d2, _, _ = remote.assign(vtraj, self.trj_fn, self.metric)
+            npt.assert_array_equal(a, a2)
+            npt.assert_array_almost_equal(d, d2)
+        
+        indices = sorted(vtraj.index for _, _, vtraj, _ in results)
+        assert indices == range(len(self.vtrajs))
+    
+    def test_1(self):
+        # nothing to do
+        assert list(multiproc.assign([], self.trj_fn, self.pdb_fn, self.metric)) == []
+
+    def test_2(self):
+        # several sets of generators
+        sets = [(self.trj_fn, self.metric, False, 0, False),
+                (self.trj_fn, self.metric, False, 250, False)]
+        results = list(multiproc.assign_sets(self.vtrajs, sets, self.pdb_fn,
+                                             n_procs=2))
+        assert len(results) == len(self.vtrajs)
+
+        del remote.STATES[:]
+        for a, d, vtraj, stats in results:
+            for k, (gens_fn, metric, pruned, gens_start, index) in enumerate(sets):
+                a2, d2, _, _ = remote.assign(vtraj, gens_fn, metric,
+                                             gens_start=gens_start)
+                npt.assert_array_equal(a[k], a2)
+                npt.assert_array_almost_equal(d[k], d2)
+
+    def test_3(self):
+        # an error while loading the generators is raised, instead of the
+        # pool starting new workers forever
+        results = multiproc.assign(self.vtrajs, 'does-not-exist.lh5',
+                                   self.pdb_fn, self.metric, n_procs=2)
+        try:
+            list(results)
+        except RuntimeError as e:
+            assert 'does-not-exist.lh5' in str(e)
+        else:
+            raise AssertionError('no error')
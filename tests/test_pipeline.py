@@ -0,0 +1,44 @@
+import time
+from nose.tools import raises, eq_
+
+from msmbuilder.parallel_assign.pipeline import Prefetcher
+
+
+def test_order():
+    prefetcher = Prefetcher(lambda x: 2*x, range(10), depth=2)
+    eq_(list(prefetcher), [2*x for x in range(10)])
+    prefetcher.close()
+
+
+def test_wait_time():
+    # slow loading, so the consumer waits
+    def load(x):
+        time.sleep(0.01)
+        return x
+    prefetcher = Prefetcher(load, range(5), depth=1)
+    eq_(list(prefetcher), range(5))
+    prefetcher.close()
+    assert prefetcher.io_time >= 0.05
+    assert prefetcher.wait_time > 0
+
+
+@raises(ZeroDivisionError)
+def test_error():
+    prefetcher = Prefetcher(lambda x: 1 / x, [1, 0, 2], depth=1)
+    try:
+        list(prefetcher)
+    finally:
+        prefetcher.close()
+
+
+def test_close_early():
+    loaded = []
+    def load(x):
+        loaded.append(x)
+        return x
+    prefetcher = Prefetcher(load, range(100), depth=1)
+    for x in prefetcher:
+        break
+    prefetcher.close()
+    # the background thread stopped well before the end
+    assert len(loaded) < 100
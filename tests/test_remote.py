@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import numpy as np
 import numpy.testing as npt
 import IPython as ip
@@ -9,6 +11,7 @@ from msmbuilder.parallel_assign import remote
 from msmbuilder.parallel_assign.remote import assign
 from msmbuilder.parallel_assign.local import partition
 from msmbuilder.parallel_assign.vtraj import VTraj
+from msmbuilder.parallel_assign.features import FeatureCache
 from common import fixtures_dir
 
 
@@ -28,18 +31,19 @@ class test_assign():
     
     def test_1(self):
         # assigning some confs to themselves
-        a,d,vtraj = assign(self.vtraj, self.trj_fn, self.metric)
+        a,d,vtraj,stats = assign(self.vtraj, self.trj_fn, self.metric)
         npt.assert_array_equal(a, np.arange(501))
         npt.assert_array_almost_equal(d, np.zeros(501), decimal=3)
         assert vtraj == self.vtraj
     
     def test_2(self):
-        # reset the global
-        remote.PREPARED=False
+        # a worker that has the trajectory loaded as the generators picks up
+        # the change to a different generators file
+        assign(self.vtraj, self.trj_fn, self.metric)
         
         # get a smaller vtraj, and just assign it to only the pDB
         vtraj = partition(self.project, chunk_size=10)[1]
-        a,d,vtraj = assign(vtraj, self.pdb_fn, self.metric)
+        a,d,vtraj,stats = assign(vtraj, self.pdb_fn, self.metric)
 
         # these are the right RMSD distances
         #correct_d = np. array([ 0.07839765,  0.07229914,  0.1135717 ,  0.14044274,  0.1121752 , 0.10593121,  0.08611701,  0.08802523,  0.08841465,  0.08553738], dtype=np.float32)
@@ -47,3 +51,116 @@ class test_assign():
                                0.60572095,  0.47062515,  0.5758602 ,  0.24565975,  0.69161412], dtype=np.float32)
         npt.assert_array_almost_equal(d, correct_d)
         npt.assert_array_equal(a, np.zeros(10))
+
+    def test_3(self):
+        del remote.STATES[:]
+        
+        # pruned assignment gives the same answer as the exhaustive search
+        vtraj = partition(self.project, chunk_size=100)[2]
+        a0,d0,_,stats0 = assign(vtraj, self.trj_fn, self.metric)
+        a1,d1,_,stats1 = assign(vtraj, self.trj_fn, self.metric, pruned=True)
+        
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_almost_equal(d0, d1)
+        assert stats0['n_distances'] == 100 * 501
+        assert stats1['n_distances'] < stats0['n_distances']
+
+    def test_4(self):
+        del remote.STATES[:]
+        
+        # prefetching blocks gives the same answer
+        vtraj = partition(self.project, chunk_size=100)[1]
+        a0,d0,_,_ = assign(vtraj, self.trj_fn, self.metric)
+        a1,d1,_,stats = assign(vtraj, self.trj_fn, self.metric, prefetch=2,
+                               block_size=7)
+        
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_equal(d0, d1)
+        assert stats['io_wait_time'] <= stats['io_time'] + 1e-3
+
+    def test_5(self):
+        del remote.STATES[:]
+        
+        # after a warm-up, tasks can refer to the metric by its fingerprint
+        fingerprint = remote.warm(self.trj_fn, self.pdb_fn, self.metric)
+        a0,d0,_,_ = assign(self.vtraj, self.trj_fn, self.metric)
+        a1,d1,_,_ = assign(self.vtraj, self.trj_fn, fingerprint)
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_equal(d0, d1)
+        assert len(remote.STATES) == 1
+    
+    def test_6(self):
+        del remote.STATES[:]
+        
+        # the states are kept in LRU order, and at most MAX_STATES of them
+        s0 = remote.load_gens(self.trj_fn, self.pdb_fn, self.metric)
+        s1 = remote.load_gens(self.pdb_fn, self.pdb_fn, self.metric)
+        assert remote.load_gens(self.trj_fn, self.pdb_fn, self.metric) is s0
+        s2 = remote.load_gens(self.trj_fn, self.pdb_fn, metrics.Dihedral(metric='cityblock'))
+        assert len(remote.STATES) == remote.MAX_STATES == 2
+        assert [state for key, state in remote.STATES] == [s0, s2]
+    
+    def test_7(self):
+        # the breakdown of the time adds up
+        a,d,_,stats = assign(self.vtraj, self.trj_fn, self.metric)
+        assert stats['n_frames'] == 501
+        npt.assert_almost_equal(stats['compute_time'],
+                                stats['prepare_time'] + stats['distance_time'])
+        assert stats['open_time'] + stats['read_time'] + \
+            stats['decode_time'] <= stats['io_time'] + 1e-3
+        assert stats['io_time'] + stats['compute_time'] <= \
+            stats['task_time'] + 1e-3
+    
+    def test_8(self):
+        del remote.STATES[:]
+        
+        # the index gives the same answer as computing all the distances
+        vtraj = partition(self.project, chunk_size=100)[3]
+        a0,d0,_,_ = assign(vtraj, self.trj_fn, self.metric)
+        a1,d1,_,_ = assign(vtraj, self.trj_fn, self.metric, index=True)
+        assert remote.STATES[-1][1].index is not None
+        npt.assert_array_equal(a0, a1)
+        npt.assert_array_almost_equal(d0, d1)
+    
+    def test_9(self):
+        del remote.STATES[:]
+        
+        # assigning to several sets of generators at once gives the same
+        # answers as assigning to each of them
+        sets = [(self.trj_fn, self.metric, False, 0, False),
+                (self.trj_fn, metrics.RMSD(), False, 0, False),
+                (self.trj_fn, self.metric, False, 100, False)]
+        a,d,vtraj,stats = remote.assign_sets(self.vtraj, sets, prefetch=1,
+                                             block_size=100)
+        assert len(a) == len(d) == 3
+        assert len(remote.STATES) == 3
+        for k, (gens_fn, metric, pruned, gens_start, index) in enumerate(sets):
+            a1,d1,_,_ = assign(self.vtraj, gens_fn, metric, pruned, gens_start)
+            npt.assert_array_equal(a[k], a1)
+            npt.assert_array_almost_equal(d[k], d1)
+        assert stats['n_distances_exhaustive'] == 501 * (501 + 501 + 401)
+        # the room for the three is made per call, not kept
+        assert remote.MAX_STATES == 2
+    
+    def test_10(self):
+        del remote.STATES[:]
+        
+        # with a feature cache, the second time the frames aren't loaded or
+        # prepared, and the answers are the same. with prefetching, the blocks
+        # are found in what was stored for the whole vtraj
+        features = FeatureCache(tempfile.mkdtemp())
+        try:
+            a0,d0,_,stats0 = assign(self.vtraj, self.trj_fn, self.metric,
+                                    features=features)
+            assert stats0['n_cached_frames'] == 0
+            for prefetch in [0, 1]:
+                a1,d1,_,stats1 = assign(self.vtraj, self.trj_fn, self.metric,
+                                        prefetch=prefetch, block_size=100,
+                                        features=features)
+                npt.assert_array_equal(a0, a1)
+                npt.assert_array_almost_equal(d0, d1)
+                assert stats1['n_cached_frames'] == 501
+                assert stats1['bytes_read'] == 0
+                assert stats1['prepare_time'] == 0
+        finally:
+            shutil.rmtree(features.directory)
@@ -0,0 +1,54 @@
+import os
+import csv
+import json
+import shutil
+import tempfile
+from nose.tools import eq_
+
+from msmbuilder.parallel_assign.report import RunReport, PHASES
+
+
+def stats(n_frames, task_time, **times):
+    result = dict((phase, 0.0) for phase in PHASES)
+    result.update(times)
+    result.update({'n_frames': n_frames, 'task_time': task_time})
+    return result
+
+
+def test_totals():
+    report = RunReport(300)
+    assert report.eta() is None
+    report.add(stats(100, 1.0, read_time=0.25, distance_time=0.75), 0)
+    report.add(stats(100, 4.0, read_time=1.0, distance_time=3.0), 1)
+    report.add(stats(50, 1.0, read_time=0.25, distance_time=0.75), 0)
+
+    eq_(report.n_done, 250)
+    eq_(report.totals['task_time'], 6.0)
+    eq_(report.engines[0]['n_chunks'], 2)
+    eq_(report.engine_rates(), {0: 75.0, 1: 25.0})
+    eq_(report.breakdown()['read_time'], 0.25)
+    eq_(report.breakdown()['distance_time'], 0.75)
+    # one sixth of the frames are left
+    assert report.eta() >= report.start + report.elapsed
+
+
+def test_write():
+    directory = tempfile.mkdtemp()
+    try:
+        report = RunReport(100, {'backend': 'local'})
+        report.add(stats(100, 2.0, distance_time=2.0), 'local')
+        report.finish()
+        prefix = os.path.join(directory, 'Assignments.h5.report')
+        report.write(prefix)
+
+        summary = json.load(open(prefix + '.json'))
+        eq_(summary['info'], {'backend': 'local'})
+        eq_(summary['n_done'], 100)
+        eq_(summary['engines'][0]['frames_per_second'], 50.0)
+
+        rows = list(csv.DictReader(open(prefix + '.csv')))
+        eq_(len(rows), 1)
+        eq_(rows[0]['engine'], 'local')
+        eq_(float(rows[0]['frames_per_second']), 50.0)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,262 @@
+import time
+import datetime
+from nose.tools import eq_, raises
+from IPython.parallel.error import RemoteError, TaskAborted
+
+from msmbuilder.parallel_assign.collect import ResultCollector
+from msmbuilder.parallel_assign.schedule import Scheduler
+from msmbuilder.parallel_assign.vtraj import VTraj
+
+
+class FakeResult(object):
+    """The result of a task: a list of one value if it was submitted with
+    map, or the bare value if it was submitted with apply"""
+    def __init__(self, value, mapped, started, completed):
+        self.value = value
+        self.mapped = mapped
+        self.started = started
+        self.completed = completed
+
+    @property
+    def result(self):
+        if isinstance(self.value, Exception):
+            raise self.value
+        if self.mapped:
+            return [self.value]
+        return self.value
+
+
+class FakeSubmitted(object):
+    def __init__(self, msg_ids):
+        self.msg_ids = msg_ids
+
+
+class FakeView(object):
+    def __init__(self, client, targets):
+        self.client = client
+        self.targets = targets
+
+    def map(self, f, *sequences, **kwargs):
+        return FakeSubmitted([self.client.submit(f, args, self.targets, True)
+                              for args in zip(*sequences)])
+
+    def apply(self, f, *args):
+        return FakeSubmitted([self.client.submit(f, args, self.targets, False)])
+
+
+class FakeClient(object):
+    """Stand-in for IPython.parallel.Client, running the tasks on simulated
+    engines that each take `slowness[i]` times as long as task(*args) says,
+    in seconds"""
+    def __init__(self, slowness):
+        self.slowness = dict(enumerate(slowness))
+        self.ids = sorted(self.slowness)
+        # (engine, args) of each task that was started
+        self.ran = []
+        self.running = dict((i, None) for i in self.slowness)
+        self.unassigned = []
+        self.tasks = {}
+        self.results = {}
+        self.aborted = []
+        self._queue_handlers = {'apply_reply': self._handle_apply_reply}
+
+    def load_balanced_view(self, targets=None):
+        return FakeView(self, targets)
+
+    def submit(self, f, args, targets, mapped):
+        msg_id = 'msg-%d' % len(self.tasks)
+        self.tasks[msg_id] = (f, args, targets, mapped)
+        self.unassigned.append(msg_id)
+        return msg_id
+
+    def _handle_apply_reply(self, msg):
+        msg_id = msg['parent_header']['msg_id']
+        self.results[msg_id] = msg['result']
+
+    def reply(self, msg_id, value, started):
+        mapped = self.tasks[msg_id][3]
+        return {'parent_header': {'msg_id': msg_id},
+                'result': FakeResult(value, mapped, started,
+                                     datetime.datetime.now())}
+
+    def kill(self, engine):
+        """the engine dies, and the client fails its task, and the ones
+        waiting for it, like the real client does: with a RemoteError
+        wrapping an EngineError"""
+        msg_id, _, started = self.running.pop(engine)
+        del self.slowness[engine]
+        self.ids.remove(engine)
+        lost = [msg_id] + [m for m in self.unassigned
+                           if self.tasks[m][2] == [engine]]
+        for m in lost:
+            if m in self.unassigned:
+                self.unassigned.remove(m)
+            error = RemoteError('EngineError', 'Engine %r died' % engine, '')
+            self._handle_apply_reply(self.reply(m, error, started))
+
+    def spin(self):
+        now = time.time()
+        for engine, running in self.running.items():
+            if running is not None and running[1] <= now:
+                msg_id, _, started = running
+                f, args = self.tasks[msg_id][:2]
+                self._queue_handlers['apply_reply'](
+                    self.reply(msg_id, f(*args), started))
+                self.running[engine] = None
+            if self.running[engine] is None:
+                for msg_id in self.unassigned:
+                    targets = self.tasks[msg_id][2]
+                    if targets is None or engine in targets:
+                        self.unassigned.remove(msg_id)
+                        f, args = self.tasks[msg_id][:2]
+                        self.ran.append((engine, args))
+                        duration = f(*args)
+                        if isinstance(duration, Exception):
+                            duration = 0
+                        end = now + duration * self.slowness[engine]
+                        self.running[engine] = (msg_id, end,
+                                                datetime.datetime.now())
+                        break
+
+    def get_result(self, msg_id):
+        return self.results[msg_id]
+
+    def queue_status(self, verbose=False):
+        status = dict((engine, {'queue': [], 'completed': [],
+                                'tasks': [] if running is None else [running[0]]})
+                      for engine, running in self.running.items())
+        status['unassigned'] = list(self.unassigned)
+        return status
+
+    def abort(self, msg_ids, block=None):
+        """the tasks that haven't started are failed with TaskAborted, and
+        the others run to completion"""
+        self.aborted.extend(msg_ids)
+        for msg_id in msg_ids:
+            if msg_id in self.unassigned:
+                self.unassigned.remove(msg_id)
+                self._handle_apply_reply(self.reply(msg_id,
+                    TaskAborted(msg_id), None))
+
+
+def task(duration):
+    return duration
+
+
+def test_all_once():
+    client = FakeClient([1, 1, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), task)
+    jobs = [0.01] * 10
+    results = [result for result, _ in scheduler.run(jobs)]
+    eq_(sorted(results), jobs)
+    eq_(scheduler.n_remaining, 0)
+
+
+def test_speculate():
+    # engine 0 is very slow. its last task is copied to another engine, which
+    # finishes first
+    client = FakeClient([100, 1, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), task,
+                          speculate=True, check_interval=0.01, min_samples=3)
+    jobs = [0.01] * 10
+    start = time.time()
+    results = [result for result, _ in scheduler.run(jobs)]
+    assert time.time() - start < 0.5
+    eq_(len(results), 10)
+    assert scheduler.n_duplicates >= 1
+    assert scheduler.n_duplicates_won >= 1
+
+
+def test_lost_engine():
+    client = FakeClient([1, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), task)
+    jobs = [0.05] * 6
+    results = []
+    for result, _ in scheduler.run(jobs):
+        if not results:
+            client.kill(0)
+        results.append(result)
+    eq_(sorted(results), jobs)
+    eq_(scheduler.n_resubmitted, 1)
+
+
+def failing(duration):
+    # (the fake client fails the task with an exception that's returned)
+    return RemoteError('ValueError', 'bad vtraj', '')
+
+
+@raises(RemoteError)
+def test_remote_error():
+    # errors other than a lost engine are raised
+    client = FakeClient([1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), failing)
+    list(scheduler.run([0.01]))
+
+
+def vtraj_task(vtraj):
+    return 0.001 * len(vtraj)
+
+
+def test_locality():
+    # each trajectory is run on one engine
+    client = FakeClient([1, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), vtraj_task,
+                          locality=True)
+    vtrajs = [VTraj(None, (traj, start, start + 5)) for start in range(0, 20, 5)
+              for traj in range(4)]
+    results = list(scheduler.run(vtrajs))
+    eq_(len(results), 16)
+    engines = {}
+    for engine, (vtraj,) in client.ran:
+        engines.setdefault(vtraj.chunks[0].traj, set()).add(engine)
+    # (timing jitter at the very end can cause a steal)
+    assert scheduler.n_stolen <= 1
+    assert sum(len(e) for e in engines.values()) <= 4 + scheduler.n_stolen
+
+
+def test_stealing():
+    # a slow engine has its vtrajs stolen by the fast one
+    client = FakeClient([10, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), vtraj_task,
+                          locality=True)
+    vtrajs = [VTraj(None, (traj, start, start + 5)) for start in range(0, 20, 5)
+              for traj in range(4)]
+    results = list(scheduler.run(vtrajs))
+    eq_(sorted(r[0] for r in results), [0.005] * 16)
+    assert scheduler.n_stolen > 0
+    eq_(len(client.ran), 16)
+
+
+def test_lost_engine_locality():
+    # the vtrajs of a lost engine are run by the others
+    client = FakeClient([1, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), vtraj_task,
+                          locality=True)
+    vtrajs = [VTraj(None, (traj, start, start + 5)) for start in range(0, 20, 5)
+              for traj in range(4)]
+    results = []
+    for result, _ in scheduler.run(vtrajs):
+        if not results:
+            client.kill(0)
+        results.append(result)
+    eq_(sorted(results), [0.005] * 16)
+    assert scheduler.n_resubmitted >= 1
+    # they were queued for the engines that are left, not sent to any engine
+    assert all(targets == [1] for _, _, targets, _ in client.tasks.values()
+               if targets != [0])
+
+
+def test_speculate_locality():
+    # the copy of the slow engine's last task finishes first, but the
+    # original keeps running, so the slow engine isn't free
+    client = FakeClient([100, 1])
+    scheduler = Scheduler(client, ResultCollector(client, 0.01), vtraj_task,
+                          speculate=True, check_interval=0.01, min_samples=3,
+                          locality=True)
+    vtrajs = [VTraj(None, (traj, start, start + 5)) for start in range(0, 20, 5)
+              for traj in range(4)]
+    results = list(scheduler.run(vtrajs))
+    eq_(len(results), 16)
+    assert scheduler.n_duplicates_won >= 1
+    assert client.running[0] is not None
+    eq_(scheduler._in_flight[0], 1)
@@ -28,6 +28,13 @@ def test_setup_logger():
     ok_(line.startswith(progname))
     ok_(line.endswith(message + '\n'))
 
+def test_set_output_dirs():
+    eq_(AssignParallel.set_output_dirs('/out', ['/d/Gens.lh5']), ['/out'])
+    eq_(AssignParallel.set_output_dirs('/out', ['/d/k100/Gens.lh5', '/d/k200/Gens.lh5']),
+        ['/out/k100_Gens', '/out/k200_Gens'])
+    eq_(AssignParallel.set_output_dirs('/out', ['/d/Gens.lh5', '/d/k2/Gens.lh5']),
+        ['/out/Gens', '/out/k2_Gens'])
+
 class test_main:
     class Args:
             metric = 'dihedral'
@@ -58,6 +65,10 @@ class test_main:
             
             npt.assert_array_equal(assignments, r_assignments)
             npt.assert_array_almost_equal(distances, r_distances)
+            
+            for ext in ['.json', '.csv']:
+                ok_(os.path.exists(os.path.join(args.output_dir,
+                                                'Assignments.h5.report' + ext)))
         
         except:
             raise
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+
+from msmbuilder import Trajectory
+from msmbuilder import metrics
+from msmbuilder.parallel_assign import shared
+from common import fixtures_dir
+
+
+class Prepared(object):
+    "stand-in for an object like RMSD.TheoData"
+    def __init__(self, xyz, n_atoms):
+        self.XYZData = xyz
+        self.NumAtoms = n_atoms
+
+
+class test_cached():
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.n_builds = 0
+    
+    def teardown(self):
+        shutil.rmtree(self.directory)
+    
+    def build(self, value):
+        def f():
+            self.n_builds += 1
+            return value
+        return f
+    
+    def test_0(self):
+        # arrays are built once, then memory-mapped
+        x = np.random.randn(10, 3).astype(np.float32)
+        for i in range(3):
+            got = shared.cached('a', self.build(x), self.directory)
+            npt.assert_array_equal(got, x)
+            assert isinstance(got, np.memmap)
+        assert self.n_builds == 1
+    
+    def test_1(self):
+        # objects with array attributes
+        x = Prepared(np.random.randn(10, 3), 3)
+        got = shared.cached('b', self.build(x), self.directory)
+        assert isinstance(got, Prepared)
+        npt.assert_array_equal(got.XYZData, x.XYZData)
+        assert got.NumAtoms == 3
+    
+    def test_2(self):
+        # a different key is a different segment
+        shared.cached('a', self.build(np.zeros(3)), self.directory)
+        got = shared.cached('c', self.build(np.ones(3)), self.directory)
+        npt.assert_array_equal(got, np.ones(3))
+        assert shared.clear(self.directory) == 2
+        assert os.listdir(self.directory) == []
+    
+    def test_3(self):
+        # the prepared generators match the ones prepared directly
+        gens_fn = os.path.join(fixtures_dir(), 'trj0.lh5')
+        metric = metrics.Dihedral()
+        key = shared.key(shared.file_identity(gens_fn),
+                         shared.metric_fingerprint(metric))
+        prepare = lambda: metric.prepare_trajectory(Trajectory.LoadTrajectoryFile(gens_fn))
+        npt.assert_array_equal(shared.cached(key, prepare, self.directory), prepare())
+
+
+def test_metric_fingerprint():
+    assert shared.metric_fingerprint(metrics.Dihedral()) == \
+        shared.metric_fingerprint(metrics.Dihedral())
+    assert shared.metric_fingerprint(metrics.Dihedral(metric='euclidean')) != \
+        shared.metric_fingerprint(metrics.Dihedral(metric='cityblock'))
+
+
+def test_metric_fingerprint_objects():
+    # a Hybrid holds its base metrics. the fingerprint is the same in another
+    # process, where they have other addresses
+    import subprocess, sys
+    make = 'metrics.Hybrid([metrics.Dihedral(), metrics.RMSD()], [1.0, 1.0])'
+    fingerprint = shared.metric_fingerprint(eval(make))
+    code = ('from msmbuilder import metrics; '
+            'from msmbuilder.parallel_assign import shared; '
+            'print shared.metric_fingerprint(%s)' % make)
+    other = subprocess.check_output([sys.executable, '-c', code])
+    assert other.strip() == fingerprint
+    assert fingerprint != shared.metric_fingerprint(
+        metrics.Hybrid([metrics.Dihedral(), metrics.RMSD()], [1.0, 2.0]))
+
+
+def test_remove():
+    directory = tempfile.mkdtemp()
+    try:
+        for segment_key in ['a', 'b']:
+            shared.cached(segment_key, lambda: np.zeros(3), directory)
+        assert shared.remove(['a', 'c'], directory) == 1
+        assert sorted(os.listdir(directory)) == [shared.PREFIX + 'b',
+                                                 shared.PREFIX + 'b.lock']
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+import tables
+
+from msmbuilder import Project
+from msmbuilder import metrics
+from msmbuilder.parallel_assign import remote, local
+from msmbuilder.parallel_assign.stream import assign_iter
+from common import fixtures_dir
+
+
+class test_assign_iter():
+    def setup(self):
+        self.metric = metrics.Dihedral()
+        self.pdb_fn = os.path.join(fixtures_dir(), 'native.pdb')
+        self.trj_fn = os.path.join(fixtures_dir(), 'trj0.lh5')
+        self.project = Project({'NumTrajs': 1, 'TrajLengths': [501], 'TrajFileBaseName': 'trj', 'TrajFileType': '.lh5',
+                           'ConfFilename': self.pdb_fn,
+                           'TrajFilePath': fixtures_dir()})
+        self.outdir = tempfile.mkdtemp()
+        del remote.STATES[:]
+
+        vtraj = local.partition(self.project, chunk_size=501)[0]
+        self.a, self.d, _, _ = remote.assign(vtraj, self.trj_fn, self.metric)
+
+    def teardown(self):
+        shutil.rmtree(self.outdir)
+
+    def check_blocks(self, blocks, n_frames=501):
+        covered = np.zeros(n_frames, dtype=bool)
+        for traj, start, stop, a, d in blocks:
+            assert traj == 0
+            assert not np.any(covered[start:stop])
+            covered[start:stop] = True
+            npt.assert_array_equal(a, self.a[start:stop])
+            npt.assert_array_almost_equal(d, self.d[start:stop])
+        return covered
+
+    def test_0(self):
+        # in this process, one block per vtraj, covering every frame once
+        blocks = list(assign_iter(self.project, self.trj_fn, self.metric,
+                                  chunk_size=100))
+        assert len(blocks) == 6
+        assert np.all(self.check_blocks(blocks))
+
+    def test_1(self):
+        # in a pool of processes
+        blocks = list(assign_iter(self.project, self.trj_fn, self.metric,
+                                  chunk_size=100, n_procs=2))
+        assert np.all(self.check_blocks(blocks))
+
+    def test_2(self):
+        # the blocks are saved, and a second run has nothing left to do
+        blocks = list(assign_iter(self.project, self.trj_fn, self.metric,
+                                  chunk_size=100, output_dir=self.outdir))
+        assert np.all(self.check_blocks(blocks))
+
+        f = tables.openFile(os.path.join(self.outdir, 'Assignments.h5'))
+        npt.assert_array_equal(f.root.Data[0], self.a)
+        f.close()
+        f = tables.openFile(os.path.join(self.outdir, 'Assignments.h5.distances'))
+        npt.assert_array_almost_equal(f.root.Data[0], self.d)
+        f.close()
+
+        assert list(assign_iter(self.project, self.trj_fn, self.metric,
+                                chunk_size=100, output_dir=self.outdir)) == []
+
+    def test_3(self):
+        # stopping early saves what was yielded, and the next run picks up
+        # the rest
+        blocks = assign_iter(self.project, self.trj_fn, self.metric,
+                             chunk_size=100, output_dir=self.outdir)
+        first = [blocks.next() for _ in xrange(2)]
+        blocks.close()
+
+        rest = list(assign_iter(self.project, self.trj_fn, self.metric,
+                                chunk_size=100, output_dir=self.outdir))
+        assert len(rest) == 4
+        assert np.all(self.check_blocks(first + rest))
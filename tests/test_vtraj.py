@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy.testing as npt
+
+from msmbuilder import Trajectory, Project
+from msmbuilder.parallel_assign.vtraj import VTraj, VTrajPlan, HandlePool, CoordinateBuffer
+from common import fixtures_dir
+
+
+class test_load():
+    def setup(self):
+        self.pdb_fn = os.path.join(fixtures_dir(), 'native.pdb')
+        self.trj_fn = os.path.join(fixtures_dir(), 'trj0.lh5')
+        self.project = Project({'NumTrajs': 1, 'TrajLengths': [501], 'TrajFileBaseName': 'trj', 'TrajFileType': '.lh5',
+                           'ConfFilename': self.pdb_fn,
+                           'TrajFilePath': fixtures_dir()})
+
+    def test_0(self):
+        # the same coordinates as loading the whole trajectory
+        correct = Trajectory.LoadTrajectoryFile(self.trj_fn)['XYZList']
+        conf = Trajectory.LoadTrajectoryFile(self.pdb_fn)
+        handles, buffer = HandlePool(), CoordinateBuffer()
+
+        vtraj = VTraj(self.project, (0, 10, 20), (0, 400, 450))
+        xyz = vtraj.load(conf, handles, buffer)['XYZList']
+        npt.assert_array_equal(xyz, np.concatenate([correct[10:20], correct[400:450]]))
+
+        # a smaller vtraj reuses the buffer and the open file
+        vtraj = VTraj(self.project, (0, 100, 105))
+        xyz = vtraj.load(conf, handles, buffer)['XYZList']
+        npt.assert_array_equal(xyz, correct[100:105])
+        assert len(handles) == 1
+        handles.close()
+
+    def test_1(self):
+        vtraj = VTraj(self.project, (0, 0, 5), (0, 10, 12), (0, 20, 30))
+        blocks = vtraj.split(4)
+        assert [b.canonical() for b in blocks] == [[(0, 0, 4)],
+                                                   [(0, 4, 5), (0, 10, 12), (0, 20, 21)],
+                                                   [(0, 21, 25)],
+                                                   [(0, 25, 29)],
+                                                   [(0, 29, 30)]]
+
+
+def test_plan():
+    vtrajs = [VTraj(None, (0, 0, 5), (1, 0, 2)), VTraj(None, (1, 2, 9))]
+    plan = VTrajPlan.from_vtrajs(None, vtrajs)
+    assert len(plan) == 2
+    npt.assert_equal(plan.lengths(), [7, 7])
+    assert [e.canonical() for e in plan] == [e.canonical() for e in vtrajs]
+    assert [e.index for e in plan] == [0, 1]
+    assert plan[-1].canonical() == [(1, 2, 9)]
+    assert plan.hashes() == [e.hash() for e in vtrajs]
+
+    # appending to a view doesn't change the plan
+    vtraj = plan[0]
+    vtraj.append((2, 0, 1))
+    assert len(vtraj) == 8
+    assert len(plan[0]) == 7
+
+
+class test_handle_pool():
+    def setup(self):
+        self.d = tempfile.mkdtemp()
+        self.fns = []
+        for i in range(3):
+            fn = os.path.join(self.d, 'trj%d.lh5' % i)
+            shutil.copy(os.path.join(fixtures_dir(), 'trj0.lh5'), fn)
+            self.fns.append(fn)
+
+    def test_0(self):
+        pool = HandlePool(max_open=2)
+        h0 = pool.get(self.fns[0])
+        assert pool.get(self.fns[0]) is h0
+        h1 = pool.get(self.fns[1])
+        pool.get(self.fns[0])
+        # fns[1] is the least recently used, so it's evicted
+        pool.get(self.fns[2])
+        assert len(pool) == 2
+        assert h0.isopen
+        assert not h1.isopen
+        pool.close()
+        assert len(pool) == 0
+
+    def teardown(self):
+        shutil.rmtree(self.d)
+
+
+def test_coordinate_buffer():
+    buffer = CoordinateBuffer()
+    a = buffer.get(10, 3)
+    assert a.shape == (10, 3, 3)
+    b = buffer.get(5, 3)
+    assert b.shape == (5, 3, 3)
+    # no reallocation when shrinking
+    assert np.may_share_memory(a, b)